@@ -0,0 +1,48 @@
+# Compare the black and tokenize python engines on a corpus of python files.
+#
+# usage: python benchmarks/bench_engines.py [CORPUS_DIR] [--repeat N]
+# The corpus defaults to the standard library of the running interpreter.
+import argparse
+import sysconfig
+import time
+from pathlib import Path
+
+from refers.refers import get_python_tags
+from refers.refers import get_python_tags_tokenize
+
+ENGINES = {"black": get_python_tags, "tokenize": get_python_tags_tokenize}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("corpus", nargs="?", default=sysconfig.get_paths()["stdlib"])
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    sources = []
+    for f in sorted(Path(args.corpus).rglob("*.py")):
+        try:
+            sources.append((f, f.read_text(encoding="utf-8")))
+        except (OSError, UnicodeDecodeError):
+            continue
+    size = sum(len(src) for _, src in sources) / 1e6
+    print(f"corpus: {args.corpus} ({len(sources)} files, {size:.1f} MB)")
+
+    for name, engine in ENGINES.items():
+        failures = 0
+        t0 = time.perf_counter()
+        for _ in range(args.repeat):
+            for f, src in sources:
+                try:
+                    engine(f, src)
+                except Exception:
+                    failures += 1
+        elapsed = (time.perf_counter() - t0) / args.repeat
+        print(
+            f"{name:>8}: {elapsed:8.2f} s  {size / elapsed:6.2f} MB/s  "
+            f"{failures // args.repeat} files failed"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# Latency of the language server on a generated workspace: lookups answered from the resident index
+# and re-indexing of an open document on didChange.
+#
+# usage: python benchmarks/bench_lsp.py [--files N] [--tags-per-file N] [--repeat N]
+import argparse
+import io
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from refers.lsp import LanguageServer
+from refers.refers import load_config
+
+
+def timed(func, repeat: int) -> str:
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    times.sort()
+    return (
+        f"median {statistics.median(times) * 1e3:8.3f} ms, "
+        f"p99 {times[int(len(times) * 0.99) - 1] * 1e3:8.3f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=1_000)
+    parser.add_argument("--tags-per-file", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=1_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pdir = Path(tmp)
+        (pdir / "pyproject.toml").write_text("[tool.refers]\n")
+        for i in range(args.files):
+            (pdir / f"m{i}.py").write_text(
+                "".join(
+                    f"def f{j}():\n    return {j}  # @tag:t{i}_{j}\n\n"
+                    for j in range(args.tags_per_file)
+                )
+            )
+        doc_text = "".join(
+            f"see @ref:t{i}_{i % args.tags_per_file}:line\n" for i in range(args.files)
+        )
+        (pdir / "doc.md").write_text(doc_text)
+        server = LanguageServer(
+            load_config(pdir, engine="tokenize", cache=False), io.BytesIO()
+        )
+
+        t0 = time.perf_counter()
+        server.initialize({})
+        print(
+            f"{args.files} files, {len(server.workspace.tags)} tags: "
+            f"initialize {time.perf_counter() - t0:.2f} s"
+        )
+
+        doc_uri = (pdir / "doc.md").as_uri()
+        module_uri = (pdir / "m0.py").as_uri()
+        module_text = (pdir / "m0.py").read_text()
+        server.did_open({"textDocument": {"uri": doc_uri, "text": doc_text}})
+        server.did_open({"textDocument": {"uri": module_uri, "text": module_text}})
+        position = {
+            "textDocument": {"uri": doc_uri},
+            "position": {"line": 7, "character": 8},
+        }
+        prefix = {
+            "textDocument": {"uri": doc_uri},
+            "position": {"line": 0, "character": 10},
+        }
+        edit = {
+            "textDocument": {"uri": module_uri},
+            "contentChanges": [
+                {
+                    "range": {
+                        "start": {"line": 1, "character": 4},
+                        "end": {"line": 1, "character": 4},
+                    },
+                    "text": " ",
+                }
+            ],
+        }
+
+        print(f"definition: {timed(lambda: server.definition(position), args.repeat)}")
+        print(f"     hover: {timed(lambda: server.hover(position), args.repeat)}")
+        print(f"completion: {timed(lambda: server.completion(prefix), args.repeat)}")
+        print(
+            f" didChange: {timed(lambda: server.did_change(edit), args.repeat // 10)}"
+            f" ({args.tags_per_file} tags in the edited file)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# Compare locating the tag and reference markers of a large generated file with one pass of the
+# trie patterns of Markers.scan (one per leading character of the markers) against one regex pass
+# per marker, and against a plain alternation of the markers.
+#
+# usage: python benchmarks/bench_markers.py [--lines N] [--marker-every N] [--repeat N]
+import argparse
+import re
+import time
+from typing import List
+
+from refers.markers import Markers
+
+ALIASES = {
+    "default": ([], []),
+    "aliases": (["@anchor:"], ["@see:", "@cite:"]),
+    "aliases, other prefix": (["%anchor:"], ["@see:", "@cite:"]),
+}
+
+
+def per_marker(markers: Markers, buf: bytes):
+    patterns = [re.compile(re.escape(m.encode())) for m in markers.tag_markers]
+    tag_offsets = sorted(m.start() for p in patterns for m in p.finditer(buf))
+    patterns = [re.compile(re.escape(m.encode())) for m in markers.ref_markers]
+    ref_offsets = sorted(m.start() for p in patterns for m in p.finditer(buf))
+    return tag_offsets, ref_offsets
+
+
+def plain_alternation(markers: Markers, buf: bytes):
+    all_markers = markers.tag_markers + markers.ref_markers
+    pattern = re.compile(b"|".join(re.escape(m.encode()) for m in all_markers))
+    ref_markers = {m.encode() for m in markers.ref_markers}
+    tag_offsets: List[int] = []
+    ref_offsets: List[int] = []
+    for m in pattern.finditer(buf):
+        (ref_offsets if m.group() in ref_markers else tag_offsets).append(m.start())
+    return tag_offsets, ref_offsets
+
+
+def trie(markers: Markers, buf: bytes):
+    return markers.scan(buf)
+
+
+SCANNERS = {
+    "per marker": per_marker,
+    "plain alternation": plain_alternation,
+    "Markers.scan": trie,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=1_000_000)
+    parser.add_argument("--marker-every", type=int, default=1_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    lines = []
+    for i in range(args.lines):
+        if i % args.marker_every == 0:
+            lines.append(f"x{i} = {i}  # @tag:t{i}\n")
+        elif i % args.marker_every == 1:
+            lines.append(f"see @ref:t{i - 1}:line and @see:t{i - 1}\n")
+        else:
+            lines.append(f"{i:08d} INFO request from user@example.com in {i % 97} ms\n")
+    buf = "".join(lines).encode()
+    size = len(buf) / 1e6
+    print(f"{args.lines} lines, {size:.1f} MB, markers every {args.marker_every} lines")
+
+    for name, (tag_aliases, ref_aliases) in ALIASES.items():
+        markers = Markers(tag_aliases, ref_aliases)
+        print(f"{name}: {markers.tag_markers + markers.ref_markers}")
+        expected = per_marker(markers, buf)
+        for scanner_name, scanner in SCANNERS.items():
+            t0 = time.perf_counter()
+            for _ in range(args.repeat):
+                result = scanner(markers, buf)
+            elapsed = (time.perf_counter() - t0) / args.repeat
+            assert result == expected
+            print(
+                f"{scanner_name:>18}: {elapsed * 1e3:8.1f} ms  {size / elapsed:8.1f} MB/s"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# Compare the single-pass reference replacement with the previous per-reference re.sub approach on
+# reference-dense documents.
+#
+# usage: python benchmarks/bench_replace.py [--lines N] [--refs-per-line N] [--tags N]
+import argparse
+import random
+import re
+import time
+from pathlib import Path
+
+from refers.definitions import DOC_RE_TAG
+from refers.refers import DOC_PATTERN
+from refers.refers import make_ref_replacer
+from refers.tags import Tag
+from refers.tags import Tags
+
+OPTIONS = ["", ":line", ":file", ":quote", ":link", ":linkline", ":fulllink"]
+
+
+def legacy_render_line(line: str, tags: Tags, pdir: Path) -> str:
+    """reference replacement before the single-pass engine"""
+    for re_tag in re.finditer(DOC_RE_TAG, line):
+        tag_name, option = re_tag.group(1), re_tag.group(2)
+        if option is None:
+            option = ":default"
+        tag = tags.get_tag(tag_name)
+        visit = getattr(tag, f"visit_{option[1:]}", None)
+        assert visit is not None
+        line = re.sub(rf"{re_tag.group(0)}(?![a-zA-Z:])", visit(parent_dir=pdir), line)
+    return line
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=20_000)
+    parser.add_argument("--refs-per-line", type=int, default=8)
+    parser.add_argument("--tags", type=int, default=1_000)
+    args = parser.parse_args()
+
+    pdir = Path.cwd()
+    # fixed width names: the legacy approach also rewrites @ref:t1 inside @ref:t12
+    tags = Tags()
+    for i in range(args.tags):
+        tags.add_tag(
+            Tag(
+                f"t{i:05d}",
+                i + 1,
+                f"x{i} = {i}  # @tag:t{i:05d}",
+                pdir / "src.py",
+                i + 1,
+                i + 1,
+                f"x{i} = {i}",
+            )
+        )
+    rng = random.Random(0)
+    lines = [
+        " and ".join(
+            f"see @ref:t{rng.randrange(args.tags):05d}{rng.choice(OPTIONS)}"
+            for _ in range(args.refs_per_line)
+        )
+        + "\n"
+        for _ in range(args.lines)
+    ]
+    print(
+        f"{args.lines} lines, {args.refs_per_line} references per line, {args.tags} tags"
+    )
+
+    t0 = time.perf_counter()
+    legacy = [legacy_render_line(line, tags, pdir) for line in lines]
+    t_legacy = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    replace_ref = make_ref_replacer(tags, pdir, False)
+    single_pass = [DOC_PATTERN.sub(replace_ref, line) for line in lines]
+    t_single_pass = time.perf_counter() - t0
+
+    assert legacy == single_pass
+    print(f"     legacy: {t_legacy:6.3f} s")
+    print(f"single-pass: {t_single_pass:6.3f} s ({t_legacy / t_single_pass:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
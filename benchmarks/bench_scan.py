@@ -0,0 +1,63 @@
+# Compare tag scanning of a large generated text file: decoding it and matching every line
+# (get_text_tags) against one bytes regex over the raw, memory-mapped buffer (scan_text_tags).
+#
+# usage: python benchmarks/bench_scan.py [--lines N] [--tag-every N] [--repeat N]
+import argparse
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from refers.files import read_buffer
+from refers.refers import get_text_tags
+from refers.refers import read_source
+from refers.refers import scan_text_tags
+
+
+def decode_and_match(f: Path):
+    return get_text_tags(f, read_source(f) or "")
+
+
+def scan(f: Path):
+    with read_buffer(f) as buf:
+        return scan_text_tags(f, buf)
+
+
+SCANNERS = {"get_text_tags": decode_and_match, "scan_text_tags": scan}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=1_000_000)
+    parser.add_argument("--tag-every", type=int, default=10_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        f = Path(tmp) / "generated.log"
+        with open(f, "w") as fwrite:
+            for i in range(args.lines):
+                if i % args.tag_every == 0:
+                    fwrite.write(f"{i:08d} INFO request handled  # @tag:t{i}\n")
+                else:
+                    fwrite.write(f"{i:08d} INFO request handled in {i % 97} ms\n")
+        size = f.stat().st_size / 1e6
+        print(f"{args.lines} lines, {size:.1f} MB, a tag every {args.tag_every} lines")
+
+        for name, scanner in SCANNERS.items():
+            t0 = time.perf_counter()
+            for _ in range(args.repeat):
+                n_tags = len(scanner(f))
+            elapsed = (time.perf_counter() - t0) / args.repeat
+            tracemalloc.start()
+            scanner(f)
+            peak = tracemalloc.get_traced_memory()[1] / 1e6
+            tracemalloc.stop()
+            print(
+                f"{name:>14}: {elapsed * 1e3:8.1f} ms  {size / elapsed:8.1f} MB/s  "
+                f"peak {peak:6.1f} MB  {n_tags} tags"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+# python tag extraction from black's parse tree. Imported only when a python file has a tag
+import io
+import re
+from pathlib import Path
+from typing import cast
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from typing import Union
+
+import black
+from black import nodes
+from black.mode import TargetVersion
+from black.parsing import get_grammars
+from black.parsing import lib2to3_parse
+from blib2to3 import pygram
+from blib2to3.pgen2 import driver
+from blib2to3.pgen2 import token
+from blib2to3.pgen2.grammar import Grammar
+from blib2to3.pgen2.parse import ParseError
+from blib2to3.pgen2.tokenize import TokenError
+from blib2to3.pytree import Leaf
+from blib2to3.pytree import Node
+
+from refers.compromise_black import LineGenerator
+from refers.errors import MultipleTagsInOneLine
+from refers.logical_lines import ScopeSpan
+from refers.markers import DEFAULT_MARKERS
+from refers.markers import Markers
+from refers.scopes import ScopeIndex
+from refers.tags import Tag
+
+# types
+LeafID = int
+
+LN = Union[Leaf, Node]
+
+# grammars black tries in turn, by the name recorded in the tag cache
+GRAMMARS: Dict[str, Grammar] = {
+    "async_keywords": pygram.python_grammar_async_keywords,  # python 3.7-3.9
+    "python": pygram.python_grammar,  # python 3.0-3.6
+    "soft_keywords": pygram.python_grammar_soft_keywords,  # python 3.10+
+}
+
+
+def get_target_versions(target_versions: Optional[List[str]]) -> Set[TargetVersion]:
+    """black target versions from names like "py311". Names black does not know are skipped"""
+    if not target_versions:
+        return set()
+    return {
+        TargetVersion[v.upper()]
+        for v in target_versions
+        if v.upper() in TargetVersion.__members__
+    }
+
+
+def get_grammar_names(
+    target_versions: Set[TargetVersion], grammar: Optional[str] = None
+) -> List[str]:
+    """names of the grammars to try, in order: grammar first if it suits the target versions"""
+    names = [
+        name
+        for g in get_grammars(target_versions)
+        for name, known in GRAMMARS.items()
+        if g is known
+    ]
+    if grammar in names:
+        names.remove(grammar)
+        names.insert(0, grammar)
+    return names
+
+
+def parse(
+    src_txt: str,
+    target_versions: Set[TargetVersion],
+    grammar: Optional[str] = None,
+) -> Tuple[Node, str]:
+    """
+    Parse like black's lib2to3_parse, trying the grammar that parsed the file last time first
+    :param src_txt: python source
+    :param target_versions: restrict the grammars tried to those of these versions
+    :param grammar: name of the grammar to try first
+    :return: tree and name of the grammar that parsed it
+    """
+    if not src_txt.endswith("\n"):
+        src_txt += "\n"
+    for name in get_grammar_names(target_versions, grammar):
+        try:
+            result = driver.Driver(GRAMMARS[name]).parse_string(src_txt, True)
+        except (ParseError, TokenError):
+            continue
+        if isinstance(result, Leaf):
+            result = Node(pygram.python_symbols.file_input, [result])
+        return result, name
+    # raise black's error message
+    lib2to3_parse(src_txt, target_versions)
+    raise AssertionError("unreachable")
+
+
+def get_scopes(src_node: Node, line_offset: int = 0) -> List[ScopeSpan]:
+    """
+    function and class spans of a parse tree, as refers.logical_lines.LogicalLines collects them
+    :param src_node: tree parsed by black
+    :param line_offset: number of lines stripped from the top of the source before parsing
+    :return:
+    """
+    scopes: List[ScopeSpan] = []
+    for node in src_node.pre_order():
+        if node.type == pygram.python_symbols.funcdef:
+            kind = "def"
+        elif node.type == pygram.python_symbols.classdef:
+            kind = "class"
+        else:
+            continue
+        start = node
+        if node.parent is not None and node.parent.type in (
+            pygram.python_symbols.async_funcdef,
+            pygram.python_symbols.async_stmt,
+        ):
+            start = node.parent  # async def
+        # the body ends at its last NEWLINE, before the DEDENTs closing the block
+        last: LN = node
+        while isinstance(last, Node):
+            last = next(
+                child
+                for child in reversed(last.children)
+                if child.type not in (token.INDENT, token.DEDENT)
+            )
+        scopes.append(
+            (
+                kind,
+                cast(Leaf, node.children[1]).value,
+                start.get_lineno() + line_offset,
+                last.get_lineno() + line_offset,
+            )
+        )
+    return scopes
+
+
+def get_python_tags(
+    f: Path,
+    src_contents: str,
+    target_versions: Optional[List[str]] = None,
+    markers: Markers = DEFAULT_MARKERS,
+) -> List[Tag]:
+    """get tags of a python file: the full line of a tag is the whole (multi-line) statement"""
+    return parse_python_tags(f, src_contents, target_versions, None, markers)[0]
+
+
+def parse_python_tags(
+    f: Path,
+    src_contents: str,
+    target_versions: Optional[List[str]] = None,
+    grammar: Optional[str] = None,
+    markers: Markers = DEFAULT_MARKERS,
+) -> Tuple[List[Tag], str]:
+    """
+    get tags of a python file along with the name of the grammar that parsed it
+    :param target_versions: python versions the file targets, e.g. ["py38", "py39"]
+    :param grammar: name of the grammar that parsed the file last time, tried first
+    :param markers: tag markers
+    :return:
+    """
+    mode = black.Mode()
+    file_tags: List[Tag] = []
+    src_lines = io.StringIO(src_contents).readlines()
+    src_stripped = src_contents.lstrip()
+    line_offset = src_contents[: len(src_contents) - len(src_stripped)].count("\n")
+    src_node, grammar = parse(
+        src_stripped, get_target_versions(target_versions), grammar
+    )
+    scopes: Optional[ScopeIndex] = None  # built for the first tag
+    lines = LineGenerator(mode=mode)
+    line_num_scanned = 0
+    for current_line in lines.visit(src_node):
+        # standalone comments hold no information in Leaf and is therefore not supported
+        if current_line.leaves[0].type == nodes.STANDALONE_COMMENT:
+            continue
+
+        line_num_start = current_line.leaves[0].get_lineno() + line_offset
+        line_num_end = current_line.leaves[-1].get_lineno() + line_offset
+        full_line = None
+
+        # a line shared by several logical lines (def f(): return 1) belongs to the first
+        line_nums = range(max(line_num_start, line_num_scanned + 1), line_num_end + 1)
+        line_num_scanned = max(line_num_scanned, line_num_end)
+        for line_num in line_nums:
+            src_line = src_lines[line_num - 1]
+            if not markers.has_tag(src_line):
+                continue
+            src_line = re.sub(r"\s*(.*)\n$", r"\1", src_line)  # strip newline
+            tag_names = markers.tag_pattern.findall(src_line)
+            if len(tag_names) == 0:
+                continue
+            elif len(tag_names) > 1:
+                raise MultipleTagsInOneLine
+            if full_line is None:
+                full_line = "".join(src_lines[line_num_start - 1 : line_num_end])
+                full_line = re.sub(r"^\s*(.*)\n$", r"\1", full_line, flags=re.DOTALL)
+            if scopes is None:
+                scopes = ScopeIndex(get_scopes(src_node, line_offset))
+            tag = Tag(
+                tag_names[0],
+                line_num,
+                src_line,
+                f,
+                line_num_start,
+                line_num_end,
+                full_line,
+                scopes.func_name(line_num_start),
+                scopes.class_name(line_num_start),
+            )
+            file_tags.append(tag)
+    return file_tags, grammar
@@ -0,0 +1,300 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+
+from refers.definitions import CACHE_DIR_NAME
+from refers.files import atomic_write_text
+from refers.files import Buffer
+from refers.files import read_buffer
+from refers.markers import DEFAULT_MARKERS
+from refers.markers import Markers
+from refers.tags import Tag
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 4  # bump when the layout of cache entries or the tag extraction changes
+CACHE_FILE_NAME = "tags.json"
+DEFAULT_CACHE_MAX_SIZE = 64 * 1024**2  # bytes
+# a hit refreshes the last use of an entry at most this often, so that a run changing nothing
+# does not rewrite the cache
+LAST_USED_RESOLUTION = 24 * 3600  # seconds
+
+
+def content_hash(src_bytes: Buffer) -> str:
+    return hashlib.blake2b(src_bytes, digest_size=16).hexdigest()
+
+
+def default_cache_dir(rootdir: Path) -> Path:
+    return rootdir / CACHE_DIR_NAME
+
+
+def ensure_cache_dir(cache_dir: Path):
+    """create the cache directory, git-ignored"""
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    gitignore = cache_dir / ".gitignore"
+    if not gitignore.exists():
+        gitignore.write_text("# created by refers\n*\n")
+
+
+def tag_rows(tags: List[Tag]) -> List[List[Any]]:
+    """tags as JSON rows, without their file"""
+    return [
+        [
+            tag.name,
+            tag.line_num,
+            tag.line,
+            tag.line_num_start,
+            tag.line_num_end,
+            tag.full_line,
+            tag.func_name,
+            tag.class_name,
+        ]
+        for tag in tags
+    ]
+
+
+def tags_from_rows(f: Path, rows: List[List[Any]]) -> List[Tag]:
+    """tags of file f from their JSON rows"""
+    tags = []
+    for (
+        name,
+        line_num,
+        line,
+        line_num_start,
+        line_num_end,
+        full_line,
+        func_name,
+        class_name,
+    ) in rows:
+        tags.append(
+            Tag(
+                name,
+                line_num,
+                line,
+                f,
+                line_num_start,
+                line_num_end,
+                full_line,
+                func_name,
+                class_name,
+            )
+        )
+    return tags
+
+
+def blob_key(oid: str, f: Path) -> str:
+    """cache key of a git blob. The suffix of its path decides how its tags are read"""
+    return f"blob:{oid}{f.suffix}"
+
+
+class FileEntry:
+    """
+    result of reading a file for the cache: its stat and content hash when read, its tags, the
+    numbers of the lines holding a reference and, for python files parsed by black, the name of the
+    grammar that parsed it. text holds the decoded contents of a file with references when the
+    reader kept them for rendering; it is not cached
+    """
+
+    __slots__ = ("mtime_ns", "size", "digest", "tags", "grammar", "ref_lines", "text")
+
+    def __init__(
+        self,
+        mtime_ns: int,
+        size: int,
+        digest: str,
+        tags: List[Tag],
+        grammar: Optional[str] = None,
+        ref_lines: Optional[List[int]] = None,
+        text: Optional[str] = None,
+    ):
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.digest = digest
+        self.tags = tags
+        self.grammar = grammar
+        self.ref_lines = [] if ref_lines is None else ref_lines
+        self.text = text
+
+
+class TagCache:
+    """
+    On-disk cache of the tags of each file, keyed by path and validated by mtime and size and, when
+    those changed, by a hash of the contents. The cache is discarded when it was built with another
+    engine, other markers or other target versions. Entries are evicted least recently used first
+    once the cache grows beyond max_size bytes. A read-only cache keeps its changes in memory, e.g.
+    for a check that must write nothing.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path,
+        engine: str = "black",
+        max_size: int = DEFAULT_CACHE_MAX_SIZE,
+        markers: Markers = DEFAULT_MARKERS,
+        target_versions: Optional[List[str]] = None,
+        read_only: bool = False,
+    ):
+        self.cache_dir = cache_dir
+        self.engine = engine
+        self.max_size = max_size
+        self.markers = markers
+        self.target_versions = target_versions
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self._now = time.time()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._changed = False
+        self._load()
+
+    @property
+    def cache_file(self) -> Path:
+        return self.cache_dir / CACHE_FILE_NAME
+
+    def _load(self):
+        try:
+            with open(self.cache_file, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if (
+            not isinstance(data, dict)
+            or data.get("version") != CACHE_VERSION
+            or data.get("engine") != self.engine
+            or data.get("markers") != self.markers.key()
+            or data.get("target_versions") != self.target_versions
+        ):
+            logger.info(f"Discarding outdated tag cache {self.cache_file}")
+            return
+        self._entries = data["entries"]
+
+    def get_entry(self, f: Path) -> Optional[FileEntry]:
+        """cached entry of a file, or None if the file is not cached or changed"""
+        entry = self._entries.get(str(f))
+        if entry is None:
+            self.misses += 1
+            return None
+        try:
+            st = os.stat(f)
+        except OSError:
+            self.misses += 1
+            return None
+        if st.st_mtime_ns != entry["mtime_ns"] or st.st_size != entry["size"]:
+            with read_buffer(f) as buf:
+                digest = content_hash(buf)
+            if digest != entry["digest"]:
+                self.misses += 1
+                return None
+            # touched only
+            entry["mtime_ns"], entry["size"] = st.st_mtime_ns, st.st_size
+            entry["last_used"] = self._now
+            self._changed = True
+        return self._hit(f, entry)
+
+    def get_blob(self, oid: str, f: Path) -> Optional[FileEntry]:
+        """
+        cached entry of a git blob read as file f, or None. A blob never changes, so the entry needs
+        no validation and is shared by every revision and path holding the same contents and suffix
+        """
+        entry = self._entries.get(blob_key(oid, f))
+        if entry is None:
+            self.misses += 1
+            return None
+        return self._hit(f, entry)
+
+    def _hit(self, f: Path, entry: Dict[str, Any]) -> FileEntry:
+        """file entry of a valid cache entry, marked as used"""
+        if self._now - entry["last_used"] >= LAST_USED_RESOLUTION:
+            entry["last_used"] = self._now
+            self._changed = True
+        self.hits += 1
+        return FileEntry(
+            entry["mtime_ns"],
+            entry["size"],
+            entry["digest"],
+            tags_from_rows(f, entry["tags"]),
+            entry["grammar"],
+            entry["ref_lines"],
+        )
+
+    def put_blob(self, oid: str, f: Path, file_entry: FileEntry):
+        self._store(blob_key(oid, f), file_entry)
+
+    def grammars(self, files: Iterable[Path]) -> Dict[Path, str]:
+        """
+        grammar that parsed each file last time, changed or not: an edit rarely changes the python
+        version a file is written for
+        """
+        grammars = {}
+        for f in files:
+            entry = self._entries.get(str(f))
+            if entry is not None and entry.get("grammar") is not None:
+                grammars[f] = entry["grammar"]
+        return grammars
+
+    def put(self, f: Path, file_entry: FileEntry):
+        self._store(str(f), file_entry)
+
+    def _store(self, key: str, file_entry: FileEntry):
+        self._entries[key] = {
+            "mtime_ns": file_entry.mtime_ns,
+            "size": file_entry.size,
+            "digest": file_entry.digest,
+            "grammar": file_entry.grammar,
+            "ref_lines": file_entry.ref_lines,
+            "last_used": self._now,
+            "tags": tag_rows(file_entry.tags),
+        }
+        self._changed = True
+
+    def _evict(self) -> str:
+        """drop least recently used entries until the cache fits in max_size"""
+
+        def dump() -> str:
+            return json.dumps(
+                {
+                    "version": CACHE_VERSION,
+                    "engine": self.engine,
+                    "markers": self.markers.key(),
+                    "target_versions": self.target_versions,
+                    "entries": self._entries,
+                }
+            )
+
+        data = dump()
+        if len(data) <= self.max_size:  # sizing each entry is only needed to evict
+            return data
+        sizes = {path: len(json.dumps(entry)) for path, entry in self._entries.items()}
+        total = sum(sizes.values())
+        for path in sorted(self._entries, key=lambda p: self._entries[p]["last_used"]):
+            total -= sizes[path]
+            del self._entries[path]
+            if total <= self.max_size:
+                break
+        return dump()
+
+    def save(self):
+        """write the cache atomically"""
+        if not self._changed or self.read_only:
+            return
+        data = self._evict()
+        ensure_cache_dir(self.cache_dir)
+        atomic_write_text(self.cache_file, data)
+        self._changed = False
+        logger.info(
+            f"Tag cache: {self.hits} hits, {self.misses} misses, {len(self._entries)} entries"
+        )
+
+    def clear(self):
+        self._entries = {}
+        self._changed = False
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
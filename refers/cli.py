@@ -1,10 +1,48 @@
 import argparse
+import io
+import logging
+import sys
+from pathlib import Path
+from typing import cast
+from typing import List
+from typing import TYPE_CHECKING
 
+from refers.cache import TagCache
 from refers.refers import format_doc
+from refers.refers import load_config
+from refers.watch import DEFAULT_POLL_INTERVAL
+from refers.watch import watch
+
+if TYPE_CHECKING:
+    from refers.index import TagIndex
+
+
+def render(index: "TagIndex", inputs: List[str]):
+    """stream the rendered documents to stdout. Line endings are kept"""
+    cast(io.TextIOWrapper, sys.stdout).reconfigure(newline="")
+    for name in inputs:
+        if name == "-":
+            cast(io.TextIOWrapper, sys.stdin).reconfigure(newline="")
+            index.render_stream(sys.stdin, sys.stdout)
+        else:
+            with open(name, newline="") as rfile:
+                index.render_stream(rfile, sys.stdout)
+    sys.stdout.flush()
 
 
 def run():
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "command",
+        nargs="?",
+        choices=["render", "serve", "lsp"],
+        help="render: write the rendered INPUTS to stdout. "
+        "serve: answer JSON-RPC requests on stdin and stdout, or on --socket. "
+        "lsp: language server on stdin and stdout",
+    )
+    parser.add_argument(
+        "inputs", nargs="*", help="documents to render, - for stdin (default)"
+    )
     parser.add_argument("-r", "--rootdir", type=str, default=None)
     parser.add_argument("--allow_not_found_tags", action="store_true", default=None)
     parser.add_argument("--accepted_tag_extensions", type=str, nargs="+", default=None)
@@ -13,8 +51,132 @@ def run():
     parser.add_argument("--dirs2search", type=str, nargs="+", default=None)
     parser.add_argument("--tag_files", type=str, nargs="+", default=None)
     parser.add_argument("--ref_files", type=str, nargs="+", default=None)
+    parser.add_argument("--ignore_patterns", type=str, nargs="+", default=None)
+    parser.add_argument(
+        "--no_ignore_files", dest="use_ignore_files", action="store_false", default=None
+    )
+    parser.add_argument(
+        "--git_files",
+        "--git-files",
+        action="store_true",
+        default=None,
+        help="list the files of the git index rather than walking the tree",
+    )
+    parser.add_argument(
+        "--engine", type=str, choices=["black", "tokenize"], default=None
+    )
+    parser.add_argument("-j", "--jobs", type=int, default=None)
+    parser.add_argument(
+        "--no_cache", "--no-cache", dest="cache", action="store_false", default=None
+    )
+    parser.add_argument("--clear_cache", "--clear-cache", action="store_true")
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="write nothing, list out of date outputs and exit with 1 if there are any",
+    )
+    parser.add_argument(
+        "--changed_since",
+        "--changed-since",
+        type=str,
+        default=None,
+        metavar="REV",
+        help="read and render only the files changed since the git revision REV or since the "
+        "last run, and the documents referencing their tags",
+    )
+    parser.add_argument(
+        "--staged",
+        action="store_true",
+        help="read and render only the files with staged changes or changed since the "
+        "last run, and the documents referencing their tags",
+    )
+    parser.add_argument(
+        "--rev",
+        dest="revs",
+        type=str,
+        action="append",
+        default=None,
+        metavar="REV",
+        help="render the git revision REV from the object store, without a checkout. "
+        "Repeat to render several revisions",
+    )
+    parser.add_argument(
+        "--output_dir",
+        "--output-dir",
+        type=str,
+        default=None,
+        help="directory of the outputs of --rev, one subdirectory per revision",
+    )
+    parser.add_argument("-w", "--watch", action="store_true")
+    parser.add_argument("--poll_interval", type=float, default=DEFAULT_POLL_INTERVAL)
+    parser.add_argument("--socket", type=str, default=None)
+    parser.add_argument("-v", "--verbose", action="store_true")
     args = parser.parse_args()
-    format_doc(
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING, format="%(message)s"
+    )
+    if args.watch or args.command is not None:
+        mode = "--watch" if args.command is None else f"the {args.command} command"
+        for flag, value in (
+            ("--watch", args.watch and args.command is not None),
+            ("--check", args.check),
+            ("--changed_since", args.changed_since is not None),
+            ("--staged", args.staged),
+            ("--rev", args.revs is not None),
+            ("--output_dir", args.output_dir is not None),
+        ):
+            if value:
+                parser.error(f"{flag} cannot be used with {mode}")
+        config = load_config(
+            rootdir=args.rootdir,
+            allow_not_found_tags=args.allow_not_found_tags,
+            accepted_tag_extensions=args.accepted_tag_extensions,
+            accepted_ref_extensions=args.accepted_ref_extensions,
+            dirs2ignore=args.dirs2ignore,
+            dirs2search=args.dirs2search,
+            tag_files=args.tag_files,
+            ref_files=args.ref_files,
+            ignore_patterns=args.ignore_patterns,
+            use_ignore_files=args.use_ignore_files,
+            engine=args.engine,
+            jobs=args.jobs,
+            cache=args.cache,
+            git_files=args.git_files,
+        )
+        if args.clear_cache:
+            TagCache(config.cache_dir).clear()
+        # the servers are imported only when used, to keep the start up of the cli short
+        if args.command == "render":
+            from refers.index import TagIndex
+
+            render(TagIndex.from_config(config), args.inputs or ["-"])
+        elif args.command == "lsp":
+            from refers.lsp import serve_lsp
+
+            serve_lsp(config)
+        elif args.command == "serve":
+            from refers.server import serve
+
+            serve(
+                config,
+                None if args.socket is None else Path(args.socket),
+                args.poll_interval,
+            )
+        else:
+            watch(config, args.poll_interval)
+        return
+    if args.revs is not None:
+        for flag, value in (
+            ("--changed_since", args.changed_since is not None),
+            ("--staged", args.staged),
+        ):
+            if value:
+                parser.error(f"{flag} cannot be used with --rev")
+        if args.output_dir is None:
+            parser.error("--rev needs --output_dir")
+    elif args.output_dir is not None:
+        parser.error("--output_dir is only used with --rev")
+    stats = format_doc(
         rootdir=args.rootdir,
         allow_not_found_tags=args.allow_not_found_tags,
         accepted_tag_extensions=args.accepted_tag_extensions,
@@ -23,4 +185,20 @@ def run():
         dirs2search=args.dirs2search,
         tag_files=args.tag_files,
         ref_files=args.ref_files,
+        ignore_patterns=args.ignore_patterns,
+        use_ignore_files=args.use_ignore_files,
+        engine=args.engine,
+        jobs=args.jobs,
+        cache=args.cache,
+        clear_cache=args.clear_cache,
+        check=args.check,
+        git_files=args.git_files,
+        changed_since=args.changed_since,
+        staged=args.staged,
+        revs=args.revs,
+        output_dir=args.output_dir,
     )
+    if len(stats.stale) > 0:
+        for out_fpath in stats.stale:
+            print(f"Out of date: {out_fpath}")
+        sys.exit(1)
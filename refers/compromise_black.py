@@ -1,4 +1,6 @@
+import sys
 from functools import partial
+from typing import Dict
 from typing import Iterator
 from typing import Set
 from typing import TypeVar
@@ -18,6 +20,7 @@ from black.nodes import WHITESPACE
 from blib2to3.pgen2 import token
 from blib2to3.pytree import Leaf
 from blib2to3.pytree import Node
+from blib2to3.pytree import type_repr
 
 """sorry black, you've been compromised"""
 
@@ -27,6 +30,10 @@ Index = int
 LeafID = int
 LN = Union[Leaf, Node]
 
+# name of the visit_*() method of each node type. Visitor.visit formats a new name for every node,
+# and cpython's type attribute cache keeps the name objects it was asked for alive
+VISIT_NAMES: Dict[int, str] = {}
+
 
 class LineGenerator(Visitor[Line]):
     """redefine to:
@@ -60,6 +67,21 @@ class LineGenerator(Visitor[Line]):
         self.current_line = Line(mode=self.mode, depth=complete_line.depth + indent)
         yield complete_line
 
+    def visit(self, node: LN) -> Iterator[Line]:
+        """Visitor.visit, looking up the visitor of each node type by the same name object"""
+        name = VISIT_NAMES.get(node.type)
+        if name is None:
+            if node.type < 256:
+                name = token.tok_name[node.type]
+            else:
+                name = str(type_repr(node.type))
+            name = VISIT_NAMES[node.type] = sys.intern(f"visit_{name}")
+        visitf = getattr(self, name, None)
+        if visitf:
+            yield from visitf(node)
+        else:
+            yield from self.visit_default(node)
+
     def visit_default(self, node: LN) -> Iterator[Line]:
         """Default `visit_*()` implementation. Recurses to children of `node`."""
         if isinstance(node, Leaf):
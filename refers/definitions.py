@@ -4,6 +4,10 @@ CODE_RE_TAG = rf"{TAG_COMMENT_ID}(\w+)"  # regex of tag in code
 DOC_RE_TAG = rf"{REF_COMMENT_ID}(\w+)(:\w+)?"  # regex of tag in document
 DOC_OUT_ID = "_refers"
 LIBRARY_NAME = "refers"
+CACHE_DIR_NAME = ".refers_cache"
+DEFAULT_DIRS2IGNORE = (".git", ".hg", ".svn", CACHE_DIR_NAME)  # never searched
+IGNORE_FILES = (".gitignore", ".ignore")  # files holding gitignore style patterns
+LATEST_PYTHON_MINOR = 13  # open ended requires-python ranges target up to python 3.13
 COMMENT_SYMBOL = {
     ".py": "#",
     ".jl": "#",
@@ -0,0 +1,216 @@
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+from refers.cache import content_hash
+from refers.cache import ensure_cache_dir
+from refers.files import atomic_write_text
+from refers.markers import DEFAULT_MARKERS
+from refers.markers import Markers
+from refers.tags import Tags
+
+logger = logging.getLogger(__name__)
+
+DEPS_VERSION = 1  # bump when the layout of the graph changes
+DEPS_FILE_NAME = "deps.json"
+
+# (tag name, :option or None) -> rendered reference
+RenderRef = Callable[[str, Optional[str]], str]
+
+
+def _stat_key(f: Path) -> Optional[List[int]]:
+    try:
+        st = os.stat(f)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _file_hash(f: Path) -> Optional[str]:
+    try:
+        with open(f, "rb") as fread:
+            return content_hash(fread.read())
+    except OSError:
+        return None
+
+
+def split_ref(ref: str) -> Tuple[str, Optional[str]]:
+    """NAME:OPTION -> (NAME, :OPTION)"""
+    tag_name, _, option = ref.partition(":")
+    return tag_name, (f":{option}" if option else None)
+
+
+class DependencyGraph:
+    """
+    Persisted record of which documents reference which tags and options, the rendered value of
+    each reference and the source files of the tags. A document whose contents, output and
+    referenced values are all unchanged since it was last rendered does not need rendering again.
+    Without a cache directory the graph is kept in memory only.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[Path],
+        pdir: Path,
+        allow_not_found_tags: bool,
+        markers: Markers = DEFAULT_MARKERS,
+    ):
+        self.cache_dir = cache_dir
+        self.settings = {
+            "pdir": str(pdir),
+            "allow_not_found_tags": allow_not_found_tags,
+            "ref_markers": list(markers.ref_markers),
+        }
+        self.loaded = False  # read from the cache directory
+        self._docs: Dict[str, Dict[str, Any]] = {}
+        self._seen: Set[str] = set()
+        self._changed = False
+        self._load()
+
+    @property
+    def deps_file(self) -> Optional[Path]:
+        return None if self.cache_dir is None else self.cache_dir / DEPS_FILE_NAME
+
+    def _load(self):
+        if self.deps_file is None:
+            return
+        try:
+            with open(self.deps_file, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if (
+            not isinstance(data, dict)
+            or data.get("version") != DEPS_VERSION
+            or data.get("settings") != self.settings
+        ):
+            logger.info(f"Discarding outdated dependency graph {self.deps_file}")
+            return
+        self._docs = data["docs"]
+        self.loaded = True
+
+    def forget(self, f: Path):
+        """drop a document, e.g. one that was deleted"""
+        if self._docs.pop(str(f), None) is not None:
+            self._changed = True
+
+    def dependents(self, tag_names: Set[str]) -> Set[Path]:
+        """documents that reference any of the tags"""
+        return {
+            Path(doc)
+            for doc, entry in self._docs.items()
+            if any(tag_name in entry["tags"] for tag_name in tag_names)
+        }
+
+    def has_output(self, f: Path) -> bool:
+        """whether f had references when it was last recorded"""
+        entry = self._docs.get(str(f))
+        return entry is not None and entry["output_stat"] is not None
+
+    def is_up_to_date(self, f: Path, out_fpath: Path, render: RenderRef) -> bool:
+        """
+        Check that rendering f would reproduce its existing output
+        :param f: reference file
+        :param out_fpath: output of f
+        :param render: renders a reference with the current tags
+        :return:
+        """
+        self._seen.add(str(f))
+        entry = self._docs.get(str(f))
+        if entry is None:
+            return False
+
+        # document contents
+        stat_key = _stat_key(f)
+        if stat_key is None:
+            return False
+        if stat_key != entry["doc_stat"]:
+            if _file_hash(f) != entry["doc_hash"]:
+                return False
+            entry["doc_stat"] = stat_key
+            self._changed = True
+
+        # output: untouched since written, or absent if the document has no references
+        out_stat_key = _stat_key(out_fpath)
+        if entry["output_stat"] is None or out_stat_key is None:
+            if entry["output_stat"] != out_stat_key:
+                return False
+        elif out_stat_key != entry["output_stat"]:
+            if _file_hash(out_fpath) != entry["output_hash"]:
+                return False
+            entry["output_stat"] = out_stat_key
+            self._changed = True
+
+        # referenced tags moved, changed or disappeared
+        for ref, value_hash in entry["refs"].items():
+            try:
+                value = render(*split_ref(ref))
+            except Exception:
+                return False  # render again to raise the error
+            if content_hash(value.encode()) != value_hash:
+                return False
+        return True
+
+    def record(
+        self,
+        f: Path,
+        out_fpath: Path,
+        refs: Dict[str, str],
+        tags: Tags,
+        doc: Optional[str],
+        doc_hash: Optional[str] = None,
+    ):
+        """
+        Record a rendered document
+        :param f: reference file
+        :param out_fpath: output of f
+        :param refs: NAME:OPTION -> rendered value of each reference in the document
+        :param tags: all tags
+        :param doc: rendered output, or None if the document has no references
+        :param doc_hash: content hash of f if already known, to save reading it again
+        :return:
+        """
+        self._seen.add(str(f))
+        ref_tags: Dict[str, Optional[str]] = {}
+        for ref in refs:
+            tag = tags.is_tag(split_ref(ref)[0])
+            ref_tags[split_ref(ref)[0]] = None if tag is None else str(tag.file)
+        self._docs[str(f)] = {
+            "doc_stat": _stat_key(f),
+            "doc_hash": _file_hash(f) if doc_hash is None else doc_hash,
+            "output_stat": None if doc is None else _stat_key(out_fpath),
+            "output_hash": None if doc is None else content_hash(doc.encode()),
+            "refs": {ref: content_hash(value.encode()) for ref, value in refs.items()},
+            "tags": ref_tags,  # tag name -> source file
+        }
+        self._changed = True
+
+    def save(self, prune: bool = False):
+        """
+        write the graph atomically
+        :param prune: drop documents that were not checked or recorded since loading
+        :return:
+        """
+        if prune:
+            for doc in set(self._docs) - self._seen:
+                del self._docs[doc]
+                self._changed = True
+        if not self._changed or self.cache_dir is None or self.deps_file is None:
+            return
+        ensure_cache_dir(self.cache_dir)
+        atomic_write_text(
+            self.deps_file,
+            json.dumps(
+                {"version": DEPS_VERSION, "settings": self.settings, "docs": self._docs}
+            ),
+        )
+        self._changed = False
+        self.loaded = True
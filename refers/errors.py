@@ -32,3 +32,7 @@ class TagNotInFunction(Exception):
 
 class TagNotInClass(Exception):
     pass
+
+
+class GitError(Exception):
+    pass
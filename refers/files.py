@@ -0,0 +1,452 @@
+import logging
+import mmap
+import os
+import subprocess
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from typing import TYPE_CHECKING
+from typing import Union
+
+from refers.definitions import DEFAULT_DIRS2IGNORE
+from refers.definitions import IGNORE_FILES
+from refers.errors import GitError
+
+if TYPE_CHECKING:
+    import pathspec
+
+logger = logging.getLogger(__name__)
+
+# (directory the rules were read from, compiled rules)
+IgnoreLevel = Tuple[str, "pathspec.PathSpec"]  # type: ignore[type-arg]
+
+# raw contents of a file: read whole, or memory-mapped when large
+Buffer = Union[bytes, mmap.mmap]
+
+MMAP_MIN_SIZE = 1024**2  # bytes. Smaller files are read whole
+
+
+def compile_ignore_patterns(lines: List[str]) -> "pathspec.PathSpec":  # type: ignore[type-arg]
+    """compile gitignore style patterns. pathspec is imported on the first ignore rules"""
+    import pathspec
+    from pathspec.util import lookup_pattern
+
+    try:  # pathspec>=1.0 deprecates the gitwildmatch name
+        pattern = lookup_pattern("gitignore")
+    except KeyError:
+        pattern = lookup_pattern("gitwildmatch")
+    return pathspec.PathSpec.from_lines(pattern, lines)
+
+
+class WalkStats:
+    """counters of a directory walk"""
+
+    def __init__(self):
+        self.dirs = 0  # directories scanned
+        self.files = 0  # files yielded
+        self.skipped = 0  # files and directories dropped by the ignore rules
+        self.filtered = 0  # files dropped by the extension and dirs2search filters
+
+    def __repr__(self):
+        return (
+            f"WalkStats(dirs={self.dirs}, files={self.files}, "
+            f"skipped={self.skipped}, filtered={self.filtered})"
+        )
+
+
+@contextmanager
+def read_buffer(path: Path) -> Iterator[Buffer]:
+    """
+    raw contents of a file, memory-mapped if it is large so that scanning it does not copy it
+    into memory. A mapped buffer is only valid within the with block
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < MMAP_MIN_SIZE:
+            yield f.read()
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            yield buf
+
+
+def count_newlines(buf: Buffer, start: int, end: int) -> int:
+    """number of newlines in buf[start:end]"""
+    if isinstance(buf, bytes):
+        return buf.count(b"\n", start, end)
+    return buf[start:end].count(b"\n")  # mmap has no count
+
+
+def atomic_write_text(path: Path, text: str):
+    """write a text file via a temporary file and a rename, so readers never see partial contents"""
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if tmp_path.exists():
+            tmp_path.unlink()
+        raise
+
+
+def read_ignore_file(path: Path) -> Optional["pathspec.PathSpec"]:  # type: ignore[type-arg]
+    """read gitignore style patterns from file"""
+    try:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    spec = compile_ignore_patterns(lines)
+    return spec if len(spec.patterns) > 0 else None
+
+
+def is_ignored(rel_path: str, levels: Iterable[IgnoreLevel], is_dir: bool) -> bool:
+    """
+    Check a path against stacked ignore rules. Later (deeper) rules take precedence and the last
+    matching pattern of a level wins, so negated patterns re-include paths as in git.
+    :param rel_path: posix path relative to the walk root
+    :param levels: ignore rules ordered from the walk root down to the parent directory of the path
+    :param is_dir: True if the path is a directory
+    :return:
+    """
+    ignored = None
+    for base, spec in levels:
+        path = rel_path[len(base) + 1 :] if base else rel_path
+        if is_dir:
+            path += "/"
+        for pattern in spec.patterns:
+            if pattern.include is not None and pattern.regex.match(path) is not None:
+                ignored = pattern.include
+    return bool(ignored)
+
+
+def run_git(pdir: Path, *args: str) -> Optional[bytes]:
+    """output of a git command run in pdir, None if it failed or git is not installed"""
+    try:
+        return subprocess.run(
+            ["git", "-C", str(pdir), *args], capture_output=True, check=True
+        ).stdout
+    except OSError as e:
+        logger.info(f"Could not run git: {e}")
+    except subprocess.CalledProcessError as e:
+        logger.info(f"git {' '.join(args)} failed: {os.fsdecode(e.stderr).strip()}")
+    return None
+
+
+def git_ls_files(pdir: Path) -> Optional[List[str]]:
+    """
+    Files of the git index under pdir that are present in the working tree, as posix paths relative
+    to pdir. Reading git's file list is faster than walking a large tree and leaves out untracked
+    files such as build outputs
+    :return: None if pdir is not in a git repository or git is not installed
+    """
+    out = run_git(pdir, "ls-files", "-z", "-t", "--cached", "--deleted")
+    if out is None:
+        return None
+    # -t prefixes each path with its status: H cached, M unmerged (listed once per stage),
+    # R deleted, S skipped by a sparse checkout
+    cached, deleted = set(), set()
+    for entry in out.split(b"\0"):
+        status, path = entry[:1], os.fsdecode(entry[2:])
+        if status in (b"H", b"M"):
+            cached.add(path)
+        elif status == b"R":
+            deleted.add(path)
+    return sorted(cached - deleted)
+
+
+def git_head(pdir: Path) -> Optional[str]:
+    """object id of the commit checked out in the repository of pdir, None without one"""
+    out = run_git(pdir, "rev-parse", "--verify", "-q", "HEAD^{commit}")
+    if out is None:
+        return None
+    return out.decode().strip()
+
+
+def git_changed_files(
+    pdir: Path, since: Optional[str] = None, staged: bool = False
+) -> Optional[List[str]]:
+    """
+    Files under pdir that git reports as changed, as posix paths relative to pdir. Deleted files
+    are included, and renamed files under both of their paths.
+    :param since: revision to compare with, HEAD by default
+    :param staged: the changes staged in the git index, rather than the changes of the working
+        tree together with the untracked files
+    :return: None if pdir is not in a git repository, git is not installed or since is unknown
+    """
+    diff_args = ["diff", "--name-only", "--no-renames", "--relative", "-z"]
+    if staged:
+        diff_args.append("--cached")
+    diff_args += ["--end-of-options", since or "HEAD", "--"]
+    out = run_git(pdir, *diff_args)
+    if out is None:
+        return None
+    changed = {os.fsdecode(path) for path in out.split(b"\0") if path}
+    if not staged:
+        untracked = run_git(pdir, "ls-files", "-z", "--others", "--exclude-standard")
+        if untracked is None:
+            return None
+        changed.update(os.fsdecode(path) for path in untracked.split(b"\0") if path)
+    return sorted(changed)
+
+
+def git_ls_tree(pdir: Path, rev: str) -> List[Tuple[str, str]]:
+    """
+    Files under pdir in the tree of a git revision, as (posix path relative to pdir, blob object
+    id). Symbolic links and submodules are left out
+    """
+    out = run_git(pdir, "ls-tree", "-r", "-z", "--end-of-options", rev)
+    if out is None:
+        raise GitError(f"Could not list the files of revision {rev} in {pdir}")
+    blobs = []
+    for entry in out.split(b"\0"):
+        if not entry:
+            continue
+        info, _, path = entry.partition(b"\t")
+        mode, obj_type, oid = info.split(b" ")
+        if obj_type == b"blob" and mode != b"120000":
+            blobs.append((os.fsdecode(path), oid.decode()))
+    return blobs
+
+
+class CatFile:
+    """
+    One long-lived `git cat-file --batch` process reading blobs from the object store of the
+    repository of pdir, so that reading many files from a revision starts a single process and
+    needs no checkout. Close it, or use it as a context manager, to end the process
+    """
+
+    def __init__(self, pdir: Path):
+        try:
+            self._process = subprocess.Popen(
+                ["git", "-C", str(pdir), "cat-file", "--batch"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+            )
+        except OSError as e:
+            raise GitError(f"Could not run git: {e}")
+        self.reads = 0
+
+    def read(self, oid: str) -> bytes:
+        """contents of an object"""
+        stdin, stdout = self._process.stdin, self._process.stdout
+        assert stdin is not None and stdout is not None
+        stdin.write(oid.encode() + b"\n")
+        stdin.flush()
+        header = stdout.readline().split()  # <oid> <type> <size>, or <oid> missing
+        if len(header) != 3:
+            raise GitError(f"Could not read git object {oid}: {header}")
+        contents = stdout.read(int(header[2]))
+        stdout.read(1)  # newline ending the object
+        self.reads += 1
+        return contents
+
+    def close(self):
+        if self._process.stdin is not None:
+            self._process.stdin.close()
+        self._process.wait()
+        if self._process.stdout is not None:
+            self._process.stdout.close()
+
+    def __enter__(self) -> "CatFile":
+        return self
+
+    def __exit__(self, *exc_info: object):
+        self.close()
+
+
+def _normalise_dirs(pdir: Path, dirs: Optional[List[Path]]) -> Optional[Set[str]]:
+    if dirs is None:
+        return None
+    return {os.path.normpath(d if Path(d).is_absolute() else pdir / d) for d in dirs}
+
+
+def walk_files(
+    pdir: Path,
+    accepted_extensions: Optional[List[str]] = None,
+    dirs2ignore: Optional[List[Path]] = None,
+    dirs2search: Optional[List[Path]] = None,
+    ignore_patterns: Optional[List[str]] = None,
+    use_ignore_files: bool = True,
+    stats: Optional[WalkStats] = None,
+) -> Iterator[Path]:
+    """
+    Walk a directory tree with os.scandir and yield the files to search. Ignored directories are
+    dropped before they are descended into.
+    :param pdir: root directory of the walk
+    :param accepted_extensions: only yield files with these (lower case) suffixes
+    :param dirs2ignore: directories whose whole subtree is ignored (absolute or relative to pdir)
+    :param dirs2search: only yield files whose parent directory is in this list (absolute or relative to pdir)
+    :param ignore_patterns: gitignore style patterns relative to pdir
+    :param use_ignore_files: honour .gitignore and .ignore files found in the tree
+    :param stats: counters updated during the walk
+    :return:
+    """
+    if stats is None:
+        stats = WalkStats()
+    extensions = None if accepted_extensions is None else set(accepted_extensions)
+    ignore_dirs = _normalise_dirs(pdir, dirs2ignore) or set()
+    search_dirs = _normalise_dirs(pdir, dirs2search)
+    search_parents = None
+    if search_dirs is not None:  # directories that lead to a searched directory
+        search_parents = set()
+        for d in search_dirs:
+            p = d
+            while p not in search_parents:
+                search_parents.add(p)
+                parent = os.path.dirname(p)
+                if parent == p:
+                    break
+                p = parent
+
+    root_levels: List[IgnoreLevel] = []
+    if ignore_patterns:
+        root_levels.append(("", compile_ignore_patterns(ignore_patterns)))
+
+    stack: List[Tuple[str, str, List[IgnoreLevel]]] = [(str(pdir), "", root_levels)]
+    while stack:
+        dir_path, rel_dir, levels = stack.pop()
+        try:
+            with os.scandir(dir_path) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError as e:
+            logger.warning(f"Could not scan directory {dir_path}: {e}")
+            continue
+        stats.dirs += 1
+
+        if use_ignore_files:
+            names = {e.name for e in entries}
+            for ignore_file in IGNORE_FILES:
+                if ignore_file in names:
+                    spec = read_ignore_file(Path(dir_path) / ignore_file)
+                    if spec is not None:
+                        levels = levels + [(rel_dir, spec)]
+
+        subdirs = []
+        for entry in entries:
+            rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            try:
+                entry_is_dir = entry.is_dir(follow_symlinks=False)
+                if not entry_is_dir and not entry.is_file():
+                    continue  # symlinks to directories are not followed
+            except OSError:
+                continue
+            if entry_is_dir:
+                if (
+                    entry.name in DEFAULT_DIRS2IGNORE
+                    or os.path.normpath(entry.path) in ignore_dirs
+                    or is_ignored(rel_path, levels, True)
+                ):
+                    stats.skipped += 1
+                    continue
+                if (
+                    search_parents is not None
+                    and os.path.normpath(entry.path) not in search_parents
+                ):
+                    stats.filtered += 1
+                    continue
+                subdirs.append((entry.path, rel_path, levels))
+                continue
+
+            if "." not in entry.name:
+                continue  # only files
+            suffix = os.path.splitext(entry.name)[1]
+            if (extensions is not None and suffix.lower() not in extensions) or (
+                search_dirs is not None
+                and os.path.normpath(dir_path) not in search_dirs
+            ):
+                stats.filtered += 1
+                continue
+            if is_ignored(rel_path, levels, False):
+                stats.skipped += 1
+                continue
+            stats.files += 1
+            yield Path(entry.path)
+
+        stack.extend(reversed(subdirs))  # visit directories in sorted order
+    logger.info(f"Walked {pdir}: {stats}")
+
+
+def filter_files(
+    pdir: Path,
+    rel_paths: Iterable[str],
+    accepted_extensions: Optional[List[str]] = None,
+    dirs2ignore: Optional[List[Path]] = None,
+    dirs2search: Optional[List[Path]] = None,
+    ignore_patterns: Optional[List[str]] = None,
+    stats: Optional[WalkStats] = None,
+    use_ignore_files: bool = False,
+) -> Iterator[Path]:
+    """
+    Apply the filters of walk_files to a list of files, e.g. from git_ls_files, without listing
+    any directory. The decision for a directory is made once for all the files it holds.
+    :param pdir: directory the paths are relative to
+    :param rel_paths: posix paths relative to pdir
+    :param use_ignore_files: honour the .gitignore and .ignore files of the directories holding
+        the files, as the walk does
+    :return:
+    """
+    if stats is None:
+        stats = WalkStats()
+    extensions = None if accepted_extensions is None else set(accepted_extensions)
+    ignore_dirs = _normalise_dirs(pdir, dirs2ignore) or set()
+    search_dirs = _normalise_dirs(pdir, dirs2search)
+    root_levels: List[IgnoreLevel] = []
+    if ignore_patterns:
+        root_levels.append(("", compile_ignore_patterns(ignore_patterns)))
+
+    dir_levels: Dict[str, List[IgnoreLevel]] = {}
+
+    def levels_of(rel_dir: str) -> List[IgnoreLevel]:
+        """ignore rules of the files of a directory"""
+        levels = dir_levels.get(rel_dir)
+        if levels is None:
+            levels = (
+                root_levels if rel_dir == "" else levels_of(rel_dir.rpartition("/")[0])
+            )
+            if use_ignore_files:
+                for ignore_file in IGNORE_FILES:
+                    spec = read_ignore_file(pdir / rel_dir / ignore_file)
+                    if spec is not None:
+                        levels = levels + [(rel_dir, spec)]
+            dir_levels[rel_dir] = levels
+        return levels
+
+    dir_ignored: Dict[str, bool] = {"": False}
+
+    def is_dir_ignored(rel_dir: str) -> bool:
+        ignored = dir_ignored.get(rel_dir)
+        if ignored is None:
+            parent, _, name = rel_dir.rpartition("/")
+            ignored = (
+                is_dir_ignored(parent)
+                or name in DEFAULT_DIRS2IGNORE
+                or os.path.normpath(pdir / rel_dir) in ignore_dirs
+                or is_ignored(rel_dir, levels_of(parent), True)
+            )
+            dir_ignored[rel_dir] = ignored
+            stats.dirs += 1
+        return ignored
+
+    for rel_path in rel_paths:
+        rel_dir, _, name = rel_path.rpartition("/")
+        if "." not in name:
+            continue  # only files
+        suffix = os.path.splitext(name)[1]
+        if (extensions is not None and suffix.lower() not in extensions) or (
+            search_dirs is not None
+            and os.path.normpath(pdir / rel_dir) not in search_dirs
+        ):
+            stats.filtered += 1
+            continue
+        if is_dir_ignored(rel_dir) or is_ignored(rel_path, levels_of(rel_dir), False):
+            stats.skipped += 1
+            continue
+        stats.files += 1
+        yield pdir / rel_path
+    logger.info(f"Filtered the files of {pdir}: {stats}")
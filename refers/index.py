@@ -0,0 +1,106 @@
+from pathlib import Path
+from typing import Any
+from typing import Callable
+from typing import IO
+from typing import Iterable
+from typing import Iterator
+from typing import Match
+from typing import Optional
+from typing import Union
+
+from refers.markers import DEFAULT_MARKERS
+from refers.markers import Markers
+from refers.refers import Config
+from refers.refers import get_tags
+from refers.refers import load_config
+from refers.refers import make_ref_replacer
+from refers.tags import Tag
+from refers.tags import Tags
+
+
+class TagIndex:
+    """
+    Tags of a project built once and shared by every document rendered in memory, e.g. by the pages
+    of a Sphinx or MkDocs build. The tags are read through the tag cache, so rebuilding the index of
+    an unchanged project only stats its files.
+
+    index = TagIndex.build("path/to/project")
+    html = index.render("see @ref:NAME:line")
+    """
+
+    def __init__(
+        self,
+        tags: Tags,
+        parent_dir: Path,
+        allow_not_found_tags: bool = False,
+        markers: Markers = DEFAULT_MARKERS,
+    ):
+        self.tags = tags
+        self.parent_dir = parent_dir
+        self.allow_not_found_tags = allow_not_found_tags
+        self.markers = markers
+        self._replace_ref: Callable[[Match[str]], str] = make_ref_replacer(
+            tags, parent_dir, allow_not_found_tags
+        )
+
+    @classmethod
+    def from_config(cls, config: Config) -> "TagIndex":
+        tags = get_tags(
+            config.rootdir,
+            config.accepted_tag_extensions,
+            config.dirs2search,
+            config.dirs2ignore,
+            config.tag_files,
+            config.ignore_patterns,
+            config.use_ignore_files,
+            config.engine,
+            config.jobs,
+            config.tag_cache(),
+            config.target_versions,
+            config.markers,
+            config.git_files,
+        )
+        return cls(tags, config.rootdir, config.allow_not_found_tags, config.markers)
+
+    @classmethod
+    def build(
+        cls, rootdir: Optional[Union[str, Path]] = None, **kwargs: Any
+    ) -> "TagIndex":
+        """
+        read the tags of a project
+        :param rootdir: root project folder, found from the working directory by default
+        :param kwargs: other inputs of load_config
+        :return:
+        """
+        return cls.from_config(load_config(rootdir, **kwargs))
+
+    def __contains__(self, tag_name: str) -> bool:
+        return self.tags.is_tag(tag_name) is not None
+
+    def __iter__(self) -> Iterator[Tag]:
+        return iter(self.tags)
+
+    def __len__(self) -> int:
+        return len(self.tags)
+
+    def get(self, tag_name: str) -> Optional[Tag]:
+        return self.tags.is_tag(tag_name)
+
+    def render(self, text: str) -> str:
+        """render the references of a document held in memory"""
+        if not self.markers.has_ref(text):
+            return text
+        return self.markers.ref_pattern.sub(self._replace_ref, text)
+
+    def render_lines(self, lines: Iterable[str]) -> Iterator[str]:
+        """render a document line by line. References never span lines"""
+        replace_ref = self._replace_ref
+        has_ref, ref_pattern = self.markers.has_ref, self.markers.ref_pattern
+        for line in lines:
+            if has_ref(line):
+                line = ref_pattern.sub(replace_ref, line)
+            yield line
+
+    def render_stream(self, rfile: IO[str], wfile: IO[str]):
+        """render a document from rfile to wfile holding one line in memory at a time"""
+        wfile.writelines(self.render_lines(rfile))
@@ -0,0 +1,137 @@
+# logical lines and scopes of python code from the stdlib tokenizer (no parse tree needed)
+import io
+import tokenize
+from typing import Any
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+COMPOUND_KEYWORDS = frozenset(
+    (
+        "async",
+        "class",
+        "def",
+        "elif",
+        "else",
+        "except",
+        "finally",
+        "for",
+        "if",
+        "try",
+        "while",
+        "with",
+        "match",
+        "case",
+    )
+)
+SCOPE_KEYWORDS = frozenset(("def", "class"))
+OPEN_BRACKETS = frozenset("([{")
+CLOSE_BRACKETS = frozenset(")]}")
+SKIP_TOKENS = frozenset(
+    (tokenize.NL, tokenize.INDENT, tokenize.DEDENT, tokenize.ENCODING)
+)
+
+# (line_num_start, line_num_end)
+LineRange = Tuple[int, int]
+# (kind ("def" or "class"), name, line_num_start, line_num_end)
+ScopeSpan = Tuple[str, str, int, int]
+
+
+class LogicalLines:
+    """
+    Split python source into logical lines the way refers.compromise_black.LineGenerator does:
+    a statement spanning several physical lines (brackets, backslashes, multi-line strings) is one
+    line, compound statement headers end at their colon, semicolons split statements and standalone
+    comments do not form lines. Function and class spans are collected in the same pass.
+    """
+
+    def __init__(self, src_contents: str):
+        self.lines: List[LineRange] = []
+        self.scopes: List[ScopeSpan] = []
+        self._tokenize(src_contents)
+
+    def _tokenize(self, src_contents: str):
+        start: Optional[int] = None  # first line of current logical line
+        end = 0  # last line of current logical line
+        first_name: Optional[str] = None  # first token of current logical line
+        depth = 0  # bracket depth
+        after_def = False  # previous token is the def/class keyword
+        header: Optional[List[Any]] = None  # [kind, name, start] of a def/class header
+        pending: Optional[List[Any]] = None  # def/class whose header ended with a colon
+        pending_body_inline = False
+        indent = 0
+        last_newline = 0
+        stack: List[Tuple[List[Any], int]] = (
+            []
+        )  # open def/class blocks and their indent
+
+        tokens = tokenize.generate_tokens(io.StringIO(src_contents).readline)
+        for tok in tokens:
+            tok_type = tok.type
+            if tok_type == tokenize.INDENT:
+                indent += 1
+                if pending is not None:
+                    stack.append((pending, indent))
+                    pending = None
+                continue
+            if tok_type == tokenize.DEDENT:
+                indent -= 1
+                while stack and stack[-1][1] > indent:
+                    scope, _ = stack.pop()
+                    self.scopes.append((scope[0], scope[1], scope[2], last_newline))
+                continue
+            if tok_type in SKIP_TOKENS:
+                continue
+            if tok_type == tokenize.ENDMARKER:
+                break
+            if tok_type == tokenize.COMMENT:
+                if start is not None:
+                    end = tok.end[0]
+                continue  # else standalone comment
+            if tok_type == tokenize.NEWLINE:
+                if start is not None:
+                    self.lines.append((start, end))
+                    start = None
+                last_newline = tok.start[0]
+                if pending is not None and pending_body_inline:  # def f(): return 1
+                    self.scopes.append(
+                        (pending[0], pending[1], pending[2], last_newline)
+                    )
+                    pending = None
+                continue
+
+            if pending is not None:
+                pending_body_inline = True
+            if start is None:
+                start, first_name = tok.start[0], tok.string
+            end = tok.end[0]
+            if after_def:
+                if header is not None and tok_type == tokenize.NAME:
+                    header[1] = tok.string
+                after_def = False
+            if (
+                tok_type == tokenize.NAME
+                and tok.string in SCOPE_KEYWORDS
+                and depth == 0
+            ):
+                if first_name in ("def", "class", "async"):
+                    header = [tok.string, "", start]
+                    after_def = True
+            elif tok_type == tokenize.OP:
+                if tok.string in OPEN_BRACKETS:
+                    depth += 1
+                elif tok.string in CLOSE_BRACKETS:
+                    depth = max(depth - 1, 0)
+                elif depth == 0 and (
+                    tok.string == ";"
+                    or (tok.string == ":" and first_name in COMPOUND_KEYWORDS)
+                ):
+                    self.lines.append((start, end))
+                    start = first_name = None
+                    if tok.string == ":" and header is not None:
+                        pending, header = header, None
+                        pending_body_inline = False
+
+        while stack:
+            scope, _ = stack.pop()
+            self.scopes.append((scope[0], scope[1], scope[2], last_newline))
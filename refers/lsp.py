@@ -0,0 +1,539 @@
+# Language server for @ref and @tag navigation, speaking the language server protocol on stdio
+import json
+import logging
+import re
+import sys
+import tokenize
+from pathlib import Path
+from typing import Any
+from typing import BinaryIO
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Match
+from typing import Optional
+from typing import Set
+from urllib.parse import unquote
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+from refers.definitions import DOC_OUT_ID
+from refers.errors import MultipleTagsInOneLine
+from refers.files import filter_files
+from refers.markers import trie_regex
+from refers.refers import collect_file_tags
+from refers.refers import Config
+from refers.refers import extract_tags
+from refers.refers import render_ref
+from refers.tags import Tag
+from refers.tags import VISIT_OPTIONS
+from refers.workspace import Workspace
+
+logger = logging.getLogger(__name__)
+
+# the engine for open documents: it needs no parse tree and takes the scopes from the buffer
+BUFFER_ENGINE = "tokenize"
+MAX_COMPLETION_ITEMS = 200
+COMPLETION_OPTIONS = sorted(
+    option for option in VISIT_OPTIONS if option != "unknown_tag"
+)
+
+# LSP constants
+TEXT_DOCUMENT_SYNC_INCREMENTAL = 2
+SEVERITY_ERROR = 1
+SEVERITY_WARNING = 2
+COMPLETION_KIND_PROPERTY = 10
+COMPLETION_KIND_REFERENCE = 18
+METHOD_NOT_FOUND = -32601
+REQUEST_FAILED = -32803
+
+
+def uri_to_path(uri: str) -> Path:
+    return Path(url2pathname(unquote(urlparse(uri).path)))
+
+
+def utf16_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def utf16_to_index(line: str, character: int) -> int:
+    """python string index of an LSP character offset (UTF-16 code units)"""
+    if line.isascii():
+        return min(character, len(line))
+    units = 0
+    for i, char in enumerate(line):
+        if units >= character:
+            return i
+        units += 2 if ord(char) > 0xFFFF else 1
+    return len(line)
+
+
+def read_message(rfile: BinaryIO) -> Optional[Dict[str, Any]]:
+    """read one Content-Length framed message, None at the end of the input"""
+    content_length = None
+    while True:
+        header = rfile.readline()
+        if header == b"":
+            return None
+        header = header.strip()
+        if header == b"":
+            break
+        name, _, value = header.decode("ascii").partition(":")
+        if name.lower() == "content-length":
+            content_length = int(value)
+    if content_length is None:
+        return None
+    message: Dict[str, Any] = json.loads(rfile.read(content_length))
+    return message
+
+
+def write_message(wfile: BinaryIO, message: Dict[str, Any]):
+    body = json.dumps(message).encode("utf-8")
+    wfile.write(b"Content-Length: %d\r\n\r\n" % len(body) + body)
+    wfile.flush()
+
+
+class Document:
+    """an open text document, kept as lines to apply incremental changes"""
+
+    __slots__ = ("uri", "path", "lines")
+
+    def __init__(self, uri: str, text: str):
+        self.uri = uri
+        self.path = uri_to_path(uri)
+        self.lines = text.splitlines(keepends=True)
+
+    @property
+    def text(self) -> str:
+        return "".join(self.lines)
+
+    def line(self, line_num: int) -> str:
+        """0-based line without its newline"""
+        if line_num >= len(self.lines):
+            return ""
+        return self.lines[line_num].rstrip("\r\n")
+
+    def apply_change(self, change: Dict[str, Any]):
+        if "range" not in change:
+            self.lines = change["text"].splitlines(keepends=True)
+            return
+        start, end = change["range"]["start"], change["range"]["end"]
+        while len(self.lines) <= end["line"]:
+            self.lines.append("")
+        first, last = self.lines[start["line"]], self.lines[end["line"]]
+        text = (
+            first[: utf16_to_index(first, start["character"])]
+            + change["text"]
+            + last[utf16_to_index(last, end["character"]) :]
+        )
+        self.lines[start["line"] : end["line"] + 1] = text.splitlines(keepends=True)
+
+
+class LanguageServer:
+    """
+    Definition, hover, completion and diagnostics for @ref:NAME:OPTION. The tags of the workspace
+    are read once at initialisation (through the tag cache). After that only single files are
+    re-indexed: an open document from its buffer on every change, and files changed on disk when
+    the client reports them. Lookups are dictionary lookups on the resident Tags index.
+    """
+
+    def __init__(self, config: Config, wfile: BinaryIO):
+        self.config = config
+        self.markers = config.markers
+        ref_markers = trie_regex(config.markers.ref_markers)
+        self._ref_name_prefix = re.compile(rf"{ref_markers}(\w*)$")
+        self._ref_option_prefix = re.compile(rf"{ref_markers}(\w+):(\w*)$")
+        self.workspace = Workspace(config, render=False)
+        self.documents: Dict[str, Document] = {}
+        self.wfile = wfile
+        self.running = True
+        self._tag_files: Set[Path] = set()
+        self.requests: Dict[str, Callable[[Dict[str, Any]], Any]] = {
+            "initialize": self.initialize,
+            "shutdown": self.shutdown,
+            "textDocument/definition": self.definition,
+            "textDocument/hover": self.hover,
+            "textDocument/completion": self.completion,
+        }
+        self.notifications: Dict[str, Callable[[Dict[str, Any]], None]] = {
+            "exit": self.exit,
+            "textDocument/didOpen": self.did_open,
+            "textDocument/didChange": self.did_change,
+            "textDocument/didClose": self.did_close,
+            "workspace/didChangeWatchedFiles": self.did_change_watched_files,
+        }
+
+    # index
+    def load(self):
+        tag_files = self.config.get_tag_files()
+        self._tag_files = set(tag_files)
+        for f, file_tags in zip(
+            tag_files,
+            collect_file_tags(
+                tag_files,
+                self.config.engine,
+                self.config.jobs,
+                self.workspace.tag_cache,
+                self.config.target_versions,
+                self.markers,
+            ),
+        ):
+            self.workspace.set_file_tags(f, file_tags)
+
+    def is_tag_file(self, f: Path) -> bool:
+        """
+        whether f is a tag file of the project: one the files searched by config.get_tag_files
+        would include, filtered by the same rules. The git index is not read, so an untracked file
+        counts when it is not ignored
+        """
+        if f in self._tag_files:
+            return True
+        if (
+            self.config.tag_files is not None
+            or f.stem.endswith(DOC_OUT_ID)
+            or not f.is_relative_to(self.config.rootdir)
+        ):
+            return False
+        rel_path = f.relative_to(self.config.rootdir).as_posix()
+        return any(
+            filter_files(
+                self.config.rootdir,
+                [rel_path],
+                self.config.accepted_tag_extensions,
+                self.config.dirs2ignore,
+                self.config.dirs2search,
+                self.config.ignore_patterns,
+                use_ignore_files=self.config.use_ignore_files or self.config.git_files,
+            )
+        )
+
+    def index_document(self, document: Document) -> Optional[str]:
+        """
+        re-index the tags of an open document from its buffer
+        :return: an error message if the buffer does not index, in which case its previous tags
+            are kept
+        """
+        if not self.is_tag_file(document.path):
+            return None
+        text = document.text.replace("\r\n", "\n")
+        try:
+            file_tags = extract_tags(
+                document.path,
+                text if self.markers.has_tag(text) else None,
+                BUFFER_ENGINE,
+                markers=self.markers,
+            )
+        except MultipleTagsInOneLine:
+            return "Multiple tags in one line"
+        except (SyntaxError, tokenize.TokenError):  # incomplete edit
+            return None
+        self._tag_files.add(document.path)
+        self.workspace.set_file_tags(document.path, file_tags)
+        return None
+
+    def index_file(self, f: Path):
+        """re-index a file from disk"""
+        if not f.is_file():
+            self._tag_files.discard(f)
+            self.workspace.set_file_tags(f, [])
+            return
+        if not self.is_tag_file(f):
+            return
+        try:
+            file_tags = collect_file_tags(
+                [f],
+                self.config.engine,
+                1,
+                self.workspace.tag_cache,
+                self.config.target_versions,
+                self.markers,
+            )[0]
+        except Exception as e:
+            logger.error(f"{f}: {type(e).__name__}: {e}")
+            return
+        self._tag_files.add(f)
+        self.workspace.set_file_tags(f, file_tags)
+
+    def _tag_names(self, f: Path) -> Set[str]:
+        return {tag.name for tag in self.workspace.file_tags.get(f, [])}
+
+    def _reindexed(self, f: Path, reindex: Callable[[], Optional[str]]):
+        """re-index f and publish the diagnostics of the open documents it affects"""
+        names = self._tag_names(f)
+        error = reindex()
+        changed_names = names ^ self._tag_names(f)
+        for document in list(self.documents.values()):
+            if document.path == f or changed_names:
+                self.publish_diagnostics(
+                    document, error if document.path == f else None
+                )
+
+    # diagnostics
+    def diagnostics(self, document: Document) -> List[Dict[str, Any]]:
+        tags = self.workspace.tags
+        diagnostics = []
+        not_found_severity = (
+            SEVERITY_WARNING if self.config.allow_not_found_tags else SEVERITY_ERROR
+        )
+        for line_num, line in enumerate(document.lines):
+            has_ref, has_tag = self.markers.has_ref(line), self.markers.has_tag(line)
+            if not has_ref and not has_tag:
+                continue
+            for m in self.markers.ref_pattern.finditer(line) if has_ref else ():
+                tag_name, option = m.group(1), m.group(2)
+                if tags.is_tag(tag_name) is None:
+                    diagnostics.append(
+                        self._diagnostic(
+                            line_num,
+                            line,
+                            m,
+                            not_found_severity,
+                            f"Tag {tag_name} not found",
+                        )
+                    )
+                elif option is not None and option[1:] not in VISIT_OPTIONS:
+                    diagnostics.append(
+                        self._diagnostic(
+                            line_num,
+                            line,
+                            m,
+                            SEVERITY_ERROR,
+                            f"Option {option} of tag {tag_name} not found",
+                        )
+                    )
+            for m in self.markers.tag_pattern.finditer(line) if has_tag else ():
+                duplicates = tags.duplicates.get(m.group(1))
+                if duplicates is not None:
+                    locations = ", ".join(
+                        f"{tag.file} L{tag.line_num}" for tag in duplicates
+                    )
+                    diagnostics.append(
+                        self._diagnostic(
+                            line_num,
+                            line,
+                            m,
+                            SEVERITY_ERROR,
+                            f"Tag {m.group(1)} is not unique. Found at: {locations}",
+                        )
+                    )
+        return diagnostics
+
+    @staticmethod
+    def _range(line_num: int, line: str, m: Match[str]) -> Dict[str, Any]:
+        return {
+            "start": {"line": line_num, "character": utf16_len(line[: m.start()])},
+            "end": {"line": line_num, "character": utf16_len(line[: m.end()])},
+        }
+
+    def _diagnostic(
+        self, line_num: int, line: str, m: Match[str], severity: int, message: str
+    ) -> Dict[str, Any]:
+        return {
+            "range": self._range(line_num, line, m),
+            "severity": severity,
+            "source": "refers",
+            "message": message,
+        }
+
+    def publish_diagnostics(self, document: Document, error: Optional[str] = None):
+        diagnostics = self.diagnostics(document)
+        if error is not None:
+            diagnostics.append(
+                {
+                    "range": {
+                        "start": {"line": 0, "character": 0},
+                        "end": {"line": 0, "character": 0},
+                    },
+                    "severity": SEVERITY_ERROR,
+                    "source": "refers",
+                    "message": error,
+                }
+            )
+        self.notify(
+            "textDocument/publishDiagnostics",
+            {"uri": document.uri, "diagnostics": diagnostics},
+        )
+
+    # requests
+    def initialize(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        self.load()
+        return {
+            "capabilities": {
+                "textDocumentSync": {
+                    "openClose": True,
+                    "change": TEXT_DOCUMENT_SYNC_INCREMENTAL,
+                },
+                "definitionProvider": True,
+                "hoverProvider": True,
+                "completionProvider": {"triggerCharacters": [":"]},
+            },
+            "serverInfo": {"name": "refers"},
+        }
+
+    def shutdown(self, params: Any) -> None:
+        return None
+
+    def _ref_at(self, params: Dict[str, Any]) -> Optional[Match[str]]:
+        document = self.documents.get(params["textDocument"]["uri"])
+        if document is None:
+            return None
+        line = document.line(params["position"]["line"])
+        index = utf16_to_index(line, params["position"]["character"])
+        for m in self.markers.ref_pattern.finditer(line):
+            if m.start() <= index <= m.end():
+                return m
+        return None
+
+    def _tag_at(self, params: Dict[str, Any]) -> Optional[Tag]:
+        m = self._ref_at(params)
+        return None if m is None else self.workspace.tags.is_tag(m.group(1))
+
+    def definition(self, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        tag = self._tag_at(params)
+        if tag is None:
+            return None
+        return {
+            "uri": Path(tag.file).as_uri(),
+            "range": {
+                "start": {"line": tag.line_num - 1, "character": 0},
+                "end": {"line": tag.line_num - 1, "character": 0},
+            },
+        }
+
+    def hover(self, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        m = self._ref_at(params)
+        if m is None:
+            return None
+        tag = self.workspace.tags.is_tag(m.group(1))
+        if tag is None:
+            return None
+        try:
+            rendered = render_ref(
+                self.workspace.tags,
+                self.config.rootdir,
+                self.config.allow_not_found_tags,
+                m.group(1),
+                m.group(2),
+            )
+        except Exception as e:
+            rendered = f"{type(e).__name__}: {e}"
+        return {
+            "contents": {
+                "kind": "markdown",
+                "value": f"```\n{tag.visit_quote()}\n```\n\n`{m.group(0)}` → {rendered}",
+            }
+        }
+
+    def completion(self, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        document = self.documents.get(params["textDocument"]["uri"])
+        if document is None:
+            return None
+        line = document.line(params["position"]["line"])
+        prefix = line[: utf16_to_index(line, params["position"]["character"])]
+        m = self._ref_option_prefix.search(prefix)
+        if m is not None:
+            return {
+                "isIncomplete": False,
+                "items": [
+                    {"label": option, "kind": COMPLETION_KIND_PROPERTY}
+                    for option in COMPLETION_OPTIONS
+                    if option.startswith(m.group(2))
+                ],
+            }
+        m = self._ref_name_prefix.search(prefix)
+        if m is None:
+            return None
+        items = []
+        for tag in self.workspace.tags:
+            if tag.name.startswith(m.group(1)):
+                items.append(
+                    {
+                        "label": tag.name,
+                        "kind": COMPLETION_KIND_REFERENCE,
+                        "detail": f"{tag.file} L{tag.line_num}",
+                    }
+                )
+                if len(items) == MAX_COMPLETION_ITEMS:
+                    return {"isIncomplete": True, "items": items}
+        return {"isIncomplete": False, "items": items}
+
+    # notifications
+    def exit(self, params: Any):
+        self.running = False
+
+    def did_open(self, params: Dict[str, Any]):
+        text_document = params["textDocument"]
+        document = Document(text_document["uri"], text_document["text"])
+        self.documents[document.uri] = document
+        self._reindexed(document.path, lambda: self.index_document(document))
+
+    def did_change(self, params: Dict[str, Any]):
+        document = self.documents.get(params["textDocument"]["uri"])
+        if document is None:
+            return
+        for change in params["contentChanges"]:
+            document.apply_change(change)
+        self._reindexed(document.path, lambda: self.index_document(document))
+
+    def did_close(self, params: Dict[str, Any]):
+        document = self.documents.pop(params["textDocument"]["uri"], None)
+        if document is None:
+            return
+        self._reindexed(document.path, lambda: self.index_file(document.path))
+        self.notify(
+            "textDocument/publishDiagnostics", {"uri": document.uri, "diagnostics": []}
+        )
+
+    def did_change_watched_files(self, params: Dict[str, Any]):
+        open_paths = {document.path for document in self.documents.values()}
+        for change in params["changes"]:
+            f = uri_to_path(change["uri"])
+            if f not in open_paths:  # the buffer of an open document takes precedence
+                self._reindexed(f, lambda: self.index_file(f))
+
+    # protocol
+    def notify(self, method: str, params: Any):
+        write_message(
+            self.wfile, {"jsonrpc": "2.0", "method": method, "params": params}
+        )
+
+    def handle(self, message: Dict[str, Any]):
+        method = message.get("method")
+        params: Any = message.get("params")
+        if "id" not in message:  # notification
+            handler = self.notifications.get(str(method))
+            if handler is not None:
+                try:
+                    handler(params)
+                except Exception:
+                    logger.exception(f"{method} failed")
+            return
+        response: Dict[str, Any] = {"jsonrpc": "2.0", "id": message["id"]}
+        request = self.requests.get(str(method))
+        if request is None:
+            response["error"] = {
+                "code": METHOD_NOT_FOUND,
+                "message": f"Method {method} not found",
+            }
+        else:
+            try:
+                response["result"] = request(params)
+            except Exception as e:
+                logger.exception(f"{method} failed")
+                response["error"] = {
+                    "code": REQUEST_FAILED,
+                    "message": f"{type(e).__name__}: {e}",
+                }
+        write_message(self.wfile, response)
+
+    def serve(self, rfile: BinaryIO):
+        while self.running:
+            message = read_message(rfile)
+            if message is None:
+                break
+            self.handle(message)
+
+
+def serve_lsp(config: Config):
+    """serve the language server protocol on stdin and stdout"""
+    LanguageServer(config, sys.stdout.buffer).serve(sys.stdin.buffer)
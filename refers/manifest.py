@@ -0,0 +1,161 @@
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+
+from refers.cache import ensure_cache_dir
+from refers.cache import FileEntry
+from refers.cache import tag_rows
+from refers.cache import tags_from_rows
+from refers.files import atomic_write_text
+from refers.tags import Tag
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 3  # bump when the layout of the manifest changes
+MANIFEST_FILE_NAME = "manifest.json"
+
+
+class Manifest:
+    """
+    Persisted list of the tag and reference files of a project with the tags of each tag file, as
+    of the last run. Together with the dependency graph it lets a run that is told which files
+    changed, e.g. by git, read and render only those and the documents referencing their tags.
+    The manifest is only valid for the settings that decided which files were searched. It also
+    holds the stat and content hash of each file and the git HEAD when it was saved, so that files
+    changed since, by a commit, a checkout or an edit that was reverted, are found even when the
+    changes reported for a run leave them out.
+    """
+
+    def __init__(self, cache_dir: Path, settings: Dict[str, Any]):
+        self.cache_dir = cache_dir
+        self.settings = settings
+        self.loaded = False
+        self._tag_files: Dict[str, List[List[Any]]] = {}  # path -> tag rows
+        self._ref_files: Set[str] = set()
+        self._stats: Dict[str, List[Any]] = {}  # path -> [mtime_ns, size, digest]
+        self.head: Optional[str] = None
+        self._changed = False
+        self._load()
+
+    @property
+    def manifest_file(self) -> Path:
+        return self.cache_dir / MANIFEST_FILE_NAME
+
+    def _load(self):
+        try:
+            with open(self.manifest_file, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if (
+            not isinstance(data, dict)
+            or data.get("version") != MANIFEST_VERSION
+            or data.get("settings") != self.settings
+        ):
+            logger.info(f"Discarding outdated manifest {self.manifest_file}")
+            return
+        self._tag_files = data["tag_files"]
+        self._ref_files = set(data["ref_files"])
+        self._stats = data["stats"]
+        self.head = data["head"]
+        self.loaded = True
+
+    def file_tags(self) -> Dict[Path, List[Tag]]:
+        """tags of every tag file that has any"""
+        file_tags = {}
+        for f, rows in self._tag_files.items():
+            if len(rows) > 0:
+                path = Path(f)
+                file_tags[path] = tags_from_rows(path, rows)
+        return file_tags
+
+    def has_ref_files(self) -> bool:
+        return len(self._ref_files) > 0
+
+    def is_ref_file(self, f: Path) -> bool:
+        return str(f) in self._ref_files
+
+    def stale_files(self) -> List[Path]:
+        """files of the manifest whose stat differs from the recorded one, including deleted files"""
+        stale = []
+        for f, (mtime_ns, size, _) in self._stats.items():
+            try:
+                st = os.stat(f)
+            except OSError:
+                stale.append(Path(f))
+                continue
+            if st.st_mtime_ns != mtime_ns or st.st_size != size:
+                stale.append(Path(f))
+        return stale
+
+    def reset(
+        self,
+        tag_entries: Dict[Path, FileEntry],
+        ref_entries: Dict[Path, FileEntry],
+        head: Optional[str],
+    ):
+        """record every file of a full run and the git HEAD it was run at"""
+        self._tag_files = {}
+        self._ref_files = set()
+        self._stats = {}
+        for f, file_entry in tag_entries.items():
+            self.set_tags(f, file_entry)
+        for f, file_entry in ref_entries.items():
+            self.set_ref_file(f, file_entry)
+        self.set_head(head)
+        self._changed = True
+
+    def set_head(self, head: Optional[str]):
+        if head != self.head:
+            self.head = head
+            self._changed = True
+
+    def set_tags(self, f: Path, file_entry: Optional[FileEntry]):
+        """record the tags of a tag file, None if it was deleted"""
+        if file_entry is None:
+            self._changed |= self._tag_files.pop(str(f), None) is not None
+            self._changed |= self._stats.pop(str(f), None) is not None
+        else:
+            self._tag_files[str(f)] = tag_rows(file_entry.tags)
+            self._set_stat(f, file_entry)
+
+    def set_ref_file(self, f: Path, file_entry: Optional[FileEntry]):
+        """record a reference file, None if it was deleted"""
+        if file_entry is not None:
+            self._ref_files.add(str(f))
+            self._set_stat(f, file_entry)
+        elif str(f) in self._ref_files:
+            self._ref_files.remove(str(f))
+            self._stats.pop(str(f), None)
+            self._changed = True
+
+    def _set_stat(self, f: Path, file_entry: FileEntry):
+        self._stats[str(f)] = [file_entry.mtime_ns, file_entry.size, file_entry.digest]
+        self._changed = True
+
+    def save(self):
+        """write the manifest atomically"""
+        if not self._changed:
+            return
+        ensure_cache_dir(self.cache_dir)
+        atomic_write_text(
+            self.manifest_file,
+            json.dumps(
+                {
+                    "version": MANIFEST_VERSION,
+                    "settings": self.settings,
+                    "tag_files": self._tag_files,
+                    "ref_files": sorted(self._ref_files),
+                    "stats": self._stats,
+                    "head": self.head,
+                }
+            ),
+        )
+        self._changed = False
+        self.loaded = True
@@ -0,0 +1,126 @@
+import re
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import Union
+
+from refers.definitions import REF_COMMENT_ID
+from refers.definitions import TAG_COMMENT_ID
+from refers.files import Buffer
+
+Trie = Dict[str, "Trie"]  # character -> subtrie, "" marks the end of a marker
+
+
+def trie_regex(markers: Iterable[str]) -> str:
+    """
+    Regex matching any of markers, with the alternation factored into a trie:
+    ["@tag:", "@ref:"] gives "@(?:ref:|tag:)", so that each character is matched once
+    """
+    trie: Trie = {}
+    for marker in markers:
+        node = trie
+        for char in marker:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def to_regex(node: Trie) -> str:
+        end = "" in node
+        alternatives = [
+            re.escape(char) + to_regex(child)
+            for char, child in sorted(node.items())
+            if char != ""
+        ]
+        if len(alternatives) == 0:
+            return ""
+        if len(alternatives) == 1 and not end:
+            return alternatives[0]
+        regex = "(?:" + "|".join(alternatives) + ")"
+        return regex + "?" if end else regex
+
+    return to_regex(trie)
+
+
+def compile_scan_patterns(markers: Sequence[str]) -> List["re.Pattern[bytes]"]:
+    """
+    One bytes trie pattern per leading character of markers. re searches a pattern quickly from
+    its literal prefix, which an alternation of markers starting with different characters does not
+    have: a few fast passes then beat one slow pass
+    """
+    groups: Dict[str, List[str]] = {}
+    for marker in markers:
+        groups.setdefault(marker[0], []).append(marker)
+    return [re.compile(trie_regex(group).encode()) for group in groups.values()]
+
+
+class Markers:
+    """
+    Markers of tags and references: @tag: and @ref: plus the aliases configured in [tool.refers].
+    scan locates every marker of a buffer in one pass of a compiled trie pattern per leading
+    character of the markers (a single pass for the default ones).
+    """
+
+    def __init__(
+        self, tag_aliases: Sequence[str] = (), ref_aliases: Sequence[str] = ()
+    ):
+        self.tag_markers = (TAG_COMMENT_ID, *tag_aliases)
+        self.ref_markers = (REF_COMMENT_ID, *ref_aliases)
+        both = set(self.tag_markers) & set(self.ref_markers)
+        if len(both) > 0 or "" in self.tag_markers + self.ref_markers:
+            raise ValueError(
+                f"Markers must be distinct and not empty: {sorted(both) or ['']}"
+            )
+        self.tag_pattern = re.compile(rf"{trie_regex(self.tag_markers)}(\w+)")
+        self.ref_pattern = re.compile(rf"{trie_regex(self.ref_markers)}(\w+)(:\w+)?")
+        self.tag_patterns_bytes = compile_scan_patterns(self.tag_markers)
+        self.patterns_bytes = compile_scan_patterns(self.tag_markers + self.ref_markers)
+        self._ref_markers_bytes = {m.encode() for m in self.ref_markers}
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, Markers) and self.key() == other.key()
+
+    def __repr__(self):
+        return f"Markers({self.tag_markers}, {self.ref_markers})"
+
+    def key(self) -> List[List[str]]:
+        """markers, to check that a cache was built with the same ones"""
+        return [list(self.tag_markers), list(self.ref_markers)]
+
+    def scan(self, buf: Buffer) -> Tuple[List[int], List[int]]:
+        """offsets of the tag markers and of the reference markers of raw contents"""
+        tag_offsets: List[int] = []
+        ref_offsets: List[int] = []
+        ref_markers = self._ref_markers_bytes
+        for pattern in self.patterns_bytes:
+            for m in pattern.finditer(buf):
+                if m.group() in ref_markers:
+                    ref_offsets.append(m.start())
+                else:
+                    tag_offsets.append(m.start())
+        if len(self.patterns_bytes) > 1:
+            tag_offsets.sort()
+            ref_offsets.sort()
+        return tag_offsets, ref_offsets
+
+    def has_tag(self, text: Union[str, Buffer]) -> bool:
+        """whether decoded or raw contents hold a tag marker"""
+        if isinstance(text, str):
+            return any(marker in text for marker in self.tag_markers)
+        return any(p.search(text) is not None for p in self.tag_patterns_bytes)
+
+    def has_ref(self, text: str) -> bool:
+        """whether text holds a reference marker"""
+        return any(marker in text for marker in self.ref_markers)
+
+
+DEFAULT_MARKERS = Markers()
+
+
+def markers_from_aliases(
+    tag_aliases: Optional[Sequence[str]], ref_aliases: Optional[Sequence[str]]
+) -> Markers:
+    if not tag_aliases and not ref_aliases:
+        return DEFAULT_MARKERS
+    return Markers(tag_aliases or (), ref_aliases or ())
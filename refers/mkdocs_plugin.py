@@ -0,0 +1,37 @@
+# MkDocs plugin rendering the references of every page's markdown, with no _refers files.
+#
+# mkdocs.yml:
+#     plugins:
+#       - refers:
+#           rootdir: null  # project root, found from mkdocs.yml upwards by default
+#           allow_not_found_tags: false
+from pathlib import Path
+from typing import Any
+from typing import Optional
+
+from mkdocs.config import config_options
+from mkdocs.plugins import BasePlugin
+
+from refers.index import TagIndex
+from refers.refers import find_rootdir
+
+
+class RefersPlugin(BasePlugin):  # type: ignore[type-arg]
+    config_scheme = (
+        ("rootdir", config_options.Type(str, default="")),
+        ("allow_not_found_tags", config_options.Type(bool, default=False)),
+    )
+
+    index: Optional[TagIndex] = None
+
+    def on_pre_build(self, config: Any):
+        rootdir = self.config["rootdir"] or find_rootdir(
+            Path(config["config_file_path"]).parent
+        )
+        self.index = TagIndex.build(
+            rootdir, allow_not_found_tags=self.config["allow_not_found_tags"]
+        )
+
+    def on_page_markdown(self, markdown: str, page: Any, config: Any, files: Any):
+        assert self.index is not None
+        return self.index.render(markdown)
@@ -1,35 +1,69 @@
+import io
+import logging
+import os
 import re
+from functools import partial
 from pathlib import Path
+from typing import Any
+from typing import Callable
+from typing import cast
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
 from typing import List
+from typing import Match
 from typing import Optional
+from typing import Set
+from typing import Tuple
 from typing import TypeVar
 from typing import Union
 
-import black
-import toml
-from black import nodes
-from black.parsing import lib2to3_parse
-from blib2to3.pytree import Leaf
-from blib2to3.pytree import Node
-
-from refers.compromise_black import LineGenerator
-from refers.definitions import CODE_RE_TAG
+from refers.cache import content_hash
+from refers.cache import default_cache_dir
+from refers.cache import DEFAULT_CACHE_MAX_SIZE
+from refers.cache import FileEntry
+from refers.cache import tag_rows
+from refers.cache import TagCache
+from refers.cache import tags_from_rows
 from refers.definitions import DOC_OUT_ID
 from refers.definitions import DOC_RE_TAG
+from refers.definitions import LATEST_PYTHON_MINOR
 from refers.definitions import LIBRARY_NAME
+from refers.deps import DependencyGraph
 from refers.errors import MultipleTagsInOneLine
 from refers.errors import OptionNotFoundError
 from refers.errors import PyprojectNotFound
 from refers.errors import TagNotFoundError
+from refers.files import atomic_write_text
+from refers.files import Buffer
+from refers.files import CatFile
+from refers.files import count_newlines
+from refers.files import filter_files
+from refers.files import git_changed_files
+from refers.files import git_head
+from refers.files import git_ls_files
+from refers.files import git_ls_tree
+from refers.files import read_buffer
+from refers.files import walk_files
+from refers.files import WalkStats
+from refers.logical_lines import LogicalLines
+from refers.manifest import Manifest
+from refers.markers import DEFAULT_MARKERS
+from refers.markers import Markers
+from refers.markers import markers_from_aliases
+from refers.scopes import ScopeIndex
 from refers.tags import Tag
 from refers.tags import Tags
+from refers.tags import VISIT_OPTIONS
 
 # types
 T = TypeVar("T")
 Index = int
-LeafID = int
 
-LN = Union[Leaf, Node]
+DOC_PATTERN = re.compile(DOC_RE_TAG)
+LONE_CR_PATTERN_BYTES = re.compile(rb"\r(?!\n)")  # old Mac line ending
+
+logger = logging.getLogger(__name__)
 
 
 def get_files(
@@ -37,20 +71,391 @@ def get_files(
     accepted_extensions: Optional[List[str]] = None,
     dirs2ignore: Optional[List[Path]] = None,
     dirs2search: Optional[List[Path]] = None,
+    ignore_patterns: Optional[List[str]] = None,
+    use_ignore_files: bool = True,
+    stats: Optional[WalkStats] = None,
+    git_files: bool = False,
 ):
-    if dirs2ignore is None:
-        dirs2ignore = []
-    for f in pdir.rglob(r"*.*"):  # only files
-        if (
-            f.parent in dirs2ignore
-            or (dirs2search is not None and f.parent not in dirs2search)
-            or (
-                accepted_extensions is not None
-                and f.suffix.lower() not in accepted_extensions
-            )
-        ):
+    """
+    files to search under pdir. See walk_files for the filters
+    :param git_files: list the files of the git index rather than walking the tree. Untracked files
+        are then left out whatever the ignore files say. Outside a git repository the tree is walked
+    """
+    rel_paths = git_ls_files(pdir) if git_files else None
+    if rel_paths is None:
+        files = walk_files(
+            pdir,
+            accepted_extensions,
+            dirs2ignore,
+            dirs2search,
+            ignore_patterns,
+            use_ignore_files,
+            stats,
+        )
+    else:
+        files = filter_files(
+            pdir,
+            rel_paths,
+            accepted_extensions,
+            dirs2ignore,
+            dirs2search,
+            ignore_patterns,
+            stats,
+        )
+    for f in files:
+        if not f.stem.endswith(DOC_OUT_ID):  # outputs of previous runs
+            yield f
+
+
+def default_encoding() -> str:
+    """encoding open(f) uses in text mode"""
+    return io.TextIOWrapper(io.BytesIO()).encoding
+
+
+def decode_text(src_bytes: Buffer) -> str:
+    """decode like open(f) in text mode: default encoding and universal newlines"""
+    return io.TextIOWrapper(io.BytesIO(src_bytes)).read()
+
+
+def decode_source(
+    src_bytes: Buffer, markers: Markers = DEFAULT_MARKERS
+) -> Optional[str]:
+    """
+    Decode file contents only if they contain a tag. The marker search on the raw bytes lets
+    files without tags skip decoding and parsing altogether.
+    :param src_bytes: raw file contents
+    :param markers: tag markers
+    :return: file contents, or None if the file contains no tag
+    """
+    if not markers.has_tag(src_bytes):
+        return None
+    return decode_text(src_bytes)
+
+
+def marker_lines(buf: Buffer, offsets: List[int]) -> Iterator[Tuple[int, int, int]]:
+    """
+    line number, start and end offsets of each line holding one of offsets, in order. Newlines are
+    only counted between the lines
+    """
+    line_num = 1
+    counted = 0  # newlines are counted up to this offset
+    line_end = -1
+    for offset in offsets:
+        if offset <= line_end:  # line already yielded
+            continue
+        line_start = buf.rfind(b"\n", 0, offset) + 1
+        line_end = buf.find(b"\n", offset)
+        if line_end == -1:
+            line_end = len(buf)
+        line_num += count_newlines(buf, counted, line_start)
+        counted = line_start
+        yield line_num, line_start, line_end
+
+
+def find_ref_lines(src_contents: str, markers: Markers = DEFAULT_MARKERS) -> List[int]:
+    """numbers of the lines holding a reference marker"""
+    return [
+        i + 1
+        for i, line in enumerate(io.StringIO(src_contents))
+        if markers.has_ref(line)
+    ]
+
+
+def read_source(f: Path, markers: Markers = DEFAULT_MARKERS) -> Optional[str]:
+    """read a file and decode it only if it contains a tag"""
+    with read_buffer(f) as buf:
+        return decode_source(buf, markers)
+
+
+def get_text_tags(
+    f: Path, src_contents: str, markers: Markers = DEFAULT_MARKERS
+) -> List[Tag]:
+    """get tags of a file without line continuation: one tag per line"""
+    file_tags = []
+    for i, full_line in enumerate(io.StringIO(src_contents)):
+        full_line = full_line.strip()
+        line_num = i + 1
+        tag_names = markers.tag_pattern.findall(full_line)
+        if len(tag_names) == 0:
+            continue
+        elif len(tag_names) > 1:
+            raise MultipleTagsInOneLine
+        tag_name = tag_names[0]
+        tag = Tag(
+            tag_name,
+            line_num,
+            full_line,
+            f,
+            line_num,
+            line_num,
+            full_line,
+        )
+        file_tags.append(tag)
+    return file_tags
+
+
+def scan_text_tags(
+    f: Path,
+    buf: Buffer,
+    markers: Markers = DEFAULT_MARKERS,
+    tag_offsets: Optional[List[int]] = None,
+) -> List[Tag]:
+    """
+    get tags of a file without line continuation from its raw contents, as get_text_tags does
+    from the decoded ones. Only the lines holding a tag marker are decoded
+    :param tag_offsets: offsets of the tag markers in buf, from Markers.scan
+    :return:
+    """
+    if tag_offsets is None:
+        tag_offsets = markers.scan(buf)[0]
+    if len(tag_offsets) == 0:
+        return []
+    if LONE_CR_PATTERN_BYTES.search(buf) is not None:
+        return get_text_tags(f, decode_text(buf), markers)
+    encoding = default_encoding()
+    file_tags: List[Tag] = []
+    for line_num, line_start, line_end in marker_lines(buf, tag_offsets):
+        full_line = buf[line_start:line_end].decode(encoding).strip()
+        tag_names = markers.tag_pattern.findall(full_line)
+        if len(tag_names) == 0:
             continue
-        yield f
+        elif len(tag_names) > 1:
+            raise MultipleTagsInOneLine
+        tag = Tag(
+            tag_names[0],
+            line_num,
+            full_line,
+            f,
+            line_num,
+            line_num,
+            full_line,
+        )
+        file_tags.append(tag)
+    return file_tags
+
+
+def get_python_tags(
+    f: Path,
+    src_contents: str,
+    target_versions: Optional[List[str]] = None,
+    markers: Markers = DEFAULT_MARKERS,
+) -> List[Tag]:
+    """
+    get tags of a python file: the full line of a tag is the whole (multi-line) statement. black is
+    imported on the first python file that contains a tag
+    :param target_versions: python versions the file targets, e.g. ["py38", "py39"]. Only the
+        grammars of these versions are tried
+    """
+    from refers.black_engine import get_python_tags as get_python_tags_black
+
+    return get_python_tags_black(f, src_contents, target_versions, markers)
+
+
+def get_python_tags_tokenize(
+    f: Path,
+    src_contents: str,
+    target_versions: Optional[List[str]] = None,
+    markers: Markers = DEFAULT_MARKERS,
+) -> List[Tag]:
+    """
+    get tags of a python file using the stdlib tokenizer instead of a black parse. As with black,
+    a physical line that is part of several logical lines is assigned to the first one. The
+    tokenizer reads every version, target_versions is ignored
+    """
+    file_tags = []
+    src_lines = io.StringIO(src_contents).readlines()
+    logical_lines = LogicalLines(src_contents)
+    scopes = ScopeIndex(logical_lines.scopes)
+    line_num_scanned = 0
+    for line_num_start, line_num_end in logical_lines.lines:
+        full_line = None
+        for line_num in range(
+            max(line_num_start, line_num_scanned + 1), line_num_end + 1
+        ):
+            src_line = src_lines[line_num - 1]
+            if not markers.has_tag(src_line):
+                continue
+            src_line = re.sub(r"\s*(.*)\n$", r"\1", src_line)  # strip newline
+            tag_names = markers.tag_pattern.findall(src_line)
+            if len(tag_names) == 0:
+                continue
+            elif len(tag_names) > 1:
+                raise MultipleTagsInOneLine
+            if full_line is None:
+                full_line = "".join(src_lines[line_num_start - 1 : line_num_end])
+                full_line = re.sub(r"^\s*(.*)\n$", r"\1", full_line, flags=re.DOTALL)
+            tag = Tag(
+                tag_names[0],
+                line_num,
+                src_line,
+                f,
+                line_num_start,
+                line_num_end,
+                full_line,
+                scopes.func_name(line_num_start),
+                scopes.class_name(line_num_start),
+            )
+            file_tags.append(tag)
+        line_num_scanned = max(line_num_scanned, line_num_end)
+    return file_tags
+
+
+PYTHON_ENGINES = {
+    "black": get_python_tags,
+    "tokenize": get_python_tags_tokenize,
+}
+
+
+def get_file_tags(
+    f: Path,
+    engine: str = "black",
+    target_versions: Optional[List[str]] = None,
+    markers: Markers = DEFAULT_MARKERS,
+) -> List[Tag]:
+    """
+    get tags of one file. Files without a tag are not parsed
+    :param f: file
+    :param engine: python logical line engine: "black" or "tokenize"
+    :param target_versions: python versions of the project, e.g. ["py38", "py39"]
+    :param markers: tag markers
+    :return:
+    """
+    if f.suffix == ".py":
+        return extract_tags(
+            f, read_source(f, markers), engine, target_versions, markers
+        )
+    with read_buffer(f) as buf:
+        return scan_text_tags(f, buf, markers)
+
+
+def extract_tags(
+    f: Path,
+    src_contents: Optional[str],
+    engine: str = "black",
+    target_versions: Optional[List[str]] = None,
+    markers: Markers = DEFAULT_MARKERS,
+) -> List[Tag]:
+    """get tags of file contents returned by decode_source"""
+    if src_contents is None:
+        return []
+    if f.suffix == ".py":
+        return PYTHON_ENGINES[engine](f, src_contents, target_versions, markers)
+    return get_text_tags(f, src_contents, markers)
+
+
+def read_file_entry(
+    f: Path,
+    engine: str = "black",
+    target_versions: Optional[List[str]] = None,
+    grammars: Optional[Dict[Path, str]] = None,
+    keep_text: bool = False,
+    markers: Markers = DEFAULT_MARKERS,
+) -> FileEntry:
+    """
+    get tags and reference lines of one file along with the stat and content hash the tag cache is
+    keyed by, all from a single read of the file. Tag and reference markers are located in one pass
+    :param grammars: grammar that parsed each python file last time, tried first by black
+    :param keep_text: keep the decoded contents of a file with references, for rendering
+    :param markers: tag and reference markers
+    :return:
+    """
+    st = os.stat(f)
+    with read_buffer(f) as buf:
+        return buffer_entry(
+            f,
+            buf,
+            st.st_mtime_ns,
+            engine,
+            target_versions,
+            (grammars or {}).get(f),
+            keep_text,
+            markers,
+        )
+
+
+def buffer_entry(
+    f: Path,
+    buf: Buffer,
+    mtime_ns: int = 0,
+    engine: str = "black",
+    target_versions: Optional[List[str]] = None,
+    grammar: Optional[str] = None,
+    keep_text: bool = False,
+    markers: Markers = DEFAULT_MARKERS,
+) -> FileEntry:
+    """
+    get tags and reference lines of the contents of file f held in memory, see read_file_entry
+    :param mtime_ns: modification time of f, recorded in the entry
+    :param grammar: grammar that parsed f last time, tried first by black
+    :return:
+    """
+    digest = content_hash(buf)
+    tag_offsets, ref_offsets = markers.scan(buf)
+    text = None
+    ref_lines: List[int] = []
+    if len(ref_offsets) > 0:
+        text = decode_text(buf)
+        if LONE_CR_PATTERN_BYTES.search(buf) is None:
+            ref_lines = [line[0] for line in marker_lines(buf, ref_offsets)]
+        else:
+            ref_lines = find_ref_lines(text, markers)
+    parsed_by = None
+    if f.suffix != ".py":
+        file_tags = scan_text_tags(f, buf, markers, tag_offsets)
+    elif len(tag_offsets) == 0:
+        file_tags = []
+    else:
+        src_contents = decode_text(buf) if text is None else text
+        if engine == "black":
+            from refers.black_engine import parse_python_tags
+
+            file_tags, parsed_by = parse_python_tags(
+                f, src_contents, target_versions, grammar, markers
+            )
+        else:
+            file_tags = extract_tags(f, src_contents, engine, target_versions, markers)
+    return FileEntry(
+        mtime_ns,
+        len(buf),
+        digest,
+        file_tags,
+        parsed_by,
+        ref_lines,
+        text if keep_text else None,
+    )
+
+
+def map_files(
+    func: Callable[[Path], T], files: Iterable[Path], jobs: int = 1
+) -> Iterator[T]:
+    """
+    Apply func to every file, in worker processes if jobs is not 1. Results are yielded in the
+    order of files regardless of which worker finishes first.
+    """
+    if jobs <= 0:
+        jobs = os.cpu_count() or 1
+    if jobs == 1:
+        yield from map(func, files)
+        return
+    files = list(files)
+    if len(files) < 2:
+        yield from map(func, files)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+
+    jobs = min(jobs, len(files))
+    chunksize = max(1, len(files) // (jobs * 4))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(func, files, chunksize=chunksize)
+
+
+def own_tags(f: Path, file_tags: List[Tag]) -> List[Tag]:
+    """
+    tags of file f, holding f itself: tags returned by a worker process hold a copy of their file
+    """
+    if all(tag.file is f for tag in file_tags):
+        return file_tags
+    return tags_from_rows(f, tag_rows(file_tags))
 
 
 def get_tags(
@@ -59,78 +464,308 @@ def get_tags(
     dirs2search: Optional[List[Path]] = None,
     dirs2ignore: Optional[List[Path]] = None,
     tag_files: Optional[List[Path]] = None,
+    ignore_patterns: Optional[List[str]] = None,
+    use_ignore_files: bool = True,
+    engine: str = "black",
+    jobs: int = 1,
+    cache: Optional[TagCache] = None,
+    target_versions: Optional[List[str]] = None,
+    markers: Markers = DEFAULT_MARKERS,
+    git_files: bool = False,
 ) -> Tags:
+    """
+    get tags of all tag files
+    :param jobs: number of worker processes extracting tags. 0 or less uses all CPUs
+    :param cache: reuse the tags of unchanged files from this cache and store the others in it
+    :param target_versions: python versions of the project, e.g. ["py38", "py39"]
+    :param markers: tag markers
+    :param git_files: see get_files
+    :return:
+    """
+    if engine not in PYTHON_ENGINES:
+        raise ValueError(
+            f"Unknown engine {engine}. Possible engines: {list(PYTHON_ENGINES)}"
+        )
     files = (
-        get_files(pdir, accepted_tag_extensions, dirs2ignore, dirs2search)
+        get_files(
+            pdir,
+            accepted_tag_extensions,
+            dirs2ignore,
+            dirs2search,
+            ignore_patterns,
+            use_ignore_files,
+            git_files=git_files,
+        )
         if tag_files is None
         else iter(tag_files)
     )
-    mode = black.Mode()
-    tags = Tags()
-    for f in files:
-        with open(f) as fread:
-            if not f.suffix == ".py":
-                for i, full_line in enumerate(fread):
-                    full_line = full_line.strip()
-                    line_num = i + 1
-                    tag_names = re.findall(CODE_RE_TAG, full_line)
-                    if len(tag_names) == 0:
-                        continue
-                    elif len(tag_names) > 1:
-                        raise MultipleTagsInOneLine
-                    tag_name = tag_names[0]
-                    tag = Tag(
-                        tag_name,
-                        line_num,
-                        full_line,
-                        f,
-                        line_num,
-                        line_num,
-                        full_line,
-                        Node(256, []),
-                    )
-                    tags.add_tag(tag)
-            else:
-                src_lines = fread.readlines()
-                fread.seek(0)
-                src_contents = fread.read()
-                src_node = lib2to3_parse(src_contents.lstrip(), mode.target_versions)
-                lines = LineGenerator(mode=mode)
-                for current_line in lines.visit(src_node):
-                    # standalone comments hold no information in Leaf and is therefore not supported
-                    if current_line.leaves[0].type == nodes.STANDALONE_COMMENT:
-                        continue
-
-                    line_num_start = current_line.leaves[0].get_lineno()
-                    line_num_end = current_line.leaves[-1].get_lineno()
-                    full_line = "".join(src_lines[line_num_start - 1 : line_num_end])
-                    full_line = re.sub(
-                        r"^\s*(.*)\n$", r"\1", full_line, flags=re.DOTALL
-                    )
+    return build_tags(
+        collect_file_tags(files, engine, jobs, cache, target_versions, markers)
+    )
+
+
+def collect_file_tags(
+    files: Iterable[Path],
+    engine: str = "black",
+    jobs: int = 1,
+    cache: Optional[TagCache] = None,
+    target_versions: Optional[List[str]] = None,
+    markers: Markers = DEFAULT_MARKERS,
+) -> List[List[Tag]]:
+    """
+    get the tags of each file, in the order of files
+    :param jobs: number of worker processes extracting tags. 0 or less uses all CPUs
+    :param cache: reuse the tags of unchanged files from this cache and store the others in it.
+        Changed python files are parsed with the grammar that parsed them last time first
+    :param target_versions: python versions of the project, e.g. ["py38", "py39"]
+    :return:
+    """
+    if cache is None:
+        files = list(files)
+        return [
+            own_tags(f, file_tags)
+            for f, file_tags in zip(
+                files,
+                map_files(
+                    partial(
+                        get_file_tags,
+                        engine=engine,
+                        target_versions=target_versions,
+                        markers=markers,
+                    ),
+                    files,
+                    jobs,
+                ),
+            )
+        ]
+    return [
+        file_entry.tags
+        for file_entry in collect_file_entries(
+            files, engine, jobs, cache, target_versions, markers=markers
+        )
+    ]
 
-                    for line_num in range(line_num_start, line_num_end + 1):
-                        src_line = re.sub(
-                            r"\s*(.*)\n$", r"\1", src_lines[line_num - 1]
-                        )  # strip newline
-                        tag_names = re.findall(CODE_RE_TAG, src_line)
-                        if len(tag_names) == 0:
-                            continue
-                        elif len(tag_names) > 1:
-                            raise MultipleTagsInOneLine
-                        tag = Tag(
-                            tag_names[0],
-                            line_num,
-                            src_line,
-                            f,
-                            line_num_start,
-                            line_num_end,
-                            full_line,
-                            current_line.leaves[0].parent,
-                        )
-                        tags.add_tag(tag)
+
+def collect_file_entries(
+    files: Iterable[Path],
+    engine: str = "black",
+    jobs: int = 1,
+    cache: Optional[TagCache] = None,
+    target_versions: Optional[List[str]] = None,
+    keep_text: bool = False,
+    markers: Markers = DEFAULT_MARKERS,
+) -> List[FileEntry]:
+    """
+    read the entry of each file (tags and reference lines), in the order of files
+    :param cache: reuse the entries of unchanged files from this cache and store the others in it
+    :param keep_text: keep the contents of files with references that are read, for rendering.
+        Entries from the cache have no text
+    :return:
+    """
+    files = list(files)
+    file_entries: List[Optional[FileEntry]] = (
+        [None] * len(files) if cache is None else [cache.get_entry(f) for f in files]
+    )
+    changed = [i for i, file_entry in enumerate(file_entries) if file_entry is None]
+    grammars = {} if cache is None else cache.grammars(files[i] for i in changed)
+    read_entries = map_files(
+        partial(
+            read_file_entry,
+            engine=engine,
+            target_versions=target_versions,
+            grammars=grammars,
+            keep_text=keep_text,
+            markers=markers,
+        ),
+        [files[i] for i in changed],
+        jobs,
+    )
+    for i, file_entry in zip(changed, read_entries):
+        file_entry.tags = own_tags(files[i], file_entry.tags)
+        if cache is not None:
+            cache.put(files[i], file_entry)
+        file_entries[i] = file_entry
+    if cache is not None:
+        cache.save()
+    return cast(List[FileEntry], file_entries)
+
+
+def build_tags(all_file_tags: Iterable[List[Tag]]) -> Tags:
+    """index the tags of all files. Raises TagAlreadyExistsError listing every duplicate"""
+    tags = Tags()
+    for file_tags in all_file_tags:
+        for tag in file_tags:
+            tags.add_tag(tag, raise_duplicate=False)
+    tags.check_duplicates()
     return tags
 
 
+def render_ref(
+    tags: Tags,
+    pdir: Path,
+    allow_not_found_tags: bool,
+    tag_name: str,
+    option: Optional[str],
+) -> str:
+    """
+    Render a reference @ref:NAME:OPTION
+    :param tags: all tags
+    :param pdir: directory that relative links are given from
+    :param allow_not_found_tags: replace unknown tags with TAG-NOT-FOUND instead of raising
+    :param tag_name: NAME
+    :param option: :OPTION, or None for the default option
+    :return:
+    """
+    option = "default" if option is None else option[1:]
+    tag = tags.is_tag(tag_name)
+    if tag is None:
+        if not allow_not_found_tags:
+            raise TagNotFoundError(f"Tag {tag_name} not found")
+        return Tag.visit_unknown_tag()
+    visit = VISIT_OPTIONS.get(option)
+    if visit is None:
+        raise OptionNotFoundError(
+            f"Option :{option} of tag {tag_name} not found. Possible options: {list(VISIT_OPTIONS)}"
+        )
+    return visit(tag, parent_dir=pdir)
+
+
+def make_ref_replacer(
+    tags: Tags, pdir: Path, allow_not_found_tags: bool
+) -> Callable[[Match[str]], str]:
+    """build the re.sub callback that replaces a Markers.ref_pattern match with its rendered reference"""
+
+    def replace_ref(re_tag: Match[str]) -> str:
+        return render_ref(
+            tags, pdir, allow_not_found_tags, re_tag.group(1), re_tag.group(2)
+        )
+
+    return replace_ref
+
+
+class RenderStats:
+    """counters of the outputs of a run"""
+
+    def __init__(self):
+        self.written = 0
+        self.unchanged = 0
+        self.removed = 0  # outputs of files that no longer contain references
+        self.stale: List[Path] = (
+            []
+        )  # check mode: outputs that would be written or removed
+
+    def add(self, other: "RenderStats"):
+        """count the outputs of another run too"""
+        self.written += other.written
+        self.unchanged += other.unchanged
+        self.removed += other.removed
+        self.stale.extend(other.stale)
+
+    def __repr__(self):
+        return (
+            f"RenderStats(written={self.written}, unchanged={self.unchanged}, "
+            f"removed={self.removed}, stale={len(self.stale)})"
+        )
+
+
+def get_output_path(f: Path) -> Path:
+    return f.parent / f"{f.stem}{DOC_OUT_ID}{f.suffix}"
+
+
+def render_file(
+    f: Path,
+    replace_ref: Callable[[Match[str]], str],
+    markers: Markers = DEFAULT_MARKERS,
+) -> Optional[str]:
+    """
+    Render a reference file in memory
+    :param f: reference file
+    :param replace_ref: callback of make_ref_replacer
+    :param markers: reference markers
+    :return: rendered document, or None if the file contains no references
+    """
+    ref_found = False
+    lines = []
+    with open(f) as r_doc:
+        for line in r_doc:
+            if markers.has_ref(line):
+                line, num_refs = markers.ref_pattern.subn(replace_ref, line)
+                ref_found = ref_found or num_refs > 0
+            lines.append(line)
+    return "".join(lines) if ref_found else None
+
+
+def render_ref_lines(
+    f: Path,
+    text: Optional[str],
+    ref_lines: List[int],
+    replace_ref: Callable[[Match[str]], str],
+    markers: Markers = DEFAULT_MARKERS,
+) -> Optional[str]:
+    """
+    Render a reference file whose reference lines are known, e.g. from the tag cache
+    :param f: reference file
+    :param text: contents of f if already read, else f is read if it has references
+    :param ref_lines: numbers of the lines holding a reference marker
+    :param replace_ref: callback of make_ref_replacer
+    :param markers: reference markers
+    :return: rendered document, or None if the file contains no references
+    """
+    if len(ref_lines) == 0:
+        return None
+    if text is None:
+        with open(f) as r_doc:
+            text = r_doc.read()
+    lines = io.StringIO(text).readlines()
+    ref_found = False
+    for line_num in ref_lines:
+        lines[line_num - 1], num_refs = markers.ref_pattern.subn(
+            replace_ref, lines[line_num - 1]
+        )
+        ref_found = ref_found or num_refs > 0
+    return "".join(lines) if ref_found else None
+
+
+def render_text(
+    text: str,
+    tags: Tags,
+    parent_dir: Path,
+    allow_not_found_tags: bool = False,
+    markers: Markers = DEFAULT_MARKERS,
+) -> str:
+    """
+    Render the references of a document held in memory, e.g. a page of a docs build
+    :param text: document
+    :param tags: all tags
+    :param parent_dir: directory that relative links are given from
+    :param allow_not_found_tags: replace unknown tags with TAG-NOT-FOUND instead of raising
+    :param markers: reference markers
+    :return: rendered document
+    """
+    if not markers.has_ref(text):
+        return text
+    return markers.ref_pattern.sub(
+        make_ref_replacer(tags, parent_dir, allow_not_found_tags), text
+    )
+
+
+def output_matches(out_fpath: Path, doc: str) -> bool:
+    """whether out_fpath already holds doc"""
+    try:
+        with open(out_fpath) as f:
+            return f.read() == doc
+    except (OSError, UnicodeDecodeError):
+        return False
+
+
+def write_if_changed(out_fpath: Path, doc: str) -> bool:
+    """atomically write doc to out_fpath unless it already holds doc. Returns True if written"""
+    if output_matches(out_fpath, doc):
+        return False
+    atomic_write_text(out_fpath, doc)
+    return True
+
+
 def replace_tags(
     pdir: Path,
     tags: Tags,
@@ -139,60 +774,598 @@ def replace_tags(
     dirs2search: Optional[List[Path]] = None,
     dirs2ignore: Optional[List[Path]] = None,
     ref_files: Optional[List[Path]] = None,
-):
+    ignore_patterns: Optional[List[str]] = None,
+    use_ignore_files: bool = True,
+    graph: Optional[DependencyGraph] = None,
+    check: bool = False,
+    markers: Markers = DEFAULT_MARKERS,
+    git_files: bool = False,
+) -> "RenderStats":
+    """
+    Write the <stem>_refers<suffix> output of every reference file. Outputs are rendered in memory
+    and only written if they differ from the existing output, so unchanged outputs keep their mtime.
+    :param graph: skip reference files whose contents, output and referenced tags are unchanged
+        since the graph recorded them, and record the others
+    :param check: write and remove nothing, list the outputs that are out of date in stats.stale.
+        The dependency graph is not saved
+    :param markers: reference markers
+    :param git_files: see get_files
+    :return: counts of written, unchanged and removed outputs
+    """
     files = (
-        get_files(pdir, accepted_ref_extensions, dirs2ignore, dirs2search)
+        get_files(
+            pdir,
+            accepted_ref_extensions,
+            dirs2ignore,
+            dirs2search,
+            ignore_patterns,
+            use_ignore_files,
+            git_files=git_files,
+        )
         if ref_files is None
         else iter(ref_files)
     )
-    for f in files:
-        ref_found = False
-        out_fpath = f.parent / f"{f.stem}{DOC_OUT_ID}{f.suffix}"
-        try:
-            with open(f) as r_doc, open(out_fpath, "w") as w_doc:
-                for line in r_doc:
-                    re_tags = re.finditer(DOC_RE_TAG, line)
-                    for re_tag in re_tags:
-                        ref_found = True
-                        tag_name, option = re_tag.group(1), re_tag.group(2)
-                        if option is None:
-                            option = ":default"
-
-                        try:
-                            tag = tags.get_tag(tag_name)
-                        except TagNotFoundError as e:
-                            if allow_not_found_tags:
-                                option = ":unknown_tag"
-                            else:
-                                raise e
-
-                        # replace ref with tag:option
-                        visit = getattr(tag, f"visit_{option[1:]}", None)
-                        if visit is None:
-                            visits = [
-                                func.replace("visit_", "")
-                                for func in dir(Tag)
-                                if (callable(getattr(Tag, func)) and "visit_" in func)
-                            ]
-                            raise OptionNotFoundError(
-                                f"Option {option} of tag {tag_name} not found. Possible options: {visits}"
-                            )
-                        else:
-                            kwargs = {"parent_dir": pdir}
-                            line = re.sub(
-                                rf"{re_tag.group(0)}(?![a-zA-Z:])",
-                                visit(**kwargs),
-                                line,
-                            )
-                    w_doc.write(line)
-            if not ref_found:
+    return render_documents(
+        pdir,
+        tags,
+        allow_not_found_tags,
+        ((f, None) for f in files),
+        graph,
+        check,
+        prune=ref_files is None,
+        markers=markers,
+    )
+
+
+def render_documents(
+    pdir: Path,
+    tags: Tags,
+    allow_not_found_tags: bool,
+    documents: Iterable[Tuple[Path, Optional[FileEntry]]],
+    graph: Optional[DependencyGraph] = None,
+    check: bool = False,
+    prune: bool = False,
+    markers: Markers = DEFAULT_MARKERS,
+    output_path: Callable[[Path], Path] = get_output_path,
+) -> "RenderStats":
+    """
+    Write the output of every reference file, see replace_tags
+    :param documents: reference files, each with its entry if already read: a file whose entry
+        has no reference lines is not read again
+    :param prune: documents holds every reference file, the graph forgets the others
+    :param output_path: path of the output of a reference file, next to it by default
+    :return: counts of written, unchanged and removed outputs
+    """
+    stats = RenderStats()
+    refs: Dict[str, str] = {}  # NAME:OPTION -> rendered value, of the current file
+
+    def render(tag_name: str, option: Optional[str]) -> str:
+        return render_ref(tags, pdir, allow_not_found_tags, tag_name, option)
+
+    def replace_ref(re_tag: Match[str]) -> str:
+        value = render(re_tag.group(1), re_tag.group(2))
+        refs[re_tag.group(1) + (re_tag.group(2) or "")] = value
+        return value
+
+    for f, file_entry in documents:
+        out_fpath = output_path(f)
+        if graph is not None and graph.is_up_to_date(f, out_fpath, render):
+            if graph.has_output(f):
+                stats.unchanged += 1
+            continue
+        refs.clear()
+        if file_entry is None:
+            doc = render_file(f, replace_ref, markers)
+        else:
+            doc = render_ref_lines(
+                f, file_entry.text, file_entry.ref_lines, replace_ref, markers
+            )
+        if check:
+            if doc is None and not out_fpath.is_file():
+                pass
+            elif doc is None or not output_matches(out_fpath, doc):
+                stats.stale.append(out_fpath)
+                continue  # the graph records only outputs that are up to date
+            else:
+                stats.unchanged += 1
+        elif doc is None:  # no references
+            if out_fpath.is_file():
                 out_fpath.unlink()
-        except Exception as e:
-            out_fpath.unlink()
-            raise e
+                stats.removed += 1
+        elif write_if_changed(out_fpath, doc):
+            stats.written += 1
+        else:
+            stats.unchanged += 1
+        if graph is not None:
+            graph.record(
+                f,
+                out_fpath,
+                refs,
+                tags,
+                doc,
+                None if file_entry is None else file_entry.digest,
+            )
+    if graph is not None and not check:
+        graph.save(prune=prune)
+    logger.info(f"Outputs: {stats}")
+    return stats
 
 
-def format_doc(
+class Config:
+    """resolved settings of a run, see load_config"""
+
+    def __init__(
+        self,
+        rootdir: Path,
+        allow_not_found_tags: bool,
+        accepted_tag_extensions: List[str],
+        accepted_ref_extensions: List[str],
+        dirs2ignore: Optional[List[Path]],
+        dirs2search: Optional[List[Path]],
+        tag_files: Optional[List[Path]],
+        ref_files: Optional[List[Path]],
+        ignore_patterns: Optional[List[str]],
+        use_ignore_files: bool,
+        engine: str,
+        jobs: int,
+        cache: bool,
+        cache_dir: Path,
+        cache_max_size: int,
+        target_versions: Optional[List[str]] = None,
+        markers: Markers = DEFAULT_MARKERS,
+        git_files: bool = False,
+    ):
+        self.rootdir = rootdir
+        self.allow_not_found_tags = allow_not_found_tags
+        self.accepted_tag_extensions = accepted_tag_extensions
+        self.accepted_ref_extensions = accepted_ref_extensions
+        self.dirs2ignore = dirs2ignore
+        self.dirs2search = dirs2search
+        self.tag_files = tag_files
+        self.ref_files = ref_files
+        self.ignore_patterns = ignore_patterns
+        self.use_ignore_files = use_ignore_files
+        self.engine = engine
+        self.jobs = jobs
+        self.cache = cache
+        self.cache_dir = cache_dir
+        self.cache_max_size = cache_max_size
+        self.target_versions = target_versions
+        self.markers = markers
+        self.git_files = git_files
+
+    def tag_cache(self, read_only: bool = False) -> Optional[TagCache]:
+        if not self.cache:
+            return None
+        return TagCache(
+            self.cache_dir,
+            self.engine,
+            self.cache_max_size,
+            self.markers,
+            self.target_versions,
+            read_only,
+        )
+
+    def dependency_graph(self) -> Optional[DependencyGraph]:
+        if not self.cache:
+            return None
+        return DependencyGraph(
+            self.cache_dir, self.rootdir, self.allow_not_found_tags, self.markers
+        )
+
+    def manifest(self) -> Optional[Manifest]:
+        if not self.cache:
+            return None
+        return Manifest(self.cache_dir, self.file_settings())
+
+    def file_settings(self) -> Dict[str, Any]:
+        """settings deciding which files are searched and how their tags are read"""
+        return {
+            "rootdir": str(self.rootdir),
+            "accepted_tag_extensions": sorted(self.accepted_tag_extensions),
+            "accepted_ref_extensions": sorted(self.accepted_ref_extensions),
+            "dirs2ignore": [str(d) for d in self.dirs2ignore or []],
+            "dirs2search": [str(d) for d in self.dirs2search or []],
+            "ignore_patterns": self.ignore_patterns,
+            "use_ignore_files": self.use_ignore_files,
+            "git_files": self.git_files,
+            "engine": self.engine,
+            "target_versions": self.target_versions,
+            "markers": self.markers.key(),
+        }
+
+    def get_tag_files(self) -> List[Path]:
+        if self.tag_files is not None:
+            return self.tag_files
+        return list(
+            get_files(
+                self.rootdir,
+                self.accepted_tag_extensions,
+                self.dirs2ignore,
+                self.dirs2search,
+                self.ignore_patterns,
+                self.use_ignore_files,
+                git_files=self.git_files,
+            )
+        )
+
+    def get_ref_files(self) -> List[Path]:
+        if self.ref_files is not None:
+            return self.ref_files
+        return list(
+            get_files(
+                self.rootdir,
+                self.accepted_ref_extensions,
+                self.dirs2ignore,
+                self.dirs2search,
+                self.ignore_patterns,
+                self.use_ignore_files,
+                git_files=self.git_files,
+            )
+        )
+
+    def get_tag_and_ref_files(self) -> Tuple[List[Path], List[Path]]:
+        """tag files and reference files, with a single walk of the tree for both"""
+        if self.tag_files is not None or self.ref_files is not None:
+            return self.get_tag_files(), self.get_ref_files()
+        tag_extensions = set(self.accepted_tag_extensions)
+        ref_extensions = set(self.accepted_ref_extensions)
+        files = list(
+            get_files(
+                self.rootdir,
+                sorted(tag_extensions | ref_extensions),
+                self.dirs2ignore,
+                self.dirs2search,
+                self.ignore_patterns,
+                self.use_ignore_files,
+                git_files=self.git_files,
+            )
+        )
+        return (
+            [f for f in files if f.suffix.lower() in tag_extensions],
+            [f for f in files if f.suffix.lower() in ref_extensions],
+        )
+
+
+def render_project(
+    config: Config,
+    cache: Optional[TagCache] = None,
+    graph: Optional[DependencyGraph] = None,
+    check: bool = False,
+    manifest: Optional[Manifest] = None,
+) -> "RenderStats":
+    """
+    Get the tags of a project and write the outputs of its reference files with a single walk of
+    the tree, reading each file at most once. The pass that extracts the tags also records the
+    lines holding references, so documents without references are not read again and documents
+    with references are rendered from the contents read for their tags
+    :param cache: tag cache, which also holds the reference lines of unchanged files
+    :param graph: see replace_tags
+    :param check: see replace_tags
+    :param manifest: record the tag and reference files found, for render_changed_files
+    :return: counts of written, unchanged and removed outputs
+    """
+    tag_extensions = set(config.accepted_tag_extensions)
+    ref_extensions = set(config.accepted_ref_extensions)
+    files = list(
+        get_files(
+            config.rootdir,
+            sorted(tag_extensions | ref_extensions),
+            config.dirs2ignore,
+            config.dirs2search,
+            config.ignore_patterns,
+            config.use_ignore_files,
+            git_files=config.git_files,
+        )
+    )
+    file_entries = collect_file_entries(
+        files,
+        config.engine,
+        config.jobs,
+        cache,
+        config.target_versions,
+        keep_text=True,
+        markers=config.markers,
+    )
+    tag_entries = {
+        f: file_entry
+        for f, file_entry in zip(files, file_entries)
+        if f.suffix.lower() in tag_extensions
+    }
+    tags = build_tags(file_entry.tags for file_entry in tag_entries.values())
+    documents = [
+        (f, file_entry)
+        for f, file_entry in zip(files, file_entries)
+        if f.suffix.lower() in ref_extensions
+    ]
+    if manifest is not None:
+        manifest.reset(tag_entries, dict(documents), git_head(config.rootdir))
+        if not check:
+            manifest.save()
+    return render_documents(
+        config.rootdir,
+        tags,
+        config.allow_not_found_tags,
+        documents,
+        graph,
+        check,
+        prune=True,
+        markers=config.markers,
+    )
+
+
+def render_changed_files(
+    config: Config,
+    changed: List[str],
+    cache: Optional[TagCache] = None,
+    graph: Optional[DependencyGraph] = None,
+    check: bool = False,
+    manifest: Optional[Manifest] = None,
+) -> "RenderStats":
+    """
+    Bring the outputs of a project up to date given the files that changed since its last run,
+    e.g. according to git. Only the changed tag files are read, the tags of the others come from
+    the manifest, and only the changed reference files and the documents referencing a tag of a
+    changed file are rendered. Without a valid manifest and dependency graph the whole project
+    is rendered, see render_project. The files changed since the manifest was saved, according
+    to their stat and to git, are added to the changed files, so that the outputs are up to date
+    whatever changed is given
+    :param changed: posix paths relative to config.rootdir, including deleted files
+    :param cache: see render_project
+    :param graph: see replace_tags
+    :param check: see replace_tags
+    :param manifest: tags and files of the last run, updated with the changes
+    :return: counts of written, unchanged and removed outputs
+    """
+    if (
+        manifest is None
+        or graph is None
+        or not manifest.loaded
+        or not (graph.loaded or not manifest.has_ref_files())
+    ):
+        logger.info("No manifest of a previous run, rendering the whole project")
+        return render_project(config, cache, graph, check, manifest)
+    changed_since_saved = None
+    if manifest.head is not None:
+        changed_since_saved = git_changed_files(config.rootdir, manifest.head)
+    if changed_since_saved is None:
+        logger.info("No git commit of the last run, rendering the whole project")
+        return render_project(config, cache, graph, check, manifest)
+    changed = sorted(
+        set(changed)
+        | set(changed_since_saved)
+        | {f.relative_to(config.rootdir).as_posix() for f in manifest.stale_files()}
+    )
+
+    tag_extensions = set(config.accepted_tag_extensions)
+    ref_extensions = set(config.accepted_ref_extensions)
+    changed_files = [
+        f
+        for f in filter_files(
+            config.rootdir,
+            changed,
+            sorted(tag_extensions | ref_extensions),
+            config.dirs2ignore,
+            config.dirs2search,
+            config.ignore_patterns,
+            use_ignore_files=config.use_ignore_files and not config.git_files,
+        )
+        if not f.stem.endswith(DOC_OUT_ID)
+    ]
+    existing = [f for f in changed_files if f.is_file()]
+    file_entries = dict(
+        zip(
+            existing,
+            collect_file_entries(
+                existing,
+                config.engine,
+                config.jobs,
+                cache,
+                config.target_versions,
+                keep_text=True,
+                markers=config.markers,
+            ),
+        )
+    )
+    logger.info(f"{len(changed_files)} changed files, {len(existing)} existing")
+
+    file_tags = manifest.file_tags()
+    changed_tag_names: Set[str] = set()
+    for f in changed_files:
+        if f.suffix.lower() not in tag_extensions:
+            continue
+        changed_tag_names.update(tag.name for tag in file_tags.pop(f, []))
+        file_entry = file_entries.get(f)
+        if file_entry is not None:
+            file_tags[f] = file_entry.tags
+            changed_tag_names.update(tag.name for tag in file_entry.tags)
+        manifest.set_tags(f, file_entry)
+    tags = build_tags(file_tags.values())
+
+    documents: Dict[Path, Optional[FileEntry]] = {}
+    for f in changed_files:
+        if f.suffix.lower() not in ref_extensions:
+            continue
+        manifest.set_ref_file(f, file_entries.get(f))
+        if f in file_entries:
+            documents[f] = file_entries[f]
+        else:
+            graph.forget(f)
+    for f in sorted(graph.dependents(changed_tag_names)):
+        if manifest.is_ref_file(f):
+            documents.setdefault(f, None)
+    manifest.set_head(git_head(config.rootdir))
+    if not check:
+        manifest.save()
+    return render_documents(
+        config.rootdir,
+        tags,
+        config.allow_not_found_tags,
+        sorted(documents.items()),
+        graph,
+        check,
+        markers=config.markers,
+    )
+
+
+def revision_output_dirs(revs: List[str], output_dir: Path) -> Dict[str, Path]:
+    """
+    directory of the outputs of each revision under output_dir, named after the revision with
+    slashes replaced. Raises ValueError if two revisions would share a directory
+    """
+    rev_dirs: Dict[str, Path] = {}
+    revs_by_dir: Dict[Path, str] = {}
+    for rev in revs:
+        rev_dir = output_dir / rev.replace("/", "_")
+        other = revs_by_dir.setdefault(rev_dir, rev)
+        if other != rev:
+            raise ValueError(
+                f"Revisions {other} and {rev} would both be written to {rev_dir}"
+            )
+        rev_dirs[rev] = rev_dir
+    return rev_dirs
+
+
+def render_revision(
+    config: Config,
+    rev: str,
+    output_dir: Path,
+    cache: Optional[TagCache] = None,
+    cat_file: Optional[CatFile] = None,
+    check: bool = False,
+    texts: Optional[Dict[str, str]] = None,
+) -> "RenderStats":
+    """
+    Write the outputs of the reference files of a git revision under output_dir, reading the tag
+    and reference files from the object store rather than from a checkout. The entries of blobs
+    are cached by object id, so a file identical in several revisions is parsed once
+    :param rev: git revision, e.g. a branch or a tag
+    :param output_dir: directory the outputs are written to, at the paths of the reference files
+        relative to config.rootdir
+    :param cache: tag cache, holding the entries of the blobs
+    :param cat_file: reader of blobs, shared by the revisions rendered in a row. A reader is
+        started for the revision by default
+    :param check: see replace_tags
+    :param texts: decoded contents of the documents by blob object id, shared by the revisions
+        rendered in a row
+    :return: counts of written, unchanged and removed outputs
+    """
+    blobs = dict(git_ls_tree(config.rootdir, rev))
+    tag_extensions = set(config.accepted_tag_extensions)
+    ref_extensions = set(config.accepted_ref_extensions)
+    files = [
+        f
+        for f in filter_files(
+            config.rootdir,
+            sorted(blobs),
+            sorted(tag_extensions | ref_extensions),
+            config.dirs2ignore,
+            config.dirs2search,
+            config.ignore_patterns,
+        )
+        if not f.stem.endswith(DOC_OUT_ID)
+    ]
+    reader = CatFile(config.rootdir) if cat_file is None else cat_file
+    if texts is None:
+        texts = {}
+
+    def read_text(oid: str) -> str:
+        if oid not in texts:
+            texts[oid] = decode_text(reader.read(oid))
+        return texts[oid]
+
+    try:
+        file_tags = []
+        documents = []
+        for f in files:
+            oid = blobs[f.relative_to(config.rootdir).as_posix()]
+            file_entry = None if cache is None else cache.get_blob(oid, f)
+            if file_entry is None:
+                buf = reader.read(oid)
+                file_entry = buffer_entry(
+                    f,
+                    buf,
+                    engine=config.engine,
+                    target_versions=config.target_versions,
+                    keep_text=True,
+                    markers=config.markers,
+                )
+                if cache is not None:
+                    cache.put_blob(oid, f, file_entry)
+                if file_entry.text is not None:
+                    texts[oid] = file_entry.text
+            if f.suffix.lower() in tag_extensions and len(file_entry.tags) > 0:
+                file_tags.append(file_entry.tags)
+            if f.suffix.lower() in ref_extensions:
+                if len(file_entry.ref_lines) > 0:
+                    file_entry.text = read_text(oid)
+                documents.append((f, file_entry))
+        if cache is not None:
+            cache.save()
+        tags = build_tags(file_tags)
+
+        def output_path(f: Path) -> Path:
+            return output_dir / get_output_path(f).relative_to(config.rootdir)
+
+        if not check:
+            for f, file_entry in documents:
+                if len(file_entry.ref_lines) > 0:
+                    output_path(f).parent.mkdir(parents=True, exist_ok=True)
+        return render_documents(
+            config.rootdir,
+            tags,
+            config.allow_not_found_tags,
+            documents,
+            check=check,
+            markers=config.markers,
+            output_path=output_path,
+        )
+    finally:
+        if cat_file is None:
+            reader.close()
+
+
+def find_rootdir(start: Path) -> Path:
+    """closest directory containing a pyproject.toml, from start upwards"""
+    p = start
+    while True:
+        if len(list(p.glob("pyproject.toml"))) == 1:
+            return p
+        p = p.parent
+        if p == Path(p.anchor) and len(list(p.glob("pyproject.toml"))) != 1:
+            raise PyprojectNotFound(
+                f"Could not find pyproject.toml file in any directory in or higher than {str(start)}"
+            )
+
+
+def target_versions_from_requires(requires_python: str) -> Optional[List[str]]:
+    """
+    python versions allowed by a requires-python specifier, e.g. ">=3.8,<3.10" gives
+    ["py38", "py39"] and ">=3.8,<3.10.2" gives ["py38", "py39", "py310"]. Poetry's "^3.8" and
+    "~3.8" are understood too
+    :return: None if the specifier gives no python 3 lower bound
+    """
+    lower, upper = None, LATEST_PYTHON_MINOR
+    for clause in requires_python.split(","):
+        m = re.fullmatch(
+            r"\s*(>=|>|==|~=|~|\^|<=|<)?\s*3\.(\d+)((?:\.[\d*]+)*)\s*", clause
+        )
+        if m is None:
+            continue
+        op, minor, patch = m.group(1), int(m.group(2)), m.group(3)
+        if op in (None, ">=", ">", "==", "~=", "~", "^"):
+            lower = minor if lower is None else max(lower, minor)
+        if op in (None, "==", "~", "<=") or (op == "~=" and patch):
+            upper = minor  # ~=3.8.1 allows 3.8.* only
+        elif op == "<":
+            # <3.10 excludes 3.10, <3.10.2 allows 3.10.0 and 3.10.1
+            upper = minor if re.search(r"[1-9]", patch) else minor - 1
+    if lower is None:
+        return None
+    return [f"py3{minor}" for minor in range(lower, max(upper, lower) + 1)]
+
+
+def load_config(
     rootdir: Optional[Union[str, Path]] = None,
     allow_not_found_tags: bool = False,
     accepted_tag_extensions: Optional[Union[str, List[str]]] = None,
@@ -201,9 +1374,29 @@ def format_doc(
     dirs2search: Optional[Union[str, List[str], Path, List[Path]]] = None,
     tag_files: Optional[Union[str, List[str], Path, List[Path]]] = None,
     ref_files: Optional[Union[str, List[str], Path, List[Path]]] = None,
-):
+    ignore_patterns: Optional[Union[str, List[str]]] = None,
+    use_ignore_files: Optional[bool] = None,
+    engine: Optional[str] = None,
+    jobs: Optional[int] = None,
+    cache: Optional[bool] = None,
+    target_versions: Optional[List[str]] = None,
+    tag_aliases: Optional[List[str]] = None,
+    ref_aliases: Optional[List[str]] = None,
+    git_files: Optional[bool] = None,
+) -> "Config":
     """
-
+    Resolve the settings of a run. Inputs take precedence over [tool.refers] in pyproject.toml,
+    which takes precedence over the defaults.
+    :param target_versions: python versions of the project, e.g. ["py311", "py312"], restricting
+        the grammars black tries. Read from project.requires-python by default
+    :param tag_aliases: markers recognised as tags besides @tag:, e.g. ["@anchor:"]
+    :param ref_aliases: markers recognised as references besides @ref:, e.g. ["@see:"]
+    :param git_files: list the files of the git index rather than walking the tree (default False)
+    :param cache: reuse tags of unchanged files from the cache directory (default True)
+    :param jobs: number of worker processes extracting tags (default 1). 0 uses all CPUs
+    :param engine: python logical line engine: "black" (default) or "tokenize"
+    :param ignore_patterns: gitignore style patterns of files and directories to skip
+    :param use_ignore_files: honour .gitignore and .ignore files
     :param tag_files:
     :param ref_files:
     :param dirs2search:
@@ -217,16 +1410,7 @@ def format_doc(
 
     # get root dir TODO use find_root_project() from black: https://github.com/psf/black/blob/d97b7898b34b67eb3c6839998920e17ac8c77908/src/black/files.py#L43
     if rootdir is None:  # TODO follow pytest rootdir finding algorithm
-        p = Path.cwd()
-        while rootdir is None:
-            if len(list(p.glob("pyproject.toml"))) == 1:
-                rootdir = p
-                break
-            p = p.parent
-            if p == Path(p.anchor) and len(list(p.glob("pyproject.toml"))) != 1:
-                raise PyprojectNotFound(
-                    f"Could not find pyproject.toml file in any directory in or higher than {str(Path.cwd())}"
-                )
+        rootdir = find_rootdir(Path.cwd())
     elif rootdir == ".":
         rootdir = Path.cwd()
     else:
@@ -235,10 +1419,14 @@ def format_doc(
             rootdir = Path().cwd() / rootdir
 
     # pyproject. Inputs to function takes precedence
+    cache_dir: Optional[Path] = None
+    cache_max_size = DEFAULT_CACHE_MAX_SIZE
     pyproject_path = rootdir / "pyproject.toml"
     if pyproject_path.is_file():
+        import toml
+
         pyproject = toml.load(str(pyproject_path))
-        if LIBRARY_NAME in pyproject["tool"].keys():
+        if LIBRARY_NAME in pyproject.get("tool", {}).keys():
             inputs_to_change = pyproject["tool"][LIBRARY_NAME].keys()
             if "refers_path" in inputs_to_change:
                 rootdir_tmp = Path(pyproject["tool"][LIBRARY_NAME]["refers_path"])
@@ -280,6 +1468,39 @@ def format_doc(
                 accepted_ref_extensions = pyproject["tool"][LIBRARY_NAME][
                     "accepted_ref_extensions"
                 ]
+            if "ignore_patterns" in inputs_to_change and ignore_patterns is None:
+                ignore_patterns = pyproject["tool"][LIBRARY_NAME]["ignore_patterns"]
+            if "use_ignore_files" in inputs_to_change and use_ignore_files is None:
+                use_ignore_files = pyproject["tool"][LIBRARY_NAME]["use_ignore_files"]
+            if "engine" in inputs_to_change and engine is None:
+                engine = pyproject["tool"][LIBRARY_NAME]["engine"]
+            if "jobs" in inputs_to_change and jobs is None:
+                jobs = pyproject["tool"][LIBRARY_NAME]["jobs"]
+            if "cache" in inputs_to_change and cache is None:
+                cache = pyproject["tool"][LIBRARY_NAME]["cache"]
+            if "cache_dir" in inputs_to_change:
+                cache_dir = Path(pyproject["tool"][LIBRARY_NAME]["cache_dir"])
+            if "cache_max_size" in inputs_to_change:
+                cache_max_size = pyproject["tool"][LIBRARY_NAME]["cache_max_size"]
+            if "target_versions" in inputs_to_change and target_versions is None:
+                target_versions = pyproject["tool"][LIBRARY_NAME]["target_versions"]
+            if "tag_aliases" in inputs_to_change and tag_aliases is None:
+                tag_aliases = pyproject["tool"][LIBRARY_NAME]["tag_aliases"]
+            if "ref_aliases" in inputs_to_change and ref_aliases is None:
+                ref_aliases = pyproject["tool"][LIBRARY_NAME]["ref_aliases"]
+            if "git_files" in inputs_to_change and git_files is None:
+                git_files = pyproject["tool"][LIBRARY_NAME]["git_files"]
+        if target_versions is None:
+            requires_python = pyproject.get("project", {}).get("requires-python")
+            if requires_python is None:
+                requires_python = (
+                    pyproject.get("tool", {})
+                    .get("poetry", {})
+                    .get("dependencies", {})
+                    .get("python")
+                )
+            if isinstance(requires_python, str):
+                target_versions = target_versions_from_requires(requires_python)
 
     # inputs (overrides pyproject)
     if isinstance(accepted_tag_extensions, str):
@@ -322,13 +1543,13 @@ def format_doc(
         ]
     if isinstance(dirs2ignore, str):
         dirs2ignore = [Path(dirs2ignore)]
-    elif isinstance(dirs2ignore, list) and isinstance(dirs2ignore[0], str):
+    elif isinstance(dirs2ignore, list) and len(dirs2ignore) > 0:
         dirs2ignore = [Path(f) for f in dirs2ignore]
     else:
         dirs2ignore = None
     if isinstance(dirs2search, str):
         dirs2search = [Path(dirs2search)]
-    elif isinstance(dirs2search, list) and isinstance(dirs2search[0], str):
+    elif isinstance(dirs2search, list) and len(dirs2search) > 0:
         dirs2search = [Path(f) for f in dirs2search]
     else:
         dirs2search = None
@@ -345,6 +1566,23 @@ def format_doc(
     else:
         tag_files = None
 
+    if isinstance(ignore_patterns, str):
+        ignore_patterns = [ignore_patterns]
+    if use_ignore_files is None:
+        use_ignore_files = True
+    if engine is None:
+        engine = "black"
+    if jobs is None:
+        jobs = 1
+    if cache is None:
+        cache = True
+    if git_files is None:
+        git_files = False
+    if cache_dir is None:
+        cache_dir = default_cache_dir(rootdir)
+    elif not cache_dir.is_absolute():
+        cache_dir = rootdir / cache_dir
+
     # checks
     if not rootdir.exists():
         raise ValueError(f"The root directory does not exist: {rootdir}.")
@@ -355,18 +1593,150 @@ def format_doc(
                     f"The following directory which was requested to be searched does not exist: {d}."
                 )
 
-    # get tags
-    tags = get_tags(
-        rootdir, accepted_tag_extensions, dirs2search, dirs2ignore, tag_files
+    return Config(
+        rootdir,
+        allow_not_found_tags,
+        accepted_tag_extensions,
+        accepted_ref_extensions,
+        dirs2ignore,
+        dirs2search,
+        tag_files,
+        ref_files,
+        ignore_patterns,
+        use_ignore_files,
+        engine,
+        jobs,
+        cache,
+        cache_dir,
+        cache_max_size,
+        target_versions,
+        markers_from_aliases(tag_aliases, ref_aliases),
+        git_files,
     )
 
-    # output document
-    replace_tags(
+
+def format_doc(
+    rootdir: Optional[Union[str, Path]] = None,
+    allow_not_found_tags: bool = False,
+    accepted_tag_extensions: Optional[Union[str, List[str]]] = None,
+    accepted_ref_extensions: Optional[Union[str, List[str]]] = None,
+    dirs2ignore: Optional[Union[str, List[str], Path, List[Path]]] = None,
+    dirs2search: Optional[Union[str, List[str], Path, List[Path]]] = None,
+    tag_files: Optional[Union[str, List[str], Path, List[Path]]] = None,
+    ref_files: Optional[Union[str, List[str], Path, List[Path]]] = None,
+    ignore_patterns: Optional[Union[str, List[str]]] = None,
+    use_ignore_files: Optional[bool] = None,
+    engine: Optional[str] = None,
+    jobs: Optional[int] = None,
+    cache: Optional[bool] = None,
+    clear_cache: bool = False,
+    check: bool = False,
+    git_files: Optional[bool] = None,
+    changed_since: Optional[str] = None,
+    staged: bool = False,
+    revs: Optional[List[str]] = None,
+    output_dir: Optional[Union[str, Path]] = None,
+) -> RenderStats:
+    """
+    Write the _refers output of every reference file. See load_config for the inputs
+    :param clear_cache: delete the cache directory before running
+    :param check: write nothing, not even the caches, list the outputs that are out of date in the
+        returned stale
+    :param changed_since: read and render only the files changed since this git revision and the
+        documents referencing their tags, see render_changed_files
+    :param staged: read and render only the files whose changes are staged in git, and the
+        documents referencing their tags
+    :param revs: render these git revisions rather than the working tree, from the object store
+        without a checkout, see render_revision
+    :param output_dir: directory holding the outputs of each of revs, see revision_output_dirs
+    :return: counts of written, unchanged and removed outputs
+    """
+    config = load_config(
         rootdir,
-        tags,
         allow_not_found_tags,
+        accepted_tag_extensions,
         accepted_ref_extensions,
-        dirs2search,
         dirs2ignore,
+        dirs2search,
+        tag_files,
         ref_files,
+        ignore_patterns,
+        use_ignore_files,
+        engine,
+        jobs,
+        cache,
+        git_files=git_files,
+    )
+
+    # get tags
+    tag_cache = config.tag_cache(read_only=check)
+    if clear_cache:
+        (tag_cache or TagCache(config.cache_dir, config.engine)).clear()
+    if revs:
+        if output_dir is None:
+            raise ValueError("Rendering git revisions needs an output directory")
+        if changed_since is not None or staged:
+            raise ValueError(
+                "Rendering git revisions cannot be combined with changed_since or staged"
+            )
+        rev_dirs = revision_output_dirs(revs, Path(output_dir))
+        stats = RenderStats()
+        texts: Dict[str, str] = {}
+        with CatFile(config.rootdir) as cat_file:
+            for rev, rev_dir in rev_dirs.items():
+                stats.add(
+                    render_revision(
+                        config,
+                        rev,
+                        rev_dir,
+                        tag_cache,
+                        cat_file,
+                        check,
+                        texts,
+                    )
+                )
+        logger.info(f"Read {cat_file.reads} blobs from git")
+        return stats
+    graph = config.dependency_graph()
+    if config.tag_files is None and config.ref_files is None:
+        manifest = config.manifest()
+        if changed_since is not None or staged:
+            changed = git_changed_files(config.rootdir, changed_since, staged)
+            if changed is not None:
+                return render_changed_files(
+                    config, changed, tag_cache, graph, check, manifest
+                )
+            logger.warning("Could not list the changes from git, rendering all files")
+        return render_project(config, tag_cache, graph, check, manifest)
+    tags = get_tags(
+        config.rootdir,
+        config.accepted_tag_extensions,
+        config.dirs2search,
+        config.dirs2ignore,
+        config.tag_files,
+        config.ignore_patterns,
+        config.use_ignore_files,
+        config.engine,
+        config.jobs,
+        tag_cache,
+        config.target_versions,
+        config.markers,
+        config.git_files,
+    )
+
+    # output document
+    return replace_tags(
+        config.rootdir,
+        tags,
+        config.allow_not_found_tags,
+        config.accepted_ref_extensions,
+        config.dirs2search,
+        config.dirs2ignore,
+        config.ref_files,
+        config.ignore_patterns,
+        config.use_ignore_files,
+        graph,
+        check,
+        config.markers,
+        config.git_files,
     )
@@ -0,0 +1,58 @@
+from bisect import bisect_right
+from typing import Iterable
+from typing import List
+from typing import Optional
+
+from refers.logical_lines import ScopeSpan
+
+
+class _Intervals:
+    """sorted, properly nested intervals. Each interval knows the interval that contains it"""
+
+    __slots__ = ("starts", "ends", "names", "parents")
+
+    def __init__(self, spans: Iterable[ScopeSpan]):
+        spans = sorted(spans, key=lambda s: (s[2], -s[3]))
+        self.starts: List[int] = []
+        self.ends: List[int] = []
+        self.names: List[str] = []
+        self.parents: List[int] = []
+        open_intervals: List[int] = []
+        for _, name, start, end in spans:
+            while open_intervals and self.ends[open_intervals[-1]] < start:
+                open_intervals.pop()
+            self.parents.append(open_intervals[-1] if open_intervals else -1)
+            open_intervals.append(len(self.starts))
+            self.starts.append(start)
+            self.ends.append(end)
+            self.names.append(name)
+
+    def innermost(self, line_num: int) -> Optional[str]:
+        """name of the innermost interval containing line_num"""
+        i = bisect_right(self.starts, line_num) - 1
+        while i >= 0 and self.ends[i] < line_num:
+            i = self.parents[i]
+        return None if i < 0 else self.names[i]
+
+
+class ScopeIndex:
+    """
+    Function and class spans of a python file, used to resolve the names of the function and class
+    containing each of the file's tags when the tags are extracted. The spans come from the
+    extraction, so names never depend on the file on disk. Only line numbers and names are kept,
+    never the source.
+    """
+
+    __slots__ = ("_funcs", "_classes")
+
+    def __init__(self, spans: List[ScopeSpan]):
+        self._funcs = _Intervals(s for s in spans if s[0] == "def")
+        self._classes = _Intervals(s for s in spans if s[0] == "class")
+
+    def func_name(self, line_num: int) -> Optional[str]:
+        """name of the innermost function containing line_num"""
+        return self._funcs.innermost(line_num)
+
+    def class_name(self, line_num: int) -> Optional[str]:
+        """name of the innermost class containing line_num"""
+        return self._classes.innermost(line_num)
@@ -0,0 +1,274 @@
+# JSON-RPC 2.0 server answering tag lookups and renders from a resident index
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import sys
+import threading
+from pathlib import Path
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import IO
+from typing import Optional
+
+from refers.errors import MultipleTagsInOneLine
+from refers.errors import OptionNotFoundError
+from refers.errors import TagAlreadyExistsError
+from refers.errors import TagNotFoundError
+from refers.errors import TagNotInClass
+from refers.errors import TagNotInFunction
+from refers.refers import Config
+from refers.refers import render_ref
+from refers.refers import render_text
+from refers.workspace import Workspace
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POLL_INTERVAL = 0.5  # seconds between checks of the files for changes
+
+# JSON-RPC error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+REFERS_ERROR = -32000
+
+REFERS_ERRORS = (
+    TagAlreadyExistsError,
+    MultipleTagsInOneLine,
+    TagNotFoundError,
+    OptionNotFoundError,
+    TagNotInFunction,
+    TagNotInClass,
+)
+
+
+class RpcError(Exception):
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class RefersServer:
+    """
+    Handle JSON-RPC requests with a resident Workspace. The tag files are polled for changes on a
+    background thread, once per poll_interval, and only changed files are re-read, so requests are
+    answered from the index without waiting for a walk of the tree.
+
+    Methods:
+    - lookup(name): the tag as an object, or null if there is no such tag
+    - render(name, option=null): the reference @ref:NAME:OPTION, option given without the colon
+    - render_document(text): text with every reference rendered
+    """
+
+    def __init__(self, config: Config, poll_interval: float = DEFAULT_POLL_INTERVAL):
+        self.workspace = Workspace(config, render=False)
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._stop_polling = threading.Event()
+        self.methods: Dict[str, Callable[..., Any]] = {
+            "lookup": self.lookup,
+            "render": self.render,
+            "render_document": self.render_document,
+        }
+
+    def load(self):
+        """read all tag files. Errors are logged and retried when a tag file changes"""
+        with self._lock:
+            try:
+                self.workspace.load()
+            except REFERS_ERRORS as e:
+                logger.error(f"{type(e).__name__}: {e}")
+
+    def poll(self):
+        """re-read the tag files changed since the last poll, with any changes that failed before"""
+        # only the polling thread touches the snapshots: the walk of the tree takes no lock
+        if not self.workspace.poll(refs=False):
+            return
+        with self._lock:
+            try:
+                self.workspace.update_tags()
+            except Exception as e:  # e.g. a tag file that does not parse
+                logger.error(f"{type(e).__name__}: {e}")
+
+    def start_polling(self) -> threading.Thread:
+        """poll the tag files on a daemon thread until stop_polling is called"""
+        self._stop_polling.clear()
+        thread = threading.Thread(target=self._poll_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def stop_polling(self):
+        self._stop_polling.set()
+
+    def _poll_forever(self):
+        while not self._stop_polling.wait(self.poll_interval):
+            self.poll()
+
+    def lookup(self, name: str) -> Optional[Dict[str, Any]]:
+        tag = self.workspace.tags.is_tag(name)
+        if tag is None:
+            return None
+        return {
+            "name": tag.name,
+            "file": str(tag.file),
+            "line_num": tag.line_num,
+            "line_num_start": tag.line_num_start,
+            "line_num_end": tag.line_num_end,
+            "line": tag.full_line,
+        }
+
+    def render(self, name: str, option: Optional[str] = None) -> str:
+        config = self.workspace.config
+        return render_ref(
+            self.workspace.tags,
+            config.rootdir,
+            config.allow_not_found_tags,
+            name,
+            None if option is None else f":{option.lstrip(':')}",
+        )
+
+    def render_document(self, text: str) -> str:
+        config = self.workspace.config
+        return render_text(
+            text,
+            self.workspace.tags,
+            config.rootdir,
+            config.allow_not_found_tags,
+            config.markers,
+        )
+
+    def _call(self, request: Any) -> Any:
+        if (
+            not isinstance(request, dict)
+            or request.get("jsonrpc") != "2.0"
+            or not isinstance(request.get("method"), str)
+        ):
+            raise RpcError(INVALID_REQUEST, "Invalid request")
+        method = self.methods.get(request["method"])
+        if method is None:
+            raise RpcError(METHOD_NOT_FOUND, f"Method {request['method']} not found")
+        params = request.get("params", [])
+        with self._lock:
+            try:
+                if isinstance(params, dict):
+                    return method(**params)
+                if isinstance(params, list):
+                    return method(*params)
+            except TypeError as e:
+                raise RpcError(INVALID_PARAMS, str(e))
+            except REFERS_ERRORS as e:
+                raise RpcError(REFERS_ERROR, f"{type(e).__name__}: {e}")
+            except Exception as e:  # e.g. a tag file that does not parse
+                raise RpcError(INTERNAL_ERROR, f"{type(e).__name__}: {e}")
+        raise RpcError(INVALID_PARAMS, "params must be an array or an object")
+
+    def handle(self, message: str) -> Optional[str]:
+        """answer one JSON-RPC message. Notifications (requests without an id) get no answer"""
+        try:
+            request = json.loads(message)
+        except ValueError:
+            return json.dumps(
+                {
+                    "jsonrpc": "2.0",
+                    "id": None,
+                    "error": {"code": PARSE_ERROR, "message": "Parse error"},
+                }
+            )
+        request_id = request.get("id") if isinstance(request, dict) else None
+        try:
+            result = self._call(request)
+        except RpcError as e:
+            response: Dict[str, Any] = {
+                "jsonrpc": "2.0",
+                "id": request_id,
+                "error": {"code": e.code, "message": e.message},
+            }
+        else:
+            response = {"jsonrpc": "2.0", "id": request_id, "result": result}
+        if isinstance(request, dict) and "id" not in request:
+            return None  # a notification, even one that failed
+        return json.dumps(response)
+
+    def serve_stream(self, rfile: IO[str], wfile: IO[str]):
+        """answer newline delimited JSON-RPC messages until the input ends"""
+        for message in rfile:
+            if not message.strip():
+                continue
+            response = self.handle(message)
+            if response is not None:
+                wfile.write(response + "\n")
+                wfile.flush()
+
+    def serve_unix_socket(self, path: Path):
+        """answer newline delimited JSON-RPC messages on a unix socket, one thread per client"""
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if not line.strip():
+                        continue
+                    response = server.handle(line.decode("utf-8"))
+                    if response is not None:
+                        self.wfile.write(response.encode("utf-8") + b"\n")
+                        self.wfile.flush()
+
+        remove_stale_socket(path)
+        with socketserver.ThreadingUnixStreamServer(str(path), Handler) as unix_server:
+            try:
+                unix_server.serve_forever()
+            finally:
+                os.unlink(path)
+
+
+def remove_stale_socket(path: Path):
+    """
+    remove a unix socket left over by a server that is gone. Raises FileExistsError if path is not
+    a socket or a server is still listening on it
+    """
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(f"{path} exists and is not a socket")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(path))
+        except ConnectionRefusedError:
+            os.unlink(path)
+            return
+    raise FileExistsError(f"A server is already listening on {path}")
+
+
+def serve(
+    config: Config,
+    socket_path: Optional[Path] = None,
+    poll_interval: float = DEFAULT_POLL_INTERVAL,
+):
+    """
+    Serve JSON-RPC on stdin and stdout, or on a unix socket
+    :param config: see load_config
+    :param socket_path: listen on this unix socket instead of stdin and stdout
+    :param poll_interval: seconds between checks of the tag files for changes
+    :return:
+    """
+    server = RefersServer(config, poll_interval)
+    server.load()
+    logger.info(f"Serving {len(server.workspace.tags)} tags of {config.rootdir}")
+    server.start_polling()
+    try:
+        if socket_path is None:
+            server.serve_stream(sys.stdin, sys.stdout)
+        else:
+            server.serve_unix_socket(socket_path)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop_polling()
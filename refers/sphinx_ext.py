@@ -0,0 +1,46 @@
+# Sphinx extension rendering the references of every source file as it is read, with no _refers files.
+#
+# conf.py:
+#     extensions = ["refers.sphinx_ext"]
+#     refers_rootdir = None  # project root, found from conf.py upwards by default
+#     refers_allow_not_found_tags = False
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from refers import __version__
+from refers.index import TagIndex
+from refers.refers import find_rootdir
+
+_index: Optional[TagIndex] = None  # shared by the sources of a build
+
+
+def build_index(app: Any):
+    global _index
+    rootdir = app.config.refers_rootdir
+    if rootdir is None:
+        rootdir = find_rootdir(Path(app.confdir))
+    _index = TagIndex.build(
+        rootdir, allow_not_found_tags=app.config.refers_allow_not_found_tags
+    )
+
+
+def render_source(app: Any, docname: str, source: List[str]):
+    if _index is None:
+        build_index(app)
+    assert _index is not None
+    source[0] = _index.render(source[0])
+
+
+def setup(app: Any) -> Dict[str, Any]:
+    app.add_config_value("refers_rootdir", None, "env")
+    app.add_config_value("refers_allow_not_found_tags", False, "env")
+    app.connect("builder-inited", build_index)
+    app.connect("source-read", render_source)
+    return {
+        "version": __version__,
+        "parallel_read_safe": True,
+        "parallel_write_safe": True,
+    }
@@ -1,11 +1,11 @@
 import re
-import token
 import warnings
 from pathlib import Path
+from typing import Callable
+from typing import Dict
+from typing import Iterator
 from typing import List
-
-from black.nodes import syms
-from blib2to3.pytree import Node  # type: ignore
+from typing import Optional
 
 from refers.definitions import COMMENT_SYMBOL
 from refers.errors import TagAlreadyExistsError
@@ -15,6 +15,24 @@ from refers.errors import TagNotInFunction
 
 
 class Tag:
+    """
+    A tag holds only resolved scalar fields, the names of the function and class containing it
+    included, never the syntax tree of the file, so memory does not grow with the size of parsed
+    files and rendering a tag never reads its file.
+    """
+
+    __slots__ = (
+        "_name",
+        "_line_num",
+        "_line",
+        "_file",
+        "_line_num_start",
+        "_line_num_end",
+        "_full_line",
+        "_func_name",
+        "_class_name",
+    )
+
     def __init__(
         self,
         name: str,
@@ -24,7 +42,8 @@ class Tag:
         line_num_start: int,
         line_num_end: int,
         full_line: str,
-        parent_node: Node,
+        func_name: Optional[str] = None,
+        class_name: Optional[str] = None,
     ):
         self._name = name
         self._line_num = line_num
@@ -33,24 +52,8 @@ class Tag:
         self._line_num_start = line_num_start
         self._line_num_end = line_num_end
         self._full_line = full_line
-
-        current_parent, self._func_name = parent_node, None
-        while self.func_name is None and current_parent.type != token.NT_OFFSET:
-            if current_parent.type == syms.funcdef:
-                self._func_name = re.sub(
-                    r"\s*(\w+)\s*\n?", r"\1", str(current_parent.children[1])
-                )
-                break
-            current_parent = current_parent.parent
-
-        current_parent, self._class_name = parent_node, None
-        while self._class_name is None and current_parent.type != token.NT_OFFSET:
-            if current_parent.type == syms.classdef:
-                self._class_name = re.sub(
-                    r"\s*(\w+)\s*\n?", r"\1", str(current_parent.children[1])
-                )
-                break
-            current_parent = current_parent.parent
+        self._func_name = func_name
+        self._class_name = class_name
 
     @property
     def name(self):
@@ -81,11 +84,11 @@ class Tag:
         return self._full_line
 
     @property
-    def func_name(self):
+    def func_name(self) -> Optional[str]:
         return self._func_name
 
     @property
-    def class_name(self):
+    def class_name(self) -> Optional[str]:
         return self._class_name
 
     def visit_name(self, *args, **kwargs) -> str:
@@ -153,35 +156,94 @@ class Tag:
         return "TAG-NOT-FOUND"
 
     def visit_func(self, *args, **kwargs):
-        if self._func_name is None:
+        func_name = self.func_name
+        if func_name is None:
             raise TagNotInFunction
-        return self._func_name
+        return func_name
 
     def visit_class(self, *args, **kwargs):
-        if self._class_name is None:
+        class_name = self.class_name
+        if class_name is None:
             raise TagNotInClass
-        return self._class_name
+        return class_name
+
+
+# option name -> Tag.visit_<option>
+VISIT_OPTIONS: Dict[str, Callable[..., str]] = {
+    func[len("visit_") :]: getattr(Tag, func)
+    for func in dir(Tag)
+    if func.startswith("visit_") and callable(getattr(Tag, func))
+}
 
 
 class Tags:
+    """tags indexed by name. Iteration follows insertion order"""
+
     def __init__(self):
-        self.all_tags: List[Tag] = []
+        self._tags: Dict[str, Tag] = {}
+        self._duplicates: Dict[str, List[Tag]] = {}  # all tags of a non-unique name
 
-    def is_tag(self, tag_name: str) -> Tag | None:
-        """check if tag already exists"""
-        for tag in self.all_tags:
-            if tag._name == tag_name:
-                return tag
-        return None
+    @property
+    def all_tags(self) -> List[Tag]:
+        return list(self._tags.values())
+
+    @property
+    def duplicates(self) -> Dict[str, List[Tag]]:
+        return self._duplicates
+
+    def __iter__(self) -> Iterator[Tag]:
+        return iter(self._tags.values())
 
-    def add_tag(self, new_tag: Tag):
-        """add new tag"""
-        if self.is_tag(new_tag._name) is not None:
-            raise TagAlreadyExistsError(f"""Tag {new_tag._name} is not unique.""")
-        self.all_tags.append(new_tag)
+    def __len__(self) -> int:
+        return len(self._tags)
+
+    def is_tag(self, tag_name: str) -> Optional[Tag]:
+        """check if tag already exists"""
+        return self._tags.get(tag_name)
+
+    def add_tag(self, new_tag: Tag, raise_duplicate: bool = True):
+        """
+        add new tag
+        :param new_tag: tag to add
+        :param raise_duplicate: raise TagAlreadyExistsError on a non-unique tag. Otherwise the tag is
+            recorded and reported by check_duplicates
+        :return:
+        """
+        tag = self._tags.get(new_tag._name)
+        if tag is None:
+            self._tags[new_tag._name] = new_tag
+            return
+        self._duplicates.setdefault(new_tag._name, [tag]).append(new_tag)
+        if raise_duplicate:
+            raise TagAlreadyExistsError(self._duplicate_message(new_tag._name))
+
+    def remove_tag(self, tag: Tag):
+        """remove a tag that was added. The next tag of a non-unique name takes its place"""
+        duplicates = self._duplicates.get(tag._name)
+        if duplicates is None:
+            if self._tags.get(tag._name) is tag:
+                del self._tags[tag._name]
+            return
+        duplicates[:] = [t for t in duplicates if t is not tag]
+        self._tags[tag._name] = duplicates[0]
+        if len(duplicates) == 1:
+            del self._duplicates[tag._name]
+
+    def check_duplicates(self):
+        """raise TagAlreadyExistsError listing every location of every non-unique tag"""
+        if len(self._duplicates) > 0:
+            raise TagAlreadyExistsError(
+                "\n".join(self._duplicate_message(name) for name in self._duplicates)
+            )
+
+    def _duplicate_message(self, tag_name: str) -> str:
+        locations = ", ".join(
+            f"{tag.file} L{tag.line_num}" for tag in self._duplicates[tag_name]
+        )
+        return f"Tag {tag_name} is not unique. Found at: {locations}"
 
     def get_tag(self, tag_name: str):
-        tag = self.is_tag(tag_name)
+        tag = self._tags.get(tag_name)
         if tag is None:
             raise TagNotFoundError(f"Tag {tag_name} not found")
         return tag
@@ -0,0 +1,58 @@
+import logging
+import time
+from typing import Callable
+from typing import Optional
+
+from refers.refers import Config
+from refers.refers import RenderStats
+from refers.workspace import Workspace
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POLL_INTERVAL = 0.5  # seconds
+DEFAULT_DEBOUNCE = 0.2  # seconds without changes before rendering
+
+
+def watch(
+    config: Config,
+    poll_interval: float = DEFAULT_POLL_INTERVAL,
+    debounce: float = DEFAULT_DEBOUNCE,
+    stop: Optional[Callable[[], bool]] = None,
+):
+    """
+    Render all reference files, then poll the tag and reference files for changes and re-render the
+    affected outputs until interrupted. Polling only stats files, so no file system notification
+    service is needed. Errors such as unknown or duplicated tags are logged and the changes are
+    rendered again on the next change.
+    :param config: see load_config
+    :param poll_interval: seconds between polls
+    :param debounce: changes are rendered once no file changed for this many seconds, so a burst of
+        saves is rendered once
+    :param stop: checked after every poll, stop watching when it returns True
+    :return:
+    """
+    workspace = Workspace(config)
+    _render(workspace.build)
+    logger.warning(f"Watching {config.rootdir} for changes. Press Ctrl+C to stop")
+    try:
+        while stop is None or not stop():
+            time.sleep(poll_interval)
+            if not workspace.poll():
+                continue
+            while True:
+                time.sleep(debounce)
+                if not workspace.poll():
+                    break
+            _render(workspace.update)
+    except KeyboardInterrupt:
+        pass
+
+
+def _render(render: Callable[[], RenderStats]):
+    start = time.perf_counter()
+    try:
+        stats = render()
+    except Exception as e:  # keep watching whatever went wrong
+        logger.error(f"{type(e).__name__}: {e}")
+        return
+    logger.warning(f"{stats} in {time.perf_counter() - start:.3f}s")
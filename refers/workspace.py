@@ -0,0 +1,171 @@
+import logging
+import os
+from pathlib import Path
+from typing import Dict
+from typing import List
+from typing import Set
+from typing import Tuple
+
+from refers.deps import DependencyGraph
+from refers.refers import collect_file_tags
+from refers.refers import Config
+from refers.refers import RenderStats
+from refers.refers import replace_tags
+from refers.tags import Tag
+from refers.tags import Tags
+
+logger = logging.getLogger(__name__)
+
+# path -> (mtime_ns, size)
+Snapshot = Dict[Path, Tuple[int, int]]
+
+
+def take_snapshot(files: List[Path]) -> Snapshot:
+    snapshot = {}
+    for f in files:
+        try:
+            st = os.stat(f)
+        except OSError:  # deleted since listed
+            continue
+        snapshot[f] = (st.st_mtime_ns, st.st_size)
+    return snapshot
+
+
+def diff_snapshots(old: Snapshot, new: Snapshot) -> Set[Path]:
+    """files added, removed or modified"""
+    return {f for f in old.keys() | new.keys() if old.get(f) != new.get(f)}
+
+
+class Workspace:
+    """
+    Tags of a project kept in memory between renders. poll() compares the stat of the tag and
+    reference files with the previous poll and update() then re-reads only the changed tag files and
+    re-renders only the reference files that changed or reference a tag of a changed file. A
+    workspace created with render=False only answers requests about tags (server, language server)
+    and keeps no record of the tags to re-render.
+    """
+
+    def __init__(self, config: Config, render: bool = True):
+        self.config = config
+        self.render = render
+        self.tag_cache = config.tag_cache()
+        self.graph = DependencyGraph(
+            config.cache_dir if config.cache else None,
+            config.rootdir,
+            config.allow_not_found_tags,
+            config.markers,
+        )
+        self.file_tags: Dict[Path, List[Tag]] = {}
+        self.tags = Tags()
+        self._tag_snapshot: Snapshot = {}
+        self._ref_snapshot: Snapshot = {}
+        # changes not yet successfully rendered
+        self._changed_tag_files: Set[Path] = set()
+        self._changed_ref_files: Set[Path] = set()
+        self._changed_tag_names: Set[str] = set()
+
+    def load(self):
+        """read all tag files"""
+        self._load_tag_files(self.config.get_tag_files())
+
+    def _load_tag_files(self, tag_files: List[Path]):
+        self._tag_snapshot = take_snapshot(tag_files)
+        self._changed_tag_files = set(tag_files)
+        self.update_tags()
+
+    def build(self) -> RenderStats:
+        """read all tag files and render all reference files"""
+        tag_files, ref_files = self.config.get_tag_and_ref_files()
+        self._ref_snapshot = take_snapshot(ref_files)
+        self._changed_ref_files = set(self._ref_snapshot)
+        self._load_tag_files(tag_files)
+        return self.render_changed()
+
+    def poll(self, refs: bool = True) -> bool:
+        """
+        record the files changed since the last poll
+        :param refs: also poll the reference files, not only the tag files
+        :return: True if any file changed
+        """
+        if refs:
+            tag_files, ref_files = self.config.get_tag_and_ref_files()
+        else:
+            tag_files = self.config.get_tag_files()
+        tag_snapshot = take_snapshot(tag_files)
+        changed_tag_files = diff_snapshots(self._tag_snapshot, tag_snapshot)
+        self._tag_snapshot = tag_snapshot
+        self._changed_tag_files |= changed_tag_files
+        if not refs:
+            return len(changed_tag_files) > 0
+        ref_snapshot = take_snapshot(ref_files)
+        changed_ref_files = diff_snapshots(self._ref_snapshot, ref_snapshot)
+        self._ref_snapshot = ref_snapshot
+        self._changed_ref_files |= changed_ref_files
+        return len(changed_tag_files) + len(changed_ref_files) > 0
+
+    def update(self) -> RenderStats:
+        """update the tags of the changed tag files and render the affected reference files"""
+        self.update_tags()
+        return self.render_changed()
+
+    def update_tags(self):
+        """
+        re-read the changed tag files and replace their tags in the index. Raises
+        TagAlreadyExistsError while the index holds non-unique tags
+        """
+        if self._changed_tag_files:
+            changed = sorted(
+                f for f in self._changed_tag_files if f in self._tag_snapshot
+            )
+            changed_file_tags = dict(
+                zip(
+                    changed,
+                    collect_file_tags(
+                        changed,
+                        self.config.engine,
+                        self.config.jobs,
+                        self.tag_cache,
+                        self.config.target_versions,
+                        self.config.markers,
+                    ),
+                )
+            )  # raises, keeping the changes
+            for f in sorted(self._changed_tag_files):
+                file_tags = changed_file_tags.get(f, [])
+                if self.render:
+                    for tags in (self.file_tags.get(f, []), file_tags):
+                        self._changed_tag_names.update(tag.name for tag in tags)
+                self.set_file_tags(f, file_tags)
+            self._changed_tag_files = set()
+        self.tags.check_duplicates()
+
+    def set_file_tags(self, f: Path, file_tags: List[Tag]):
+        """
+        replace the tags of one file in the index without rebuilding it. Non-unique tags are
+        recorded in tags.duplicates rather than raised
+        """
+        for tag in self.file_tags.pop(f, []):
+            self.tags.remove_tag(tag)
+        if len(file_tags) > 0:
+            self.file_tags[f] = file_tags
+        for tag in file_tags:
+            self.tags.add_tag(tag, raise_duplicate=False)
+
+    def render_changed(self) -> RenderStats:
+        """render the reference files that changed or reference a changed tag"""
+        for f in self._changed_ref_files - self._ref_snapshot.keys():
+            self.graph.forget(f)
+        affected = (
+            self._changed_ref_files | self.graph.dependents(self._changed_tag_names)
+        ) & self._ref_snapshot.keys()
+        stats = replace_tags(
+            self.config.rootdir,
+            self.tags,
+            self.config.allow_not_found_tags,
+            ref_files=sorted(affected),
+            graph=self.graph,
+            markers=self.config.markers,
+        )
+        self._changed_ref_files = set()
+        self._changed_tag_names = set()
+        return stats
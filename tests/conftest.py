@@ -1,4 +1,5 @@
 import re
+import shutil
 from pathlib import Path
 
 import pytest
@@ -71,6 +72,4 @@ def check_refers_test_files(request, tmp_path):
     assert refers_found, "No document with _refers found"
 
     # clean up
-    for f in tmp_folder.iterdir():  # type: ignore
-        f.unlink()  # type: ignore
-    tmp_folder.rmdir()
+    shutil.rmtree(tmp_folder)
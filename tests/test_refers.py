@@ -1,16 +1,62 @@
+import gc
+import io
+import json
+import os
 import re
+import shutil
+import socket
+import subprocess
+import sys
+import time
+import tokenize
+import tracemalloc
+import types
 from pathlib import Path
+from typing import Any
+from typing import cast
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
 
 import pytest
 
+from refers.cache import LAST_USED_RESOLUTION
+from refers.cache import tag_rows
+from refers.cache import TagCache
+from refers.cache import tags_from_rows
+from refers.cli import run
+from refers.definitions import CACHE_DIR_NAME
 from refers.definitions import COMMENT_SYMBOL
+from refers.errors import GitError
 from refers.errors import MultipleTagsInOneLine
 from refers.errors import OptionNotFoundError
 from refers.errors import TagAlreadyExistsError
 from refers.errors import TagNotFoundError
+from refers.errors import TagNotInClass
+from refers.errors import TagNotInFunction
+from refers.files import WalkStats
+from refers.index import TagIndex
+from refers.lsp import LanguageServer
+from refers.lsp import read_message
+from refers.markers import Markers
+from refers.markers import trie_regex
 from refers.refers import format_doc
+from refers.refers import get_files
 from refers.refers import get_tags
+from refers.refers import get_text_tags
+from refers.refers import load_config
+from refers.refers import render_text
 from refers.refers import replace_tags
+from refers.refers import revision_output_dirs
+from refers.refers import scan_text_tags
+from refers.refers import target_versions_from_requires
+from refers.server import METHOD_NOT_FOUND
+from refers.server import REFERS_ERROR
+from refers.server import RefersServer
+from refers.server import remove_stale_socket
+from refers.watch import watch
+from refers.workspace import Workspace
 
 
 @pytest.mark.parametrize(
@@ -50,9 +96,10 @@ d = 1  # @tag:a
     ],
     indirect=True,
 )
-def test_tags_error_tag_exists(create_tmp_file):
+@pytest.mark.parametrize("engine", ["black", "tokenize"])
+def test_tags_error_tag_exists(create_tmp_file, engine):
     with pytest.raises(TagAlreadyExistsError):
-        get_tags(Path().cwd(), tag_files=[create_tmp_file])
+        get_tags(Path().cwd(), tag_files=[create_tmp_file], engine=engine)
 
 
 @pytest.mark.parametrize(
@@ -75,8 +122,9 @@ e = (
     ],
     indirect=True,
 )
-def test_tags_no_option(create_tmp_file):
-    tags = get_tags(Path().cwd(), tag_files=[create_tmp_file])
+@pytest.mark.parametrize("engine", ["black", "tokenize"])
+def test_tags_no_option(create_tmp_file, engine):
+    tags = get_tags(Path().cwd(), tag_files=[create_tmp_file], engine=engine)
     tag = tags.get_tag("a")
     assert tag.name == "a"
     assert tag.file.name == "test.py"
@@ -144,8 +192,9 @@ class F():
     ],
     indirect=True,
 )
-def test_tags_hard_cases(create_tmp_file):
-    tags = get_tags(Path().cwd(), tag_files=[create_tmp_file])
+@pytest.mark.parametrize("engine", ["black", "tokenize"])
+def test_tags_hard_cases(create_tmp_file, engine):
+    tags = get_tags(Path().cwd(), tag_files=[create_tmp_file], engine=engine)
 
     tag = tags.get_tag("a")
     assert tag.name == "a"
@@ -744,8 +793,9 @@ There is one class @ref:A:class, a function @ref:f:func, and a nested function @
     ],
     indirect=True,
 )
-def test_replace_tags_with_class_and_functions(create_tmp_file: Path):
-    tags = get_tags(Path().cwd(), tag_files=[create_tmp_file])
+@pytest.mark.parametrize("engine", ["black", "tokenize"])
+def test_replace_tags_with_class_and_functions(create_tmp_file: Path, engine: str):
+    tags = get_tags(Path().cwd(), tag_files=[create_tmp_file], engine=engine)
     replace_tags(
         create_tmp_file.parent,
         tags,
@@ -913,3 +963,1409 @@ def test_replace_tags_delete_file_on_error(create_tmp_file: Path):
         (create_tmp_file.stem, "_refers", create_tmp_file.suffix)
     )
     assert not f_refers.is_file()
+
+
+def test_get_files_prunes_ignored_dirs(tmp_path: Path):
+    files = {
+        "a.py": "",
+        "notes.md": "",
+        "debug.log": "",
+        "keep.log": "",
+        ".gitignore": "*.log\n!keep.log\nbuild/\n",
+        ".git/config.txt": "",
+        "build/out.py": "",
+        "node_modules/pkg/index.js": "",
+        "src/b.py": "",
+        "src/.ignore": "generated.py\n",
+        "src/generated.py": "",
+        "src/sub/c.py": "",
+        "docs/d.md": "",
+    }
+    for fname, contents in files.items():
+        f = tmp_path / fname
+        f.parent.mkdir(parents=True, exist_ok=True)
+        f.write_text(contents)
+
+    stats = WalkStats()
+    found = list(
+        get_files(
+            tmp_path,
+            dirs2ignore=[Path("node_modules")],
+            ignore_patterns=["docs/"],
+            stats=stats,
+        )
+    )
+    assert [f.relative_to(tmp_path).as_posix() for f in found] == [
+        ".gitignore",
+        "a.py",
+        "keep.log",
+        "notes.md",
+        "src/.ignore",
+        "src/b.py",
+        "src/sub/c.py",
+    ]
+    # .git, build, node_modules and docs directories; debug.log and generated.py files
+    assert stats.skipped == 6
+
+    found = list(get_files(tmp_path, [".py"], use_ignore_files=False))
+    assert [f.relative_to(tmp_path).as_posix() for f in found] == [
+        "a.py",
+        "build/out.py",
+        "src/b.py",
+        "src/generated.py",
+        "src/sub/c.py",
+    ]
+
+    found = list(get_files(tmp_path, [".py"], dirs2search=[tmp_path / "src" / "sub"]))
+    assert found == [tmp_path / "src" / "sub" / "c.py"]
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="git is not installed")
+def test_get_git_files(tmp_path: Path):
+    files = {
+        "a.py": "",
+        "notes.md": "",
+        "deleted.py": "",
+        "node_modules/pkg/index.js": "",
+        "src/b.py": "",
+        "src/sub/c.py": "",
+        "docs/d.md": "",
+    }
+    for fname, contents in files.items():
+        f = tmp_path / fname
+        f.parent.mkdir(parents=True, exist_ok=True)
+        f.write_text(contents)
+
+    # outside a git repository the tree is walked
+    found = list(get_files(tmp_path, [".py"], git_files=True))
+    assert [f.relative_to(tmp_path).as_posix() for f in found] == [
+        "a.py",
+        "deleted.py",
+        "src/b.py",
+        "src/sub/c.py",
+    ]
+
+    subprocess.run(["git", "init", "-q", str(tmp_path)], check=True)
+    subprocess.run(["git", "-C", str(tmp_path), "add", "."], check=True)
+    (tmp_path / "deleted.py").unlink()
+    (tmp_path / "build").mkdir()
+    (tmp_path / "build" / "out.py").write_text("")  # untracked
+
+    stats = WalkStats()
+    found = list(
+        get_files(
+            tmp_path,
+            dirs2ignore=[Path("node_modules")],
+            ignore_patterns=["docs/"],
+            stats=stats,
+            git_files=True,
+        )
+    )
+    assert [f.relative_to(tmp_path).as_posix() for f in found] == [
+        "a.py",
+        "notes.md",
+        "src/b.py",
+        "src/sub/c.py",
+    ]
+    assert stats.skipped == 2  # index.js and d.md
+
+    found = list(
+        get_files(
+            tmp_path, [".py"], dirs2search=[tmp_path / "src" / "sub"], git_files=True
+        )
+    )
+    assert found == [tmp_path / "src" / "sub" / "c.py"]
+    found = list(get_files(tmp_path / "src", [".py"], git_files=True))
+    assert found == [tmp_path / "src" / "b.py", tmp_path / "src" / "sub" / "c.py"]
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="git is not installed")
+def test_format_doc_git_changes(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    import refers.refers
+
+    files = {
+        "pyproject.toml": "[tool.refers]\n",
+        "a.py": "a = 1  # @tag:a\n",
+        "b.py": "b = 1  # @tag:b\n",
+        "doc_a.md": "@ref:a:line\n",
+        "doc_b.md": "@ref:b:line\n",
+    }
+    for fname, contents in files.items():
+        (tmp_path / fname).write_text(contents)
+
+    def git(*args: str):
+        subprocess.run(
+            ["git", "-C", str(tmp_path), "-c", "user.name=refers"]
+            + ["-c", "user.email=refers@example.com", *args],
+            check=True,
+            capture_output=True,
+        )
+
+    git("init", "-q")
+    (tmp_path / ".gitignore").write_text(".refers_cache/\n")
+    git("add", ".")
+    git("commit", "-q", "-m", "initial")
+
+    read: List[str] = []
+    full_runs: List[Path] = []
+    read_file_entry = refers.refers.read_file_entry
+    render_project = refers.refers.render_project
+
+    def spy_read_file_entry(f, **kwargs):
+        read.append(f.name)
+        return read_file_entry(f, **kwargs)
+
+    def spy_render_project(config, *args):
+        full_runs.append(config.rootdir)
+        return render_project(config, *args)
+
+    monkeypatch.setattr(refers.refers, "read_file_entry", spy_read_file_entry)
+    monkeypatch.setattr(refers.refers, "render_project", spy_render_project)
+
+    # no manifest yet: the whole project is read
+    stats = format_doc(tmp_path, staged=True)
+    assert stats.written == 2
+    assert len(full_runs) == 1
+
+    # only the staged tag file is read, only the document referencing it is rendered
+    read.clear()
+    (tmp_path / "a.py").write_text("\na = 1  # @tag:a\n")
+    git("add", "a.py")
+    stats = format_doc(tmp_path, staged=True)
+    assert read == ["a.py"]
+    assert stats.written == 1
+    assert (tmp_path / "doc_a_refers.md").read_text() == "2\n"
+    assert (tmp_path / "doc_b_refers.md").read_text() == "1\n"
+
+    # changes of the working tree since a revision, untracked files included
+    read.clear()
+    (tmp_path / "b.py").write_text("\n\nb = 1  # @tag:b\n")
+    (tmp_path / "doc_c.md").write_text("@ref:a:line @ref:b:line\n")
+    stats = format_doc(tmp_path, changed_since="HEAD")
+    assert sorted(read) == ["b.py", "doc_c.md"]  # a.py is cached
+    assert stats.written == 2
+    assert (tmp_path / "doc_b_refers.md").read_text() == "3\n"
+    assert (tmp_path / "doc_c_refers.md").read_text() == "2 3\n"
+
+    # deleted tag files drop their tags
+    read.clear()
+    (tmp_path / "b.py").unlink()
+    with pytest.raises(TagNotFoundError):
+        format_doc(tmp_path, changed_since="HEAD")
+    assert read == []
+    (tmp_path / "b.py").write_text("b = 1  # @tag:b\n")
+
+    assert len(full_runs) == 1
+
+    # settings changed: the manifest is discarded and the whole project read
+    format_doc(tmp_path, accepted_tag_extensions=".py", changed_since="HEAD")
+    assert len(full_runs) == 2
+    format_doc(tmp_path, accepted_tag_extensions=".py", changed_since="HEAD")
+    assert len(full_runs) == 2
+
+    # not a revision: the whole project is read
+    format_doc(tmp_path, accepted_tag_extensions=".py", changed_since="no-such-rev")
+    assert len(full_runs) == 3
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="git is not installed")
+def test_format_doc_git_changes_since_last_run(tmp_path: Path):
+    files = {
+        "pyproject.toml": "[tool.refers]\n",
+        ".gitignore": ".refers_cache/\n",
+        "a.py": "a = 1  # @tag:foo\n",
+        "doc.md": "see @ref:foo:line_num\n",
+    }
+    for fname, contents in files.items():
+        (tmp_path / fname).write_text(contents)
+
+    def git(*args: str):
+        subprocess.run(
+            ["git", "-C", str(tmp_path), "-c", "user.name=refers"]
+            + ["-c", "user.email=refers@example.com", *args],
+            check=True,
+            capture_output=True,
+        )
+
+    git("init", "-q")
+    git("add", ".")
+    git("commit", "-q", "-m", "initial")
+    format_doc(tmp_path)
+    assert (tmp_path / "doc_refers.md").read_text() == "see 1\n"
+
+    # a commit made since the last run is not among the changes of the working tree or the index
+    (tmp_path / "a.py").write_text("\n\n\na = 1  # @tag:foo\n")
+    git("commit", "-q", "-am", "move foo")
+    stats = format_doc(tmp_path, changed_since="HEAD")
+    assert stats.written == 1
+    assert (tmp_path / "doc_refers.md").read_text() == "see 4\n"
+
+    (tmp_path / "a.py").write_text("\na = 1  # @tag:foo\n")
+    git("commit", "-q", "-am", "move foo again")
+    stats = format_doc(tmp_path, staged=True)
+    assert stats.written == 1
+    assert (tmp_path / "doc_refers.md").read_text() == "see 2\n"
+
+    # an edit rendered by the last run and reverted since
+    (tmp_path / "a.py").write_text("a = 1  # @tag:foo\n")
+    format_doc(tmp_path, changed_since="HEAD")
+    assert (tmp_path / "doc_refers.md").read_text() == "see 1\n"
+    git("checkout", "--", "a.py")
+    stats = format_doc(tmp_path, changed_since="HEAD")
+    assert stats.written == 1
+    assert (tmp_path / "doc_refers.md").read_text() == "see 2\n"
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="git is not installed")
+def test_format_doc_git_revisions(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    import refers.files
+    import refers.refers
+
+    def git(*args: str):
+        subprocess.run(
+            ["git", "-C", str(tmp_path), "-c", "user.name=refers"]
+            + ["-c", "user.email=refers@example.com", *args],
+            check=True,
+            capture_output=True,
+        )
+
+    (tmp_path / "pyproject.toml").write_text("[tool.refers]\n")
+    (tmp_path / "docs").mkdir()
+    (tmp_path / "docs" / "doc.md").write_text("@ref:a:line in @ref:a:func\n")
+    (tmp_path / "b.py").write_text("b = 1  # @tag:b\n")
+    (tmp_path / "a.py").write_text("def f():\n    return 1  # @tag:a\n")
+    git("init", "-q")
+    git("add", ".")
+    git("commit", "-q", "-m", "v1")
+    git("tag", "v1")
+    (tmp_path / "a.py").write_text("\n\ndef g():\n    return 1  # @tag:a\n")
+    git("commit", "-q", "-am", "v2")
+    git("branch", "release/v2")
+    (tmp_path / "a.py").write_text("a = 1  # @tag:a\n")  # not committed
+
+    reads: List[str] = []
+    read = refers.files.CatFile.read
+
+    def spy_read(self, oid: str) -> bytes:
+        reads.append(oid)
+        return read(self, oid)
+
+    monkeypatch.setattr(refers.files.CatFile, "read", spy_read)
+    monkeypatch.setattr(
+        refers.refers, "read_file_entry", None
+    )  # nothing read from disk
+
+    out = tmp_path / "out"
+    stats = format_doc(tmp_path, revs=["v1", "release/v2"], output_dir=out)
+    assert stats.written == 2
+    assert (out / "v1" / "docs" / "doc_refers.md").read_text() == "2 in f\n"
+    assert (out / "release_v2" / "docs" / "doc_refers.md").read_text() == "4 in g\n"
+    assert not (tmp_path / "docs" / "doc_refers.md").exists()
+    # pyproject.toml is not searched, b.py and doc.md are read once for both revisions
+    assert len(reads) == 4
+
+    # blobs are cached by object id, with the scopes of their tags: only the document is read again
+    reads.clear()
+    stats = format_doc(tmp_path, revs=["v1", "release/v2"], output_dir=out)
+    assert stats.unchanged == 2
+    assert len(reads) == 1
+
+    with pytest.raises(GitError):
+        format_doc(tmp_path, revs=["no-such-rev"], output_dir=out)
+    with pytest.raises(ValueError):
+        format_doc(tmp_path, revs=["v1"])
+    with pytest.raises(ValueError):
+        format_doc(tmp_path, revs=["v1"], output_dir=out, changed_since="HEAD")
+    with pytest.raises(ValueError):
+        format_doc(tmp_path, revs=["v1"], output_dir=out, staged=True)
+
+    # revisions whose names differ only by slashes would share a directory
+    git("branch", "release_v2", "release/v2")
+    with pytest.raises(ValueError, match="release/v2 and release_v2"):
+        format_doc(tmp_path, revs=["release/v2", "release_v2"], output_dir=out)
+    assert revision_output_dirs(["v1", "v1"], out) == {"v1": out / "v1"}
+
+
+@pytest.mark.parametrize(
+    "create_tmp_file",
+    [
+        (
+            ("test.py", "def f(:\n    return 1  # @ref:a is not a tag\n"),
+            ("test2.py", "a = 1  # @tag:a\n"),
+        )
+    ],
+    indirect=True,
+)
+def test_get_tags_skips_parse_without_tags(create_tmp_file: Path):
+    # the syntax error is never reached as the file contains no tag
+    tags = get_tags(
+        Path().cwd(), tag_files=[create_tmp_file, create_tmp_file.parent / "test2.py"]
+    )
+    assert [tag.name for tag in tags.all_tags] == ["a"]
+
+
+@pytest.mark.parametrize(
+    "create_tmp_file",
+    [
+        (
+            (
+                "test.py",
+                """
+
+class A:  # @tag:a_header
+    x = 1  # @tag:a_x
+
+    def f(self):
+        def g():
+            return 1  # @tag:g_ret
+        return g  # @tag:f_ret
+
+    # standalone comment
+    y = 2  # @tag:a_y
+
+
+def h(): return 1  # @tag:h
+z = 3  # @tag:z
+@dec
+async def k(
+    a,
+):  # @tag:k
+    return a  # @tag:k_ret
+""",
+            ),
+        )
+    ],
+    indirect=True,
+)
+@pytest.mark.parametrize("engine", ["black", "tokenize"])
+def test_tags_scopes(create_tmp_file: Path, engine: str, monkeypatch):
+    generate_tokens = tokenize.generate_tokens
+    num_tokenized = 0
+
+    def count_tokenized(readline):
+        nonlocal num_tokenized
+        num_tokenized += 1
+        return generate_tokens(readline)
+
+    monkeypatch.setattr(tokenize, "generate_tokens", count_tokenized)
+    tags = get_tags(Path().cwd(), tag_files=[create_tmp_file], engine=engine)
+    # black's parse tree gives the scopes; the tokenize engine finds them with its logical lines
+    assert num_tokenized == (0 if engine == "black" else 1)
+    create_tmp_file.write_text("")  # names are resolved when the tags are extracted
+    expected = {
+        "a_header": (3, None, "A"),
+        "a_x": (4, None, "A"),
+        "g_ret": (8, "g", "A"),
+        "f_ret": (9, "f", "A"),
+        "a_y": (12, None, "A"),
+        "h": (15, "h", None),
+        "z": (16, None, None),
+        "k": (20, "k", None),
+        "k_ret": (21, "k", None),
+    }
+    for name, (line_num, func_name, class_name) in expected.items():
+        tag = tags.get_tag(name)
+        assert tag.line_num == line_num
+        assert tag.func_name == func_name
+        assert tag.class_name == class_name
+    cached_tags = tags_from_rows(create_tmp_file, tag_rows(tags.all_tags))
+    assert [(tag.func_name, tag.class_name) for tag in cached_tags] == [
+        (tag.func_name, tag.class_name) for tag in tags.all_tags
+    ]
+    with pytest.raises(TagNotInFunction):
+        tags.get_tag("z").visit_func()
+    with pytest.raises(TagNotInClass):
+        tags.get_tag("h").visit_class()
+
+
+@pytest.mark.parametrize("engine", ["black", "tokenize"])
+def test_tags_memory_independent_of_file_size(tmp_path: Path, engine: str):
+    def retained_memory(num_lines: int) -> int:
+        f = tmp_path / f"test{num_lines}.py"
+        body = "".join(f"    x{i} = [{i}, ({i} + 1)]\n" for i in range(num_lines))
+        f.write_text(f"def func():\n    a = 1  # @tag:a\n{body}")
+        gc.collect()
+        tracemalloc.start()
+        tags = get_tags(Path().cwd(), tag_files=[f], engine=engine)
+        gc.collect()
+        retained = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        assert tags.get_tag("a").visit_func() == "func"
+        return retained
+
+    retained_memory(10)  # warm up grammar and import caches
+    small = retained_memory(100)
+    large = retained_memory(1500)
+    assert large - small < 10_000  # the parsed files differ by ~50 kB
+
+
+@pytest.mark.parametrize(
+    "create_tmp_file",
+    [
+        (
+            ("test.py", "a = 1  # @tag:a\nb = 1  # @tag:b\nc = 1  # @tag:a\n"),
+            ("test.md", "@tag:b\n@tag:c\n@tag:a\n"),
+        )
+    ],
+    indirect=True,
+)
+def test_tags_error_all_duplicates_reported(create_tmp_file: Path):
+    md_file = create_tmp_file.parent / "test.md"
+    with pytest.raises(TagAlreadyExistsError) as exc_info:
+        get_tags(Path().cwd(), tag_files=[create_tmp_file, md_file])
+    assert str(exc_info.value) == (
+        f"Tag a is not unique. Found at: {create_tmp_file} L1, {create_tmp_file} L3, {md_file} L3\n"
+        f"Tag b is not unique. Found at: {create_tmp_file} L2, {md_file} L1"
+    )
+
+
+def test_get_tags_jobs(tmp_path: Path):
+    tag_files = []
+    body = "".join(f"x{i} = [{i}, ({i} + 1)]\n" for i in range(100))
+    for i in range(6):
+        f = tmp_path / f"test{i}.py"
+        f.write_text(
+            f"def f{i}():\n    a = (\n        1  # @tag:a{i}\n    )\nb = 1  # @tag:b{i}\n{body}"
+        )
+        tag_files.append(f)
+
+    def tag_fields(jobs: int) -> Tuple[List[Tuple[str, str, Optional[str]]], int]:
+        """fields of the tags, and the memory kept alive by the tags themselves"""
+        tracemalloc.start()
+        tags = get_tags(tmp_path, tag_files=tag_files, jobs=jobs)
+        fields = [(tag.name, tag.full_line, tag.func_name) for tag in tags]
+        gc.collect()
+        with_tags = tracemalloc.get_traced_memory()[0]
+        del tags
+        gc.collect()
+        retained = with_tags - tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return fields, retained
+
+    fields, retained = tag_fields(jobs=1)
+    fields_parallel, retained_parallel = tag_fields(jobs=3)
+    assert fields_parallel == fields
+    # tags returned by the workers keep no more alive than tags read in process
+    assert retained_parallel - retained < 1_000  # the files hold ~13 kB
+
+    (tmp_path / "test6.md").write_text("@tag:a2\n")
+    with pytest.raises(TagAlreadyExistsError) as exc_info:
+        get_tags(tmp_path, jobs=0)
+    assert str(exc_info.value).startswith("Tag a2 is not unique.")
+
+
+def test_markers():
+    assert trie_regex(["@tag:", "@ref:"]) == "@(?:ref:|tag:)"
+    assert trie_regex(["@t", "@tag", "%a"]) == "(?:%a|@t(?:ag)?)"
+
+    markers = Markers(["%anchor:"], ["@see:"])
+    buf = b"x = 1  # @tag:a\n%anchor:b @see:a @ref:b:line\n@seen @tag\n"
+    assert markers.scan(buf) == ([9, 16], [26, 33])
+    assert len(markers.patterns_bytes) == 2 and len(Markers().patterns_bytes) == 1
+    assert markers.tag_pattern.findall("%anchor:b @tag:a") == ["b", "a"]
+    assert markers.ref_pattern.findall("@see:a @ref:b:line") == [
+        ("a", ""),
+        ("b", ":line"),
+    ]
+    assert markers.has_tag(b"%anchor:") and not markers.has_tag(b"@ref:")
+    assert Markers(["%anchor:"], ["@see:"]) == markers != Markers()
+    with pytest.raises(ValueError):
+        Markers(["@see:"], ["@see:"])
+
+
+@pytest.mark.parametrize(
+    "create_files",
+    [
+        (
+            ("pyproject.toml", '[tool.refers]\ntag_aliases = ["%anchor:"]\n'),
+            ("doc.md", "@ref:a:line, @see:b:line, @ref:c:line\n"),
+            ("tags.py", "a = 1  # @tag:a\nb = 2  # %anchor:b\n"),
+            ("tags.tex", "%anchor:c\n"),
+        ),
+    ],
+    indirect=True,
+)
+def test_format_doc_marker_aliases(create_files: Path):
+    format_doc(create_files)
+    assert (create_files / "doc_refers.md").read_text() == "1, @see:b:line, 1\n"
+
+    # changed markers invalidate the tag cache and the dependency graph
+    (create_files / "pyproject.toml").write_text(
+        '[tool.refers]\ntag_aliases = ["%anchor:"]\nref_aliases = ["@see:"]\n'
+    )
+    stats = format_doc(create_files)
+    assert stats.written == 1
+    assert (create_files / "doc_refers.md").read_text() == "1, 2, 1\n"
+    index = TagIndex.build(create_files)
+    assert index.render("@see:b:line") == "2"
+
+
+@pytest.mark.parametrize(
+    "src",
+    [
+        "a\n  @tag:a  \nb @tag:b\n\n\nc @tag:c",
+        "a\r\n@tag:a\r\n\r\n@tag:b\r\n",
+        "a\r@tag:a\r\r@tag:b\r",
+        "é\n@tag:é_1 ü\n@tag: not a tag\n@tag:b\n",
+        "no tag\n" * 3,
+    ],
+)
+@pytest.mark.parametrize("use_mmap", [False, True])
+def test_scan_text_tags(src: str, use_mmap: bool, tmp_path: Path, monkeypatch):
+    import refers.files
+
+    if use_mmap:
+        monkeypatch.setattr(refers.files, "MMAP_MIN_SIZE", 1)
+    f = tmp_path / "test.txt"
+    f.write_bytes(src.encode("utf-8"))
+    with refers.files.read_buffer(f) as buf:
+        assert isinstance(buf, bytes) is not use_mmap
+        file_tags = scan_text_tags(f, buf)
+    expected = get_text_tags(f, f.read_text(encoding="utf-8"))
+    assert [(t.name, t.line_num, t.full_line) for t in file_tags] == [
+        (t.name, t.line_num, t.full_line) for t in expected
+    ]
+
+    f.write_bytes(b"\n\n@tag:a @tag:b\n")
+    with pytest.raises(MultipleTagsInOneLine):
+        with refers.files.read_buffer(f) as buf:
+            scan_text_tags(f, buf)
+
+
+def test_get_tags_cache(tmp_path: Path):
+    cache_dir = tmp_path / CACHE_DIR_NAME
+    f_py = tmp_path / "test.py"
+    f_py.write_text("def f():\n    a = 1  # @tag:a\n")
+    f_md = tmp_path / "test.md"
+    f_md.write_text("@tag:b\n")
+
+    cache = TagCache(cache_dir)
+    tags = get_tags(tmp_path, cache=cache)
+    assert (cache.hits, cache.misses) == (0, 2)
+    assert (cache_dir / "tags.json").is_file()
+    assert list(get_files(tmp_path)) == [f_md, f_py]  # cache directory not searched
+
+    cache_file_stat = os.stat(cache_dir / "tags.json")
+    cache = TagCache(cache_dir)
+    tags = get_tags(tmp_path, cache=cache)
+    assert (cache.hits, cache.misses) == (2, 0)
+    # nothing changed: the cache is not rewritten
+    assert os.stat(cache_dir / "tags.json").st_ino == cache_file_stat.st_ino
+    cache = TagCache(cache_dir)
+    cache._now += LAST_USED_RESOLUTION  # a day later, the last uses are refreshed
+    get_tags(tmp_path, cache=cache)
+    assert os.stat(cache_dir / "tags.json").st_ino != cache_file_stat.st_ino
+    assert tags.get_tag("a").line_num == 2
+    assert tags.get_tag("a").visit_func() == "f"
+    assert tags.get_tag("b").full_line == "@tag:b"
+
+    # same contents, new mtime: hash matches
+    os.utime(f_md, ns=(0, 0))
+    f_py.write_text("def g():\n\n    a = 1  # @tag:a\n")
+    cache = TagCache(cache_dir)
+    tags = get_tags(tmp_path, cache=cache, jobs=2)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert tags.get_tag("a").line_num == 3
+    assert tags.get_tag("a").visit_func() == "g"
+
+    # engine, target versions and version mismatches invalidate the cache
+    cache = TagCache(cache_dir, target_versions=["py311"])
+    get_tags(tmp_path, cache=cache, target_versions=["py311"])
+    assert (cache.hits, cache.misses) == (0, 2)
+    cache = TagCache(cache_dir, engine="tokenize")
+    get_tags(tmp_path, cache=cache, engine="tokenize")
+    assert (cache.hits, cache.misses) == (0, 2)
+
+    # least recently used entries are evicted
+    os.utime(f_md, ns=(1, 1))  # revalidated, so used more recently
+    cache = TagCache(cache_dir, engine="tokenize", max_size=300)
+    get_tags(tmp_path, tag_files=[f_md], cache=cache, engine="tokenize")
+    cache = TagCache(cache_dir, engine="tokenize")
+    get_tags(tmp_path, cache=cache, engine="tokenize")
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    cache.clear()
+    assert not cache_dir.exists()
+
+
+def test_python_grammar(tmp_path: Path, monkeypatch):
+    import refers.black_engine as black_engine
+
+    assert target_versions_from_requires(">=3.8,<3.10") == ["py38", "py39"]
+    assert target_versions_from_requires(">=3.8,<3.10.0") == ["py38", "py39"]
+    assert target_versions_from_requires(">=3.8,<3.10.2") == ["py38", "py39", "py310"]
+    assert target_versions_from_requires("~=3.8.1") == ["py38"]
+    assert target_versions_from_requires("^3.11") == ["py311", "py312", "py313"]
+    assert target_versions_from_requires("~=3.12") == ["py312", "py313"]
+    assert target_versions_from_requires("==3.10.*") == ["py310"]
+    assert target_versions_from_requires(">=2.7") is None
+
+    from blib2to3.pgen2 import driver
+
+    grammars: List[str] = []
+
+    def spy_driver(grammar):
+        grammars.extend(n for n, g in black_engine.GRAMMARS.items() if g is grammar)
+        return driver.Driver(grammar)
+
+    monkeypatch.setattr(
+        black_engine, "driver", types.SimpleNamespace(Driver=spy_driver)
+    )
+    f_py = tmp_path / "test.py"
+    src = "match x:\n    case 1:\n        a = 1  # @tag:a\n"
+    f_py.write_text(src)
+    tags = get_tags(tmp_path, cache=TagCache(tmp_path / CACHE_DIR_NAME))
+    assert tags.get_tag("a").line_num == 3
+    assert grammars == ["async_keywords", "python", "soft_keywords"]
+
+    # a changed file is parsed with the grammar recorded in the cache first
+    grammars.clear()
+    f_py.write_text(src + "b = 1  # @tag:b\n")
+    get_tags(tmp_path, cache=TagCache(tmp_path / CACHE_DIR_NAME))
+    assert grammars == ["soft_keywords"]
+
+    # target versions: only their grammars are tried
+    grammars.clear()
+    get_tags(tmp_path, target_versions=["py311"])
+    assert grammars == ["soft_keywords"]
+    with pytest.raises(ValueError, match="Cannot parse for target version Python 3.9"):
+        get_tags(tmp_path, target_versions=["py39"])
+
+    (tmp_path / "pyproject.toml").write_text('[project]\nrequires-python = ">=3.12"\n')
+    assert load_config(tmp_path).target_versions == ["py312", "py313"]
+    (tmp_path / "pyproject.toml").write_text(
+        '[project]\nrequires-python = ">=3.12"\n[tool.refers]\ntarget_versions = ["py39"]\n'
+    )
+    assert load_config(tmp_path).target_versions == ["py39"]
+
+
+@pytest.mark.parametrize(
+    "create_files",
+    [
+        (
+            ("file_with_refs.md", "@ref:a:quote in @ref:a:func\n"),
+            ("file_with_tags.py", "def f():\n    a = 1  # @tag:a\n"),
+        ),
+    ],
+    indirect=True,
+)
+def test_format_doc_cache(create_files: Path):
+    format_doc(create_files)
+    assert (create_files / CACHE_DIR_NAME / "tags.json").is_file()
+    (create_files / "file_with_refs_refers.md").unlink()
+    format_doc(create_files)
+    with open(create_files / "file_with_refs_refers.md") as f:
+        assert f.read() == "a = 1  # @tag:a in f\n"
+
+    format_doc(create_files, cache=False, clear_cache=True)
+    assert not (create_files / CACHE_DIR_NAME).exists()
+
+
+@pytest.mark.parametrize(
+    "create_tmp_file",
+    [
+        (
+            ("test.py", 'a = "\\\\n"  # @tag:a\nb = 1  # @tag:b\n'),
+            ("test.md", "@ref:a:quote|@ref:b:line|@ref:a:line|@ref:b|@ref:c|@ref:a\n"),
+        )
+    ],
+    indirect=True,
+)
+def test_replace_tags_many_refs_one_line(create_tmp_file: Path):
+    tags = get_tags(Path().cwd(), tag_files=[create_tmp_file])
+    replace_tags(create_tmp_file.parent, tags, True, [".md"])
+    with open(create_tmp_file.parent / "test_refers.md") as f:
+        # the quote is inserted literally, backslashes are not treated as escapes
+        assert (
+            f.read()
+            == 'a = "\\\\n"  # @tag:a|2|1|test.py L2|TAG-NOT-FOUND|test.py L1\n'
+        )
+
+
+@pytest.mark.parametrize(
+    "create_files",
+    [
+        (
+            ("a.md", "@ref:a:quote\n"),
+            ("b.md", "@ref:b:line\n"),
+            ("c.md", "no refs\n"),
+            ("tags.py", "a = 1  # @tag:a\nb = 1  # @tag:b\n"),
+        ),
+    ],
+    indirect=True,
+)
+def test_format_doc_skips_unchanged_outputs(create_files: Path):
+    stats = format_doc(create_files)
+    assert (stats.written, stats.unchanged, stats.removed) == (2, 0, 0)
+    for name in ("a_refers.md", "b_refers.md"):
+        os.utime(create_files / name, ns=(0, 0))
+
+    (create_files / "tags.py").write_text("a = 1  # @tag:a\n\nb = 1  # @tag:b\n")
+    (create_files / "a.md").write_text("no more refs\n")
+    stats = format_doc(create_files)
+    assert (stats.written, stats.unchanged, stats.removed) == (1, 0, 1)
+    assert not (create_files / "a_refers.md").exists()
+    assert (create_files / "b_refers.md").read_text() == "3\n"
+
+    os.utime(create_files / "b_refers.md", ns=(0, 0))
+    stats = format_doc(create_files)
+    assert (stats.written, stats.unchanged, stats.removed) == (0, 1, 0)
+    assert (create_files / "b_refers.md").stat().st_mtime_ns == 0
+    assert sorted(f.name for f in create_files.iterdir()) == [
+        ".refers_cache",
+        "a.md",
+        "b.md",
+        "b_refers.md",
+        "c.md",
+        "tags.py",
+    ]
+
+
+@pytest.mark.parametrize(
+    "create_files",
+    [
+        (
+            ("a.md", "title\r\n\r\nsee @ref:a:quote\r\nend\r\n"),
+            ("notes.txt", "no references\n"),
+            ("tags.py", "a = 1  # @tag:a\nb = 1  # @tag:b  @ref:a:line\n"),
+        ),
+    ],
+    indirect=True,
+)
+@pytest.mark.parametrize("cache", [False, True])
+def test_format_doc_reads_each_file_once(create_files: Path, cache: bool, monkeypatch):
+    import refers.refers
+
+    walks, read = [], []
+    from refers.files import read_buffer
+
+    get_files = refers.refers.get_files
+
+    def spy_get_files(*args, **kwargs):
+        walks.append(args[0])
+        return get_files(*args, **kwargs)
+
+    def spy_read_buffer(f):
+        read.append(f.name)
+        return read_buffer(f)
+
+    monkeypatch.setattr(refers.refers, "get_files", spy_get_files)
+    monkeypatch.setattr(refers.refers, "read_buffer", spy_read_buffer)
+    monkeypatch.setattr(
+        refers.refers, "render_file", None
+    )  # documents are not read again
+    stats = format_doc(create_files, cache=cache)
+    assert (stats.written, stats.unchanged) == (2, 0)
+    assert len(walks) == 1
+    assert sorted(read) == ["a.md", "notes.txt", "tags.py"]
+    assert (create_files / "a_refers.md").read_text() == (
+        "title\n\nsee a = 1  # @tag:a\nend\n"
+    )
+    assert (create_files / "tags_refers.py").read_text() == (
+        "a = 1  # @tag:a\nb = 1  # @tag:b  1\n"
+    )
+    assert not (create_files / "notes_refers.txt").exists()
+
+    # unchanged files are not scanned: their tags and reference lines come from the cache, and
+    # only the document whose output was deleted is read, to render it
+    read.clear()
+    (create_files / "a_refers.md").unlink()
+    stats = format_doc(create_files, cache=cache)
+    assert (stats.written, stats.unchanged) == (1, 1)
+    assert sorted(read) == ([] if cache else ["a.md", "notes.txt", "tags.py"])
+
+
+@pytest.mark.parametrize(
+    "create_files",
+    [
+        (
+            ("a.md", "@ref:a:quote\n"),
+            ("b.md", "@ref:b:line\n"),
+            ("c.md", "@ref:a:line and @ref:b:line\n"),
+            ("tags.py", "a = 1  # @tag:a\nb = 1  # @tag:b\n"),
+        ),
+    ],
+    indirect=True,
+)
+def test_format_doc_renders_only_dependents(create_files: Path, monkeypatch):
+    import refers.refers
+
+    rendered = []
+    render_ref_lines = refers.refers.render_ref_lines
+
+    def spy_render_ref_lines(f, *args):
+        rendered.append(f.name)
+        return render_ref_lines(f, *args)
+
+    monkeypatch.setattr(refers.refers, "render_ref_lines", spy_render_ref_lines)
+    format_doc(create_files)
+    assert sorted(rendered) == ["a.md", "b.md", "c.md", "tags.py"]
+    assert (create_files / CACHE_DIR_NAME / "deps.json").is_file()
+
+    # nothing changed
+    rendered.clear()
+    stats = format_doc(create_files)
+    assert rendered == []
+    assert stats.unchanged == 3
+
+    # tag b moved: only the documents referencing b (and the edited file) are rendered
+    rendered.clear()
+    (create_files / "tags.py").write_text("a = 1  # @tag:a\n\nb = 1  # @tag:b\n")
+    format_doc(create_files)
+    assert sorted(rendered) == ["b.md", "c.md", "tags.py"]
+    assert (create_files / "c_refers.md").read_text() == "1 and 3\n"
+
+    # an edited output or document is rendered again
+    rendered.clear()
+    (create_files / "a_refers.md").write_text("edited\n")
+    (create_files / "b.md").write_text("@ref:b:line!\n")
+    format_doc(create_files)
+    assert sorted(rendered) == ["a.md", "b.md"]
+    assert (create_files / "a_refers.md").read_text() == "a = 1  # @tag:a\n"
+
+    # a deleted tag raises again
+    (create_files / "tags.py").write_text("a = 1  # @tag:a\n")
+    with pytest.raises(TagNotFoundError):
+        format_doc(create_files)
+
+
+@pytest.mark.parametrize(
+    "create_files",
+    [
+        (
+            ("a.md", "@ref:a:line\n"),
+            ("b.md", "@ref:b:line\n"),
+            ("tags.py", "a = 1  # @tag:a\n"),
+            ("other.py", "b = 1  # @tag:b\n"),
+        ),
+    ],
+    indirect=True,
+)
+def test_workspace_updates_changed_files(create_files: Path, monkeypatch):
+    import refers.refers
+
+    read, rendered = [], []
+    read_file_entry = refers.refers.read_file_entry
+    render_file = refers.refers.render_file
+
+    def spy_read_file_entry(f, **kwargs):
+        read.append(f.name)
+        return read_file_entry(f, **kwargs)
+
+    def spy_render_file(f, *args):
+        rendered.append(f.name)
+        return render_file(f, *args)
+
+    walks: List[Path] = []
+    get_files = refers.refers.get_files
+
+    def spy_get_files(pdir, *args, **kwargs):
+        walks.append(pdir)
+        return get_files(pdir, *args, **kwargs)
+
+    monkeypatch.setattr(refers.refers, "read_file_entry", spy_read_file_entry)
+    monkeypatch.setattr(refers.refers, "render_file", spy_render_file)
+    monkeypatch.setattr(refers.refers, "get_files", spy_get_files)
+    workspace = Workspace(load_config(create_files))
+    stats = workspace.build()
+    assert stats.written == 2
+    assert sorted(read) == ["a.md", "b.md", "other.py", "tags.py"]
+    assert workspace.poll() is False
+    assert len(walks) == 2  # one walk of the tree for the tag and reference files
+
+    read.clear()
+    rendered.clear()
+    (create_files / "other.py").write_text("\n\nb = 1  # @tag:b\n")
+    assert workspace.poll() is True
+    stats = workspace.update()
+    assert read == ["other.py"]
+    assert sorted(rendered) == ["b.md", "other.py"]
+    assert (create_files / "b_refers.md").read_text() == "3\n"
+
+    # errors keep the changes until they are fixed
+    rendered.clear()
+    (create_files / "a.md").write_text("@ref:a:line @ref:c:line\n")
+    workspace.poll()
+    with pytest.raises(TagNotFoundError):
+        workspace.update()
+    (create_files / "other.py").write_text("b = 1  # @tag:b\nc = 1  # @tag:c\n")
+    workspace.poll()
+    workspace.update()
+    assert (create_files / "a_refers.md").read_text() == "1 2\n"
+    assert (create_files / "b_refers.md").read_text() == "1\n"
+
+    # the index is updated file by file: a duplicate raises until it is removed
+    read.clear()
+    tags_a = workspace.tags.get_tag("a")
+    (create_files / "other.py").write_text("a = 1  # @tag:a\nb = 1  # @tag:b\n")
+    workspace.poll()
+    with pytest.raises(TagAlreadyExistsError):
+        workspace.update()
+    with pytest.raises(TagAlreadyExistsError):
+        workspace.update()
+    (create_files / "other.py").write_text("b = 1  # @tag:b\nc = 1  # @tag:c\n")
+    workspace.poll()
+    workspace.update()
+    assert read == ["other.py", "other.py"]
+    assert workspace.tags.get_tag("a") is tags_a
+
+    # deleted tag files drop their tags
+    (create_files / "other.py").unlink()
+    workspace.poll()
+    with pytest.raises(TagNotFoundError):
+        workspace.update()
+
+
+@pytest.mark.parametrize(
+    "create_files",
+    [(("a.md", "@ref:a:line\n"), ("tags.py", "a = 1  # @tag:a\n"))],
+    indirect=True,
+)
+def test_watch(create_files: Path):
+    polls: List[None] = []
+
+    def stop():
+        polls.append(None)
+        if len(polls) == 1:
+            (create_files / "tags.py").write_text("\na = 1  # @tag:a\n")
+        return len(polls) > 2
+
+    watch(load_config(create_files), poll_interval=0, debounce=0, stop=stop)
+    assert (create_files / "a_refers.md").read_text() == "2\n"
+
+
+@pytest.mark.parametrize(
+    "create_files",
+    [(("tags.py", "def f():\n    a = 1  # @tag:a\n"),)],
+    indirect=True,
+)
+def test_server(create_files: Path):
+    server = RefersServer(load_config(create_files), poll_interval=0)
+    server.load()
+    requests = [
+        {"jsonrpc": "2.0", "id": 1, "method": "lookup", "params": ["a"]},
+        {"jsonrpc": "2.0", "id": 2, "method": "lookup", "params": {"name": "b"}},
+        {"jsonrpc": "2.0", "id": 3, "method": "render", "params": ["a", "func"]},
+        {"jsonrpc": "2.0", "id": 4, "method": "render", "params": ["b"]},
+        {"jsonrpc": "2.0", "id": 5, "method": "render_document", "params": ["@ref:a"]},
+        {"jsonrpc": "2.0", "id": 6, "method": "format"},
+        {"jsonrpc": "2.0", "method": "render", "params": ["a"]},
+        {"jsonrpc": "2.0", "method": "format"},
+    ]
+    rfile = io.StringIO("".join(json.dumps(r) + "\n" for r in requests) + "{\n")
+    wfile = io.StringIO()
+    server.serve_stream(rfile, wfile)
+    responses = [json.loads(line) for line in wfile.getvalue().splitlines()]
+    assert len(responses) == 7  # no response to the notifications, even a failed one
+    assert responses[0]["result"] == {
+        "name": "a",
+        "file": str(create_files / "tags.py"),
+        "line_num": 2,
+        "line_num_start": 2,
+        "line_num_end": 2,
+        "line": "a = 1  # @tag:a",
+    }
+    assert responses[1]["result"] is None
+    assert responses[2]["result"] == "f"
+    assert responses[3]["error"]["code"] == REFERS_ERROR
+    assert responses[4]["result"] == "tags.py L2"
+    assert responses[5]["error"]["code"] == METHOD_NOT_FOUND
+    assert responses[6]["error"]["code"] == -32700
+
+    # changed tag files are re-read by a poll, not by requests
+    (create_files / "tags.py").write_text("def g():\n\n    a = 1  # @tag:a\n")
+    response = json.loads(server.handle(json.dumps(requests[2])) or "")
+    assert response["result"] == "f"
+    server.poll()
+    response = json.loads(server.handle(json.dumps(requests[2])) or "")
+    assert response["result"] == "g"
+    assert len(server.workspace._changed_tag_names) == 0  # nothing to render
+
+    # a tag file that does not parse keeps the previous index until it is fixed
+    (create_files / "tags.py").write_text("def h(:\n    a = 1  # @tag:a\n")
+    server.poll()
+    assert server.workspace.tags.get_tag("a").func_name == "g"
+
+    # the polling thread
+    (create_files / "tags.py").write_text("def k():\n    a = 1  # @tag:a\n")
+    server.start_polling()
+    try:
+        for _ in range(500):
+            if server.workspace.tags.get_tag("a").func_name == "k":
+                break
+            time.sleep(0.01)
+    finally:
+        server.stop_polling()
+    assert server.workspace.tags.get_tag("a").func_name == "k"
+
+
+def test_remove_stale_socket(tmp_path: Path):
+    path = tmp_path / "refers.sock"
+    remove_stale_socket(path)  # nothing to remove
+
+    path.write_text("not a socket")
+    with pytest.raises(FileExistsError):
+        remove_stale_socket(path)
+    assert path.read_text() == "not a socket"
+    path.unlink()
+
+    listening = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listening.bind(str(path))
+    listening.listen()
+    with pytest.raises(FileExistsError):
+        remove_stale_socket(path)
+    assert path.exists()
+
+    listening.close()  # the socket file is left over
+    remove_stale_socket(path)
+    assert not path.exists()
+
+
+@pytest.mark.parametrize(
+    "create_files",
+    [
+        (
+            ("doc.md", "see @ref:a and @ref:zz:line\n"),
+            ("tags.py", "def f():\n    a = 1  # @tag:a\n"),
+        )
+    ],
+    indirect=True,
+)
+def test_language_server(create_files: Path):
+    doc_uri = (create_files / "doc.md").as_uri()
+    tags_uri = (create_files / "tags.py").as_uri()
+
+    def request(method, params, msg_id=None):
+        message = {"jsonrpc": "2.0", "method": method, "params": params}
+        if msg_id is not None:
+            message["id"] = msg_id
+        body = json.dumps(message).encode()
+        return b"Content-Length: %d\r\n\r\n" % len(body) + body
+
+    def position(uri, line, character):
+        return {
+            "textDocument": {"uri": uri},
+            "position": {"line": line, "character": character},
+        }
+
+    messages = [
+        request("initialize", {}, 1),
+        request(
+            "textDocument/didOpen",
+            {"textDocument": {"uri": doc_uri, "text": "see @ref:a and @ref:zz:line\n"}},
+        ),
+        request("textDocument/definition", position(doc_uri, 0, 6), 2),
+        request("textDocument/hover", position(doc_uri, 0, 10), 3),
+        request("textDocument/hover", position(doc_uri, 0, 0), 4),
+        request(
+            "textDocument/didOpen",
+            {
+                "textDocument": {
+                    "uri": tags_uri,
+                    "text": "def f():\n    a = 1  # @tag:a\n",
+                }
+            },
+        ),
+        request(  # add tag zz to the buffer of tags.py
+            "textDocument/didChange",
+            {
+                "textDocument": {"uri": tags_uri},
+                "contentChanges": [
+                    {
+                        "range": {
+                            "start": {"line": 2, "character": 0},
+                            "end": {"line": 2, "character": 0},
+                        },
+                        "text": "zz = 2  # @tag:zz\n",
+                    }
+                ],
+            },
+        ),
+        request(
+            "textDocument/didChange",
+            {
+                "textDocument": {"uri": doc_uri},
+                "contentChanges": [{"text": "@ref:\n@ref:a:qu\n"}],
+            },
+        ),
+        request("textDocument/completion", position(doc_uri, 0, 5), 5),
+        request("textDocument/completion", position(doc_uri, 1, 10), 6),
+        request("shutdown", None, 7),
+        request("exit", None),
+    ]
+    wfile = io.BytesIO()
+    server = LanguageServer(load_config(create_files), wfile)
+    server.serve(io.BytesIO(b"".join(messages)))
+    assert server.running is False
+
+    rfile = io.BytesIO(wfile.getvalue())
+    responses = {}
+    diagnostics = []
+    while (message := read_message(rfile)) is not None:
+        if "id" in message:
+            responses[message["id"]] = message["result"]
+        else:
+            diagnostics.append(message["params"])
+
+    assert responses[1]["capabilities"]["definitionProvider"] is True
+    assert responses[2] == {
+        "uri": tags_uri,
+        "range": {
+            "start": {"line": 1, "character": 0},
+            "end": {"line": 1, "character": 0},
+        },
+    }
+    assert "a = 1  # @tag:a" in responses[3]["contents"]["value"]
+    assert responses[4] is None
+    assert [item["label"] for item in responses[5]["items"]] == ["a", "zz"]
+    assert [item["label"] for item in responses[6]["items"]] == ["quote", "quotecode"]
+
+    # the unknown tag is reported until it is added to the buffer of tags.py
+    doc_diagnostics = [d["diagnostics"] for d in diagnostics if d["uri"] == doc_uri]
+    assert [d["message"] for d in doc_diagnostics[0]] == ["Tag zz not found"]
+    assert doc_diagnostics[0][0]["range"] == {
+        "start": {"line": 0, "character": 15},
+        "end": {"line": 0, "character": 27},
+    }
+    assert doc_diagnostics[-2] == []
+    assert server.workspace.tags.get_tag("zz").line_num == 3
+
+    # files the search for tag files skips are not indexed, even when opened
+    assert server.is_tag_file(create_files / "tags.py")
+    (create_files / ".gitignore").write_text("ignored.py\n")
+    for f in ["ignored.py", ".git/hooks.py", "tags_refers.py", "../outside.py"]:
+        assert not server.is_tag_file((create_files / f).resolve())
+
+
+@pytest.mark.parametrize(
+    "create_files",
+    [
+        (
+            ("pyproject.toml", "[tool.refers]\n"),
+            ("tags.py", "def f():\n    a = 1  # @tag:a\n"),
+        )
+    ],
+    indirect=True,
+)
+def test_tag_index(create_files: Path):
+    index = TagIndex.build(create_files)
+    assert "a" in index and "b" not in index
+    assert index.render("@ref:a:func in @ref:a:link\n") == "f in tags.py\n"
+    assert render_text("@ref:a:line", index.tags, create_files) == "2"
+    assert render_text("@ref:b", index.tags, create_files, True) == "TAG-NOT-FOUND"
+    assert not (create_files / "tags_refers.py").exists()
+
+    # sphinx: render each source as it is read
+    from refers import sphinx_ext
+
+    config = types.SimpleNamespace()
+    events: Dict[str, Any] = {}
+    app = types.SimpleNamespace(
+        confdir=str(create_files),
+        config=config,
+        add_config_value=lambda name, default, rebuild: setattr(config, name, default),
+        connect=lambda event, callback: events.setdefault(event, callback),
+    )
+    assert sphinx_ext.setup(app)["parallel_read_safe"] is True
+    events["builder-inited"](app)
+    source = ["see @ref:a:quote"]
+    events["source-read"](app, "index", source)
+    assert source == ["see a = 1  # @tag:a"]
+
+
+@pytest.mark.parametrize(
+    "create_files",
+    [(("pyproject.toml", "[tool.refers]\n"), ("tags.py", "a = 1  # @tag:a\n"))],
+    indirect=True,
+)
+def test_mkdocs_plugin(create_files: Path):
+    pytest.importorskip("mkdocs")
+    from refers.mkdocs_plugin import RefersPlugin
+
+    plugin = RefersPlugin()
+    assert plugin.load_config({}) == ([], [])
+    plugin.on_pre_build({"config_file_path": str(create_files / "mkdocs.yml")})
+    assert plugin.on_page_markdown("@ref:a:line", None, None, None) == "1"
+
+
+@pytest.mark.parametrize(
+    "create_files",
+    [(("pyproject.toml", "[tool.refers]\n"), ("tags.py", "a = 1  # @tag:a\n"))],
+    indirect=True,
+)
+def test_render_stream(create_files: Path):
+    index = TagIndex.build(create_files)
+    wfile = io.StringIO()
+    index.render_stream(io.StringIO("x @ref:a:line\r\nno ref\n@ref:a"), wfile)
+    assert wfile.getvalue() == "x 1\r\nno ref\ntags.py L1"
+
+    # one line in memory at a time
+    line = "see @ref:a:quote and @ref:a:line " + "x" * 100 + "\n"
+    tracemalloc.start()
+    num_chars = sum(len(out) for out in index.render_lines(line for _ in range(50_000)))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert num_chars > 5_000_000
+    assert peak < 100_000
+    assert sorted(f.name for f in create_files.iterdir()) == [
+        ".refers_cache",
+        "pyproject.toml",
+        "tags.py",
+    ]
+
+
+@pytest.mark.parametrize(
+    "create_files",
+    [
+        (
+            ("a.md", "@ref:a:line\n"),
+            ("b.md", "@ref:b:line\n"),
+            ("tags.py", "a = 1  # @tag:a\nb = 1  # @tag:b\n"),
+        ),
+    ],
+    indirect=True,
+)
+def test_format_doc_check(create_files: Path, monkeypatch):
+    import refers.refers
+
+    stats = format_doc(create_files, check=True)
+    assert sorted(f.name for f in stats.stale) == ["a_refers.md", "b_refers.md"]
+    assert not (create_files / "a_refers.md").exists()
+    assert not (create_files / CACHE_DIR_NAME).exists()  # nor any cache
+
+    format_doc(create_files)
+    cache_files = {f: f.read_bytes() for f in (create_files / CACHE_DIR_NAME).iterdir()}
+    rendered = []
+    render_ref_lines = refers.refers.render_ref_lines
+
+    def spy_render_ref_lines(f, *args):
+        rendered.append(f.name)
+        return render_ref_lines(f, *args)
+
+    monkeypatch.setattr(refers.refers, "render_ref_lines", spy_render_ref_lines)
+    stats = format_doc(create_files, check=True)
+    assert (stats.stale, stats.unchanged, rendered) == ([], 2, [])
+
+    # the dependency graph limits rendering to documents referencing changed tags
+    (create_files / "tags.py").write_text("a = 1  # @tag:a\n\nb = 1  # @tag:b\n")
+    (create_files / "a.md").write_text("no refs\n")
+    stats = format_doc(create_files, check=True)
+    assert sorted(f.name for f in stats.stale) == ["a_refers.md", "b_refers.md"]
+    assert sorted(rendered) == ["a.md", "b.md", "tags.py"]
+    assert (create_files / "b_refers.md").read_text() == "2\n"
+    assert cache_files == {f: f.read_bytes() for f in cache_files}
+
+    # without the cache every document is rendered
+    assert len(format_doc(create_files, cache=False, check=True).stale) == 2
+
+
+@pytest.mark.parametrize(
+    "create_files",
+    [(("a.md", "@ref:a:line\n"), ("tags.py", "a = 1  # @tag:a\n"))],
+    indirect=True,
+)
+def test_cli(create_files: Path, monkeypatch, capsys):
+    def run_cli(*args: str) -> int:
+        monkeypatch.setattr(sys, "argv", ["refers", "-r", str(create_files), *args])
+        try:
+            run()
+        except SystemExit as e:
+            return cast(int, e.code)
+        return 0
+
+    assert run_cli("--check") == 1
+    assert capsys.readouterr().out == f"Out of date: {create_files / 'a_refers.md'}\n"
+    assert run_cli() == 0
+    assert run_cli("--check") == 0
+    assert capsys.readouterr().out == ""
+
+    # options the servers and --watch would ignore
+    for args in (
+        ("--watch", "--check"),
+        ("--watch", "--staged"),
+        ("serve", "--changed_since", "HEAD"),
+        ("lsp", "--rev", "HEAD"),
+        ("render", "--watch"),
+        ("--rev", "HEAD", "--staged"),
+        ("--rev", "HEAD", "--changed_since", "HEAD"),
+        ("--rev", "HEAD"),
+        ("--output_dir", "out"),
+    ):
+        assert run_cli(*args) == 2
+        assert "error: --" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize(
+    "create_files",
+    [(("tags.py", "a = 1  # @tag:a\n"),)],
+    indirect=True,
+)
+def test_cli_render_stdin(create_files: Path, monkeypatch):
+    doc = create_files / "doc.txt"
+    doc.write_bytes(b"file @ref:a:line\r\n")
+    stdin = io.TextIOWrapper(io.BytesIO(b"see @ref:a:line\r\nno refs\r\nend"))
+    stdout = io.TextIOWrapper(io.BytesIO())
+    monkeypatch.setattr(sys, "stdin", stdin)
+    monkeypatch.setattr(sys, "stdout", stdout)
+    monkeypatch.setattr(
+        sys, "argv", ["refers", "-r", str(create_files), "render", "-", str(doc)]
+    )
+    run()
+    # line endings are kept, on stdin as in files
+    assert stdout.buffer.getvalue() == b"see 1\r\nno refs\r\nendfile 1\r\n"
+
+
+# cumulative import time of refers.cli (python -X importtime), about 4x the time on a dev machine
+CLI_IMPORT_TIME_BUDGET_US = 300_000
+HEAVY_MODULES = ("black", "blib2to3", "pathspec", "concurrent.futures", "toml")
+
+
+def test_cli_import_time():
+    check_modules = (
+        "import sys, refers.cli; "
+        f"print([m for m in {HEAVY_MODULES} if m in sys.modules])"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", check_modules],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    assert out.strip() == "[]"
+
+    import_times = []
+    for _ in range(3):
+        stderr = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import refers.cli"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stderr
+        cumulative = re.search(r"\|\s*(\d+) \| refers\.cli$", stderr, re.MULTILINE)
+        assert cumulative is not None
+        import_times.append(int(cumulative.group(1)))
+    assert min(import_times) < CLI_IMPORT_TIME_BUDGET_US
+
+
+@pytest.mark.parametrize(
+    "create_files",
+    [
+        (
+            ("pyproject.toml", "[tool.refers]\n"),
+            ("notes.md", "a note @tag:a\n"),
+            ("code.py", "x = 1  # no tag\n"),
+            ("doc.md", "@ref:a:line\n"),
+        )
+    ],
+    indirect=True,
+)
+def test_black_not_imported_without_python_tags(create_files: Path):
+    script = (
+        "import sys; from refers.refers import format_doc; "
+        f"format_doc({str(create_files)!r}); print('black' in sys.modules)"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, text=True, check=True
+    ).stdout
+    assert out.strip() == "False"
+    assert (create_files / "doc_refers.md").read_text() == "1\n"